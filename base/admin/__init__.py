@@ -11,19 +11,24 @@ from django.contrib import messages
 from django.contrib.admin.utils import quote
 from django.core.exceptions import ValidationError
 from django.core.urlresolvers import reverse
-from django.db.models import Q, Count
+from django.db.models import Count, Prefetch
+from django.http import HttpResponseRedirect
 from django.template import Template, Context
 from django.utils.html import mark_safe
 from django.utils.translation import ugettext_lazy as _, ugettext
 from base.admin import util
+from base.decorators import depends
 from django_mptt_admin.admin import DjangoMpttAdmin
 from filebrowser.settings import ADMIN_THUMBNAIL
 from grappelli_filters import RelatedAutocompleteFilter, FiltersMixin
 
+from base.caching import get_place_flag
 from base.models import Unit, ItemCategory, Place, PurchaseItem, Payer, Purchase, Item, ItemSerial, ItemChunk, \
-    TransactionItem, Transaction, OrderItemSerial, ContractItemSerial, VItemMovement, VSerialMovement, \
-    get_descendants_ids, FixSerialTransform, FixCategoryMerge, FixPlaceMerge, Cell, GeoName, Transmutation, \
-    Warranty, Return
+    TransactionItem, Transaction, OrderItemSerial, ContractItemSerial, ItemMovement, SerialMovement, \
+    subtree_q, FixSerialTransform, FixCategoryMerge, FixPlaceMerge, Cell, GeoName, Transmutation, \
+    Warranty, Return, Job
+from base.rollup import get_summaries, format_summary
+from base.treecache import CachedTreeMixin
 from .actions import process_to_void, update_cell
 from .filters import MPTTRelatedAutocompleteFilter
 from .forms import ItemCategoryForm, PlaceForm, PurchaseItemForm, TransactionItemForm, PurchaseForm, TransactionForm, \
@@ -33,7 +38,8 @@ from .functions import create_model_admin
 from .inlines import ItemCategoryCommentInline, PurchaseItemInline, PurchaseItemInlineReadonly, \
     TransactionItemInlineReadonly, TransactionItemInline, TransactionCommentPlaceInline, TransmutationItemInline, \
     TransmutationItemInlineReadonly, ReturnItemInline, ReturnItemInlineReadonly
-from .overrides import AdminReadOnly, InlineReadOnly, HiddenAdminModelMixin
+from .overrides import AdminReadOnly, InlineReadOnly, HiddenAdminModelMixin, QueryPlanMixin
+from .pagination import EstimatedCountMixin
 
 try:
     from urllib import urlencode
@@ -55,7 +61,7 @@ class UnitAdmin(admin.ModelAdmin):
 
 
 @admin.register(ItemCategory)
-class ItemCategoryAdmin(DjangoMpttAdmin):
+class ItemCategoryAdmin(QueryPlanMixin, CachedTreeMixin, DjangoMpttAdmin):
     class Media:
         js = ('base/js/category_parent_autocomplete.js',)
 
@@ -83,10 +89,14 @@ class ItemCategoryAdmin(DjangoMpttAdmin):
     image_thumbnail.short_description = "Thumbnail"
 
     def get_tree_data(self, qs, max_level):
-        qs = qs.prefetch_related('items').annotate(num_items=Count('items'))
+        qs = qs.annotate(num_items=Count('items'))
+        summaries = get_summaries(ItemCategory, [node.pk for node in qs])
 
         def handle_create_node(instance, node_info):
             pk = instance.pk
+            summary = format_summary(summaries[pk])
+            if summary:
+                node_info['label'] = "%s (%s)" % (node_info['label'], summary)
 
             if instance.num_items:
                 node_info.update(
@@ -105,12 +115,12 @@ class ItemCategoryAdmin(DjangoMpttAdmin):
 
     def get_queryset(self, request):
         qs = super(ItemCategoryAdmin, self).get_queryset(request)
-        qs = qs.prefetch_related('items').annotate(num_items=Count('items'))
+        qs = qs.annotate(num_items=Count('items'))
         return qs
 
 
 @admin.register(Place)
-class PlaceAdmin(DjangoMpttAdmin):
+class PlaceAdmin(QueryPlanMixin, CachedTreeMixin, DjangoMpttAdmin):
     change_tree_template = u'admin/mptt_change_list.html'
     search_fields = ['name', ]
     tree_auto_open = False
@@ -125,12 +135,16 @@ class PlaceAdmin(DjangoMpttAdmin):
         return mark_safe(u'<a href="%s">%s</a>' % (link, _("items list")))
 
     def get_tree_data(self, qs, max_level):
-        qs = qs.prefetch_related('items').annotate(num_items=Count('items'))
+        qs = qs.annotate(num_items=Count('items'))
+        summaries = get_summaries(Place, [node.pk for node in qs])
 
         def handle_create_node(instance, node_info):
             pk = instance.pk
+            summary = format_summary(summaries[pk])
+            if summary:
+                node_info['label'] = "%s (%s)" % (node_info['label'], summary)
 
-            if Item.objects.filter(place_id=pk).count():
+            if instance.num_items:
                 node_info.update(
                         view_url=reverse("admin:base_place_item_changelist", args=[pk]),
                         transfer_url=reverse("admin:base_item_movement_filtered_changelist", args=[pk]),
@@ -144,7 +158,7 @@ class PlaceAdmin(DjangoMpttAdmin):
 
     def get_queryset(self, request):
         qs = super(PlaceAdmin, self).get_queryset(request)
-        qs = qs.prefetch_related('items').annotate(num_items=Count('items'))
+        qs = qs.annotate(num_items=Count('items'))
         return qs
 
 
@@ -201,8 +215,6 @@ class PurchaseAdmin(FiltersMixin, admin.ModelAdmin):
         else:
             inlines = self.inlines
 
-        self._obj = obj
-
         for inline_class in inlines:
             inline = inline_class(self.model, self.admin_site)
             inline_instances.append(inline)
@@ -223,8 +235,8 @@ class PurchaseAdmin(FiltersMixin, admin.ModelAdmin):
                     raise ValidationError(ugettext("purchase items data is read only!"))
             instance.save()
         formset.save_m2m()
-        if self._obj:
-            p = self._obj
+        if form.instance.pk:
+            p = form.instance
             if hasattr(p, "is_pending") and p.is_pending:
                 # print "complete pending purchase"
                 p.is_pending = False
@@ -232,14 +244,14 @@ class PurchaseAdmin(FiltersMixin, admin.ModelAdmin):
 
 
 @admin.register(Item)
-class ItemAdmin(FiltersMixin, AdminReadOnly):
+class ItemAdmin(QueryPlanMixin, FiltersMixin, AdminReadOnly):
     search_fields = ['category__name', 'place__name']
     list_filter = [('category', MPTTRelatedAutocompleteFilter), 'cell']
     list_display = ['category_name', 'quantity', 'place', 'cell']
 
 
 @admin.register(ItemSerial)
-class ItemSerialAdmin(FiltersMixin):
+class ItemSerialAdmin(EstimatedCountMixin, QueryPlanMixin, FiltersMixin):
     class Media:
         # js = ('base/js/place_item_changelist_autocomplete.js',)
         js = ('base/js/serial_purchase_autocomplete.js',)
@@ -261,6 +273,7 @@ class ItemSerialAdmin(FiltersMixin):
         return super(ItemSerialAdmin, self).get_queryset(request).select_related('item', 'item__category',
                                                                                  'item__place')
 
+    @depends(select_related=('item__place',))
     def owner(self, instance):
         return instance.item.place.name
 
@@ -284,7 +297,7 @@ class ItemSerialAdmin(FiltersMixin):
 
 
 @admin.register(ItemChunk)
-class ItemChunkAdmin(FiltersMixin, AdminReadOnly):
+class ItemChunkAdmin(QueryPlanMixin, FiltersMixin, AdminReadOnly):
     search_fields = ['item__category__name']
     list_filter = [
         ('item__category', MPTTRelatedAutocompleteFilter),
@@ -307,7 +320,7 @@ class TransactionItemAdmin(HiddenAdminModelMixin, AdminReadOnly):
 
 
 @admin.register(Transaction)
-class TransactionAdmin(FiltersMixin, admin.ModelAdmin):
+class TransactionAdmin(EstimatedCountMixin, FiltersMixin, admin.ModelAdmin):
     class Media:
         js = ('base/js/transaction_source_item_autocomplete.js',)
 
@@ -356,8 +369,6 @@ class TransactionAdmin(FiltersMixin, admin.ModelAdmin):
         else:
             inlines = self.inlines
 
-        self._obj = obj
-
         for inline_class in inlines:
             inline = inline_class(self.model, self.admin_site)
             inline_instances.append(inline)
@@ -382,8 +393,8 @@ class TransactionAdmin(FiltersMixin, admin.ModelAdmin):
                 elif instance.pk:
                     instance.delete()
         formset.save_m2m()
-        if self._obj:
-            t = self._obj
+        if form.instance.pk:
+            t = form.instance
             if hasattr(t, "is_pending") and t.is_pending:
                 # print "complete pending transaction"
                 t.is_pending = False
@@ -422,12 +433,6 @@ class PlaceItemAdmin(HiddenAdminModelMixin, ItemAdmin):
     action_form = CellItemActionForm
     actions = [update_cell]
 
-    def __init__(self, *args, **kwargs):
-        super(PlaceItemAdmin, self).__init__(*args, **kwargs)
-        self.place_id = None
-        self.place = None
-        self.show_zero = None
-
     def items_serials_changelist_link(self, obj):
         link = reverse("admin:base_item_serials_filtered_changelist", args=[obj.id])
         return mark_safe(u'<a href="%s">%s</a>' % (link, _("serials list")))
@@ -441,13 +446,16 @@ class PlaceItemAdmin(HiddenAdminModelMixin, ItemAdmin):
     items_chunks_changelist_link.short_description = _("chunks")
 
     def item_movement_changelist_link(self, obj):
-        link = reverse("admin:base_item_movement_filtered_changelist", args=[self.place_id, obj.category_id])
+        link = reverse("admin:base_item_movement_filtered_changelist", args=[obj.place_id, obj.category_id])
         return mark_safe(u'<a href="%s">%s</a>' % (link, _("movement history")))
 
     item_movement_changelist_link.short_description = _("movement history")
 
+    @depends(select_related=('cell',), prefetch_related=(Prefetch(
+        'serials', queryset=ItemSerial.objects.filter(cell__isnull=False).select_related('cell'), to_attr='cell_serials'
+    ),))
     def custom_cell(self, obj):
-        cell_list = list(set(obj.serials.filter(cell__isnull=False).values_list("cell__name", flat=True)))
+        cell_list = list(set(serial.cell.name for serial in obj.cell_serials))
         if len(cell_list) > 1:
             # or (cell_list and obj.cell is not None and not obj.cell.name == cell_list[0]):
             return "+".join(sorted(cell_list))
@@ -458,37 +466,39 @@ class PlaceItemAdmin(HiddenAdminModelMixin, ItemAdmin):
 
     def get_queryset(self, request):
         qs = super(PlaceItemAdmin, self).get_queryset(request)
-        qs = qs.filter(place_id=self.place_id)
-        if not self.show_zero:
+        qs = qs.filter(place_id=request.place_id)
+        if not request.show_zero:
             qs = qs.filter(quantity__gt=0)
         return qs
 
     def get_list_display(self, request):
         list_display = self.list_display[:]
-        if self.place.has_cells and 'custom_cell' not in self.list_display:
+        if request.place and get_place_flag(request.place.pk, 'has_cells') and 'custom_cell' not in self.list_display:
             list_display.append('custom_cell')
         if request.user.has_perm('base.view_item_price'):
             list_display.append('price')
         return list_display
 
     def changelist_view(self, request, place_id, extra_context=None):  # pylint:disable=arguments-differ
+        # filter state is kept on request: admin instance is shared by all requests of threaded worker
         request.GET._mutable = True
-        self.show_zero = int(request.GET.pop("show_zero", ["0"])[0])
+        request.show_zero = int(request.GET.pop("show_zero", ["0"])[0])
         request.GET.pop("a", None)
-        self.place_id = place_id
+        request.place_id = place_id
+        request.place = None
         extra_context = extra_context or {}
         try:
             place = Place.objects.get(pk=place_id)
         except Place.DoesNotExist:
             extra_context.update({'cl_header': _('Place does not exist')})
         else:
-            self.place = place
+            request.place = place
             cl_header = place.name
             params_get = request.GET.copy()
-            params_get.update({'show_zero': int(not self.show_zero)})
-            extra_context.update({'export_place_id': self.place.id})
+            params_get.update({'show_zero': int(not request.show_zero)})
+            extra_context.update({'export_place_id': place.id})
             extra_context.update({'show_zero_params': urlencode(params_get)})
-            extra_context.update({'show_zero': self.show_zero})
+            extra_context.update({'show_zero': request.show_zero})
             extra_context.update({'cl_header_addon': _("> ALL")})
             extra_context.update({'cl_header': mark_safe(cl_header)})
         view = super(PlaceItemAdmin, self).changelist_view(request, extra_context=extra_context)
@@ -518,12 +528,6 @@ class CategoryItemAdmin(HiddenAdminModelMixin, ItemAdmin):
     list_display = ['category_name', 'quantity', 'place', 'items_serials_changelist_link',
                     'items_chunks_changelist_link', 'item_movement_changelist_link']
 
-    def __init__(self, *args, **kwargs):
-        super(CategoryItemAdmin, self).__init__(*args, **kwargs)
-        self.category_id = None
-        self.category = None
-        self.show_zero = None
-
     def items_serials_changelist_link(self, obj):
         link = reverse("admin:base_item_serials_filtered_changelist", args=[obj.id])
         return mark_safe(u'<a href="%s">%s</a>' % (link, _("serials list")))
@@ -538,27 +542,26 @@ class CategoryItemAdmin(HiddenAdminModelMixin, ItemAdmin):
 
     def get_queryset(self, request):
         qs = super(CategoryItemAdmin, self).get_queryset(request)
-        qs = qs.filter(category_id=self.category_id)
-        if not self.show_zero:
+        qs = qs.filter(category_id=request.category_id)
+        if not request.show_zero:
             qs = qs.filter(quantity__gt=0)
         return qs
 
     def changelist_view(self, request, category_id, extra_context=None):  # pylint:disable=arguments-differ
         request.GET._mutable = True
-        self.show_zero = int(request.GET.pop("show_zero", ["0"])[0])
+        request.show_zero = int(request.GET.pop("show_zero", ["0"])[0])
         request.GET.pop("a", None)
         rq_qs = "?" + (request.GET.urlencode() or "a=1")
-        self.category_id = category_id
+        request.category_id = category_id
         extra_context = extra_context or {}
         try:
             category = ItemCategory.objects.get(pk=category_id)
         except ItemCategory.DoesNotExist:
             extra_context.update({'cl_header': _('Category does not exist')})
         else:
-            self.category = category
             cl_header = _(u"<{name}> items".format(name=category.name))
             extra_context.update({'export_place_id': None})
-            extra_context.update({'show_zero': self.show_zero})
+            extra_context.update({'show_zero': request.show_zero})
             extra_context.update({'rq_qs': rq_qs})
             extra_context.update({'cl_header': mark_safe(cl_header)})
             extra_context.update({'hide_zero_switch': True})
@@ -595,11 +598,6 @@ class ItemSerialsFilteredAdmin(HiddenAdminModelMixin, ItemSerialAdmin):
     list_display = ['serial', 'category_name', 'serial_movement_changelist_link', 'custom_warranty_date']
     tpl = Template("{{ form.as_p }}")
 
-    def __init__(self, *args, **kwargs):
-        super(ItemSerialsFilteredAdmin, self).__init__(*args, **kwargs)
-        self.item_id = None
-        self.item = None
-
     def serial_movement_changelist_link(self, obj):
         link = reverse("admin:base_serial_movement_filtered_changelist", args=[obj.id])
         return mark_safe(u'<a href="%s">%s</a>' % (link, _("movement history")))
@@ -608,25 +606,27 @@ class ItemSerialsFilteredAdmin(HiddenAdminModelMixin, ItemSerialAdmin):
 
     def get_queryset(self, request):
         qs = super(ItemSerialsFilteredAdmin, self).get_queryset(request)
-        return qs.filter(item_id=self.item_id)
+        return qs.filter(item_id=request.item_id)
 
     def get_list_display(self, request):
         list_display = self.list_display[:]
-        if self.item.place.has_cells and 'custom_cell' not in self.list_display:
+        has_cells = request.item and get_place_flag(request.item.place_id, 'has_cells')
+        if has_cells and 'custom_cell' not in self.list_display:
             list_display.append('custom_cell')
         if request.user.has_perm('base.view_item_price'):
             list_display.append('price')
         return list_display
 
     def changelist_view(self, request, item_id, extra_context=None):  # pylint:disable=arguments-differ
-        self.item_id = item_id
+        request.item_id = item_id
+        request.item = None
         extra_context = extra_context or {}
         try:
             item = Item.objects.get(pk=item_id)
         except Item.DoesNotExist:
             extra_context.update({'cl_header': _('Item does not exist')})
         else:
-            self.item = item
+            request.item = item
             extra_context.update({'cl_header': _(u"Serials for <{name}> in <{place}>".format(
                     name=item.category.name,
                     place=item.place.name
@@ -637,6 +637,7 @@ class ItemSerialsFilteredAdmin(HiddenAdminModelMixin, ItemSerialAdmin):
     action_form = CellItemActionForm
     actions = [update_cell]
 
+    @depends(select_related=('item__place', 'cell'))
     def custom_cell(self, obj):
         if not obj.item.place.has_cells:
             return obj.cell
@@ -645,6 +646,7 @@ class ItemSerialsFilteredAdmin(HiddenAdminModelMixin, ItemSerialAdmin):
         return mark_safe('<span class="autocomplete-wrapper-js" '
                          'data-url="/base/ajax/serial_cell" data-item-id="%s">%s</span>' % (obj.pk, html))
 
+    @depends(select_related=('warranty',))
     def custom_warranty_date(self, obj):
         try:
             warranty = obj.warranty
@@ -683,34 +685,30 @@ class ItemChunksFilteredAdmin(HiddenAdminModelMixin, ItemChunkAdmin):
     class Media:
         js = ('base/js/place_item_changelist_autocomplete.js',)
 
-    item_id = None
     list_display = ['chunk', 'category_name']
     tpl = Template("{{ form.as_p }}")
 
-    def __init__(self, *args, **kwargs):
-        super(ItemChunksFilteredAdmin, self).__init__(*args, **kwargs)
-        self.item_id = None
-        self.item = None
-
     def get_queryset(self, request):
         qs = super(ItemChunksFilteredAdmin, self).get_queryset(request)
-        return qs.filter(item_id=self.item_id)
+        return qs.filter(item_id=request.item_id)
 
     def get_list_display(self, request):
         list_display = self.list_display[:]
-        if self.item.place.has_cells and 'custom_cell' not in self.list_display:
+        has_cells = request.item and get_place_flag(request.item.place_id, 'has_cells')
+        if has_cells and 'custom_cell' not in self.list_display:
             list_display.append('custom_cell')
         return list_display
 
     def changelist_view(self, request, item_id, extra_context=None):  # pylint:disable=arguments-differ
-        self.item_id = item_id
+        request.item_id = item_id
+        request.item = None
         extra_context = extra_context or {}
         try:
             item = Item.objects.get(pk=item_id)
         except Item.DoesNotExist:
             extra_context.update({'cl_header': _('Item does not exist')})
         else:
-            self.item = item
+            request.item = item
             extra_context.update({'cl_header': _(u"Chunks for <{name}> in <{place}>".format(
                     name=item.category.name,
                     place=item.place.name
@@ -721,6 +719,7 @@ class ItemChunksFilteredAdmin(HiddenAdminModelMixin, ItemChunkAdmin):
     action_form = CellItemActionForm
     actions = [update_cell]
 
+    @depends(select_related=('item__place', 'cell'))
     def custom_cell(self, obj):
         if not obj.item.place.has_cells:
             return obj.cell
@@ -750,7 +749,7 @@ create_model_admin(ItemChunksFilteredAdmin, name='item_chunks_filtered', model=I
 
 
 @admin.register(OrderItemSerial)
-class OrderItemSerialAdmin(FiltersMixin, admin.ModelAdmin):
+class OrderItemSerialAdmin(QueryPlanMixin, FiltersMixin, admin.ModelAdmin):
     search_fields = ['serial']
     list_filter = [('item__place', MPTTRelatedAutocompleteFilter), ]
     list_display = ['serial', 'category_name', 'owner', 'comment']
@@ -767,16 +766,17 @@ class OrderItemSerialAdmin(FiltersMixin, admin.ModelAdmin):
                 'item', 'item__category', 'item__place'
         )
         return qs.filter(
-                item__category_id__in=get_descendants_ids(ItemCategory, settings.APP_FILTERS["CAT_ORDERS_ID"]),
-                item__place_id__in=get_descendants_ids(Place, settings.APP_FILTERS["PLACE_WORKERS_ID"])
+                subtree_q('item__category', ItemCategory, settings.APP_FILTERS["CAT_ORDERS_ID"], include_self=False),
+                subtree_q('item__place', Place, settings.APP_FILTERS["PLACE_WORKERS_ID"], include_self=False)
         )
 
+    @depends(select_related=('item__place',))
     def owner(self, instance):
         return instance.item.place.name
 
 
 @admin.register(ContractItemSerial)
-class ContractItemSerialAdmin(FiltersMixin, admin.ModelAdmin):
+class ContractItemSerialAdmin(QueryPlanMixin, FiltersMixin, admin.ModelAdmin):
     search_fields = ['serial']
     list_filter = [('item__place', MPTTRelatedAutocompleteFilter), ]
     list_display = ['serial', 'category_name', 'owner', 'comment']
@@ -793,16 +793,17 @@ class ContractItemSerialAdmin(FiltersMixin, admin.ModelAdmin):
                 'item', 'item__category', 'item__place'
         )
         return qs.filter(
-                item__category_id__in=get_descendants_ids(ItemCategory, settings.APP_FILTERS["CAT_CONTRACTS_ID"]),
-                item__place_id__in=get_descendants_ids(Place, settings.APP_FILTERS["PLACE_WORKERS_ID"])
+                subtree_q('item__category', ItemCategory, settings.APP_FILTERS["CAT_CONTRACTS_ID"], include_self=False),
+                subtree_q('item__place', Place, settings.APP_FILTERS["PLACE_WORKERS_ID"], include_self=False)
         )
 
+    @depends(select_related=('item__place',))
     def owner(self, instance):
         return instance.item.place.name
 
 
-@admin.register(VItemMovement)
-class ItemMovementAdmin(FiltersMixin, AdminReadOnly):
+@admin.register(ItemMovement)
+class ItemMovementAdmin(EstimatedCountMixin, QueryPlanMixin, FiltersMixin, AdminReadOnly):
     search_fields = ['destination__name', 'source__name', 'category__name']
     list_filter = (
         ('created_at', DateRangeFilter),
@@ -814,9 +815,17 @@ class ItemMovementAdmin(FiltersMixin, AdminReadOnly):
     list_display = ['item_category_name', 'created_at', 'completed_at', 'source', 'destination', 'quantity', 'price']
     fields = ['item_category_name', 'created_at', 'completed_at', 'source', 'destination', 'quantity']
 
+    def get_queryset(self, request):
+        qs = super(ItemMovementAdmin, self).get_queryset(request)
+        place_id = getattr(request, 'place_id', None)
+        if place_id:
+            return qs.filter(place_id=place_id)
+        # every movement is stored for source and for destination, list it once
+        return qs.filter(direction=ItemMovement.IN)
+
 
-@admin.register(VSerialMovement)
-class SerialMovementAdmin(FiltersMixin, AdminReadOnly):
+@admin.register(SerialMovement)
+class SerialMovementAdmin(EstimatedCountMixin, QueryPlanMixin, FiltersMixin, AdminReadOnly):
     search_fields = ['destination__name', 'source__name', 'category__name', 'serial']
     list_filter = (
         ('created_at', DateRangeFilter),
@@ -830,23 +839,27 @@ class SerialMovementAdmin(FiltersMixin, AdminReadOnly):
     fields = ['serial', 'item_category_name', 'created_at', 'completed_at',
               'source', 'destination', 'quantity']
 
+    def get_queryset(self, request):
+        qs = super(SerialMovementAdmin, self).get_queryset(request)
+        place_id = getattr(request, 'place_id', None)
+        if place_id:
+            return qs.filter(place_id=place_id)
+        # every movement is stored for source and for destination, list it once
+        return qs.filter(direction=SerialMovement.IN)
+
 
 class ItemMovementFilteredAdmin(HiddenAdminModelMixin, ItemMovementAdmin):
-    place_id = None
-    category_id = None
 
     def get_queryset(self, request):
         qs = super(ItemMovementFilteredAdmin, self).get_queryset(request)
-        if self.place_id:
-            qs = qs.filter(Q(source_id=self.place_id) | Q(destination_id=self.place_id))
-        if self.category_id:
-            qs = qs.filter(category_id=self.category_id)
+        if request.category_id:
+            qs = qs.filter(category_id=request.category_id)
         return qs
 
     def changelist_view(self, request, place_id=None, category_id=None,
                         extra_context=None):  # pylint:disable=arguments-differ
-        self.place_id = int(place_id or "0")
-        self.category_id = int(category_id or "0")
+        request.place_id = int(place_id or "0")
+        request.category_id = int(category_id or "0")
         extra_context = extra_context or {}
         try:
             place = Place.objects.get(pk=place_id)
@@ -889,23 +902,18 @@ class ItemMovementFilteredAdmin(HiddenAdminModelMixin, ItemMovementAdmin):
     change_list_template = 'admin/proxy_change_list.html'
 
 
-create_model_admin(ItemMovementFilteredAdmin, name='item_movement_filtered', model=VItemMovement)
+create_model_admin(ItemMovementFilteredAdmin, name='item_movement_filtered', model=ItemMovement)
 
 
 class SerialMovementFilteredAdmin(HiddenAdminModelMixin, SerialMovementAdmin):
-    place_id = None
-    serial_id = None
 
     def get_queryset(self, request):
         qs = super(SerialMovementFilteredAdmin, self).get_queryset(request)
-        qs = qs.filter(serial_id=self.serial_id)
-        if self.place_id:
-            qs = qs.filter(Q(source_id=self.place_id) | Q(destination_id=self.place_id))
-        return qs
+        return qs.filter(item_serial_id=request.serial_id)
 
     def changelist_view(self, request, serial_id, place_id=None, extra_context=None):  # pylint:disable=arguments-differ
-        self.place_id = place_id
-        self.serial_id = serial_id
+        request.place_id = place_id
+        request.serial_id = serial_id
         extra_context = extra_context or {}
         try:
             serial = ItemSerial.objects.get(pk=serial_id)
@@ -948,7 +956,7 @@ class SerialMovementFilteredAdmin(HiddenAdminModelMixin, SerialMovementAdmin):
     change_list_template = 'admin/proxy_change_list.html'
 
 
-create_model_admin(SerialMovementFilteredAdmin, name='serial_movement_filtered', model=VSerialMovement)
+create_model_admin(SerialMovementFilteredAdmin, name='serial_movement_filtered', model=SerialMovement)
 
 
 @admin.register(FixSerialTransform)
@@ -977,6 +985,31 @@ class FixCategoryMergeAdmin(admin.ModelAdmin):
             readonly_fields.extend(['old_category', 'new_category'])
         return readonly_fields
 
+    def save_model(self, request, obj, form, change):
+        """
+        Dry run is not saved: counts of rows which merge would change are shown as message instead.
+        """
+        if change or not form.cleaned_data.get('dry_run'):
+            super(FixCategoryMergeAdmin, self).save_model(request, obj, form, change)
+            return
+        obj.old_category_sav_id, obj.old_category_sav_name = obj.old_category_id, obj.old_category.name
+        log = obj.do_merge(dry_run=True)
+        self.message_user(request, ugettext("dry run: {counts}").format(
+            counts=", ".join("%s: %s" % (name, count) for name, count in log['counts'].items())
+        ), level=messages.INFO)
+
+    def log_addition(self, request, obj):
+        if obj.pk:
+            super(FixCategoryMergeAdmin, self).log_addition(request, obj)
+
+    def response_add(self, request, obj, post_url_continue=None):
+        if obj.pk:
+            return super(FixCategoryMergeAdmin, self).response_add(request, obj, post_url_continue)
+        # back to add form with the same categories after dry run
+        return HttpResponseRedirect("%s?%s" % (request.path, urlencode({
+            'old_category': obj.old_category_id, 'new_category': obj.new_category_id
+        })))
+
 
 @admin.register(FixPlaceMerge)
 class FixPlaceMergeAdmin(admin.ModelAdmin):
@@ -986,12 +1019,32 @@ class FixPlaceMergeAdmin(admin.ModelAdmin):
 
     def get_readonly_fields(self, request, obj=None):
         readonly_fields = list(self.readonly_fields)
-        readonly_fields.extend(['timestamp', 'old_place_sav_id', 'old_place_sav_name'])
+        readonly_fields.extend(['data', 'timestamp', 'old_place_sav_id', 'old_place_sav_name', 'transaction'])
         if obj and obj.pk:
             readonly_fields.extend(['old_place', 'new_place'])
         return readonly_fields
 
 
+@admin.register(Job)
+class JobAdmin(AdminReadOnly):
+    list_display = ['__str__', 'status', 'progress_display', 'attempts', 'created_by', 'created_at', 'finished_at',
+                    'result_link']
+    list_filter = ['status', 'name']
+
+    def progress_display(self, obj):
+        progress, message = obj.get_progress()
+        return "%s%% %s" % (progress, message)
+    progress_display.short_description = _("progress")
+
+    def result_link(self, obj):
+        url = obj.get_download_url()
+        if url:
+            return mark_safe('<a href="%s">%s</a>' % (url, ugettext("download")))
+        return ''
+    result_link.short_description = _("result")
+    result_link.allow_tags = True
+
+
 @admin.register(Cell)
 class CellAdmin(FiltersMixin, admin.ModelAdmin):
     search_fields = ['name']
@@ -1043,7 +1096,6 @@ class TransmutationAdmin(FiltersMixin, admin.ModelAdmin):
             _inlines = [TransmutationItemInlineReadonly, ]
         else:
             _inlines = self.inlines
-        self._obj = obj
 
         for inline_class in _inlines:
             inline = inline_class(self.model, self.admin_site)
@@ -1055,16 +1107,19 @@ class TransmutationAdmin(FiltersMixin, admin.ModelAdmin):
         for instance in instances:
             instance.save()
         formset.save_m2m()
-        if self._obj:
-            t = self._obj
+        if form.instance.pk:
+            t = form.instance
             if hasattr(t, "is_pending") and t.is_pending:
                 # print "complete pending transaction"
                 t.is_pending = False
-                t.transmute()
+                job = Job.dispatch('transmutation', {'transmutation_id': t.pk}, request.user)
+                if job:
+                    messages.info(request, mark_safe(ugettext("Operation is queued: <a href=\"%s\">%s</a>") % (
+                        reverse("admin:base_job_change", args=[job.pk]), job)))
 
 
 @admin.register(Warranty)
-class WarrantyAdmin(FiltersMixin, admin.ModelAdmin):
+class WarrantyAdmin(QueryPlanMixin, FiltersMixin, admin.ModelAdmin):
     search_fields = ['serial__serial', 'serial__item__category__name']
     list_display = ['__str__', 'category_name', 'date']
     list_filter = [
@@ -1116,7 +1171,6 @@ class ReturnAdmin(FiltersMixin, admin.ModelAdmin):
             _inlines = [ReturnItemInlineReadonly, ]
         else:
             _inlines = self.inlines
-        self._obj = obj
 
         for inline_class in _inlines:
             inline = inline_class(self.model, self.admin_site)
@@ -1128,9 +1182,12 @@ class ReturnAdmin(FiltersMixin, admin.ModelAdmin):
         for instance in instances:
             instance.save()
         formset.save_m2m()
-        if self._obj:
-            t = self._obj
+        if form.instance.pk:
+            t = form.instance
             if hasattr(t, "is_pending") and t.is_pending:
                 # print "complete pending transaction"
                 t.is_pending = False
-                t.ret()
+                job = Job.dispatch('return', {'return_id': t.pk}, request.user)
+                if job:
+                    messages.info(request, mark_safe(ugettext("Operation is queued: <a href=\"%s\">%s</a>") % (
+                        reverse("admin:base_job_change", args=[job.pk]), job)))
@@ -1,9 +1,11 @@
 # -*- encoding: utf-8 -*-
 from __future__ import print_function, division, unicode_literals, absolute_import
 
+from django.utils.translation import ugettext_lazy as _
 from grappelli_filters import RelatedAutocompleteFilter
 from mptt.models import MPTTModel
-from django.utils.translation import ugettext_lazy as _
+
+from base.models import subtree_q
 
 
 class MPTTRelatedAutocompleteFilter(RelatedAutocompleteFilter):
@@ -44,8 +46,7 @@ class MPTTRelatedAutocompleteFilter(RelatedAutocompleteFilter):
                         request.mptt_filter = '%s | %s:"%s"' % (request.mptt_filter, _(last_field_path), obj)
                     else:
                         request.mptt_filter = '%s:"%s"' % (_(last_field_path), obj)
-                    tree = obj.get_descendants(include_self=True)
-                    param = tree.values_list("id", flat=True)
+                    return queryset.filter(subtree_q(self.field_path, mptt_model, obj))
 
             filter_parameter = self.filter_parameter if self.filter_parameter else self.get_parameter_name(self.field_path)
             return queryset.filter(**{filter_parameter: param})
@@ -0,0 +1,111 @@
+# -*- encoding: utf-8 -*-
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+import json
+
+from django.conf import settings
+from django.contrib.admin.views.main import PAGE_VAR
+from django.core.paginator import Paginator, Page, PageNotAnInteger, EmptyPage
+from django.db import connections
+from django.utils import six
+
+
+def estimate_count(queryset):
+    """
+    Planner estimate of rows count of queryset (EXPLAIN w/o ANALYZE), table statistics are read instead of rows.
+    :rtype: int
+    """
+    sql, params = queryset.order_by().query.sql_with_params()
+    with connections[queryset.db].cursor() as cursor:
+        cursor.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, six.string_types):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+class EstimatedPage(Page):
+    def __init__(self, object_list, number, paginator, has_next):
+        super(EstimatedPage, self).__init__(object_list, number, paginator)
+        self._has_next = has_next
+
+    def has_next(self):
+        return self._has_next
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator of huge querysets. If planner estimates more than settings.APP_ADMIN_COUNT_ESTIMATE rows,
+    count is the estimate and pages know only if next page exists (one extra row is read), small sets
+    are counted exactly.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(EstimatedCountPaginator, self).__init__(*args, **kwargs)
+        self.estimated = False
+        self.current_page = None
+
+    def _get_count(self):
+        if self._count is None:
+            estimate = estimate_count(self.object_list)
+            self.estimated = estimate > settings.APP_ADMIN_COUNT_ESTIMATE
+            self._count = estimate if self.estimated else self.object_list.count()
+        return self._count
+
+    count = property(_get_count)
+
+    def validate_number(self, number):
+        if not self.count or not self.estimated:
+            return super(EstimatedCountPaginator, self).validate_number(number)
+        try:
+            number = int(number)
+        except (TypeError, ValueError):
+            raise PageNotAnInteger('That page number is not an integer')
+        if number < 1:
+            raise EmptyPage('That page number is less than 1')
+        return number
+
+    def page(self, number):
+        number = self.validate_number(number)
+        if not self.estimated:
+            return super(EstimatedCountPaginator, self).page(number)
+        bottom = (number - 1) * self.per_page
+        rows = list(self.object_list[bottom:bottom + self.per_page + 1])
+        self.current_page = EstimatedPage(rows[:self.per_page], number, self, len(rows) > self.per_page)
+        return self.current_page
+
+
+_changelists = {}
+
+
+def estimated_changelist(changelist):
+    """
+    :return: subclass of ChangeList class with previous_page_url and next_page_url of estimated count pagination
+    """
+    if changelist not in _changelists:
+        class EstimatedChangeList(changelist):
+            def get_results(self, request):
+                super(EstimatedChangeList, self).get_results(request)
+                self.count_estimated = getattr(self.paginator, 'estimated', False)
+                self.previous_page_url = self.next_page_url = None
+                page = getattr(self.paginator, 'current_page', None)
+                if self.count_estimated and page:
+                    if page.has_previous():
+                        self.previous_page_url = self.get_query_string({PAGE_VAR: self.page_num - 1})
+                    if page.has_next():
+                        self.next_page_url = self.get_query_string({PAGE_VAR: self.page_num + 1})
+
+        _changelists[changelist] = EstimatedChangeList
+    return _changelists[changelist]
+
+
+class EstimatedCountMixin(object):
+    """
+    Changelist of huge table: single count query (w/o count of unfiltered table), which is replaced by planner
+    estimate for big sets, "about N" and previous/next navigation instead of page numbers then.
+    """
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def get_changelist(self, request, **kwargs):
+        return estimated_changelist(super(EstimatedCountMixin, self).get_changelist(request, **kwargs))
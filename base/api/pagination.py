@@ -0,0 +1,102 @@
+# -*- encoding: utf-8 -*-
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from django.utils.translation import ugettext_lazy as _
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """
+    Cursor pagination keyed on (ordering_field, id) in descending order. Page is read by index range, so its cost
+    does not depend on depth, and rows committed while client scrolls do not shift pages.
+    Empty ordering_field values (not completed transactions) go first, as Postgres sorts NULLs in DESC order.
+    Cursor is urlsafe base64 of json [value, id, reverse].
+    """
+    cursor_query_param = 'cursor'
+    page_size = api_settings.PAGE_SIZE
+    invalid_cursor_message = _('Invalid cursor')
+    ordering_field = 'completed_at'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.base_url = request.build_absolute_uri()
+        self.cursor = self.decode_cursor(request)
+        reverse = bool(self.cursor and self.cursor[2])
+        if self.cursor:
+            queryset = queryset.filter(self.get_position_filter(*self.cursor))
+        if reverse:
+            queryset = queryset.order_by(self.ordering_field, 'id')
+        else:
+            queryset = queryset.order_by('-' + self.ordering_field, '-id')
+
+        results = list(queryset[:self.page_size + 1])
+        has_more = len(results) > self.page_size
+        self.page = results[:self.page_size]
+        if reverse:
+            self.page.reverse()
+            self.has_next = True
+            self.has_previous = has_more
+        else:
+            self.has_next = has_more
+            self.has_previous = self.cursor is not None
+        return self.page
+
+    def get_position_filter(self, value, pk, reverse):
+        """
+        Rows after (value, pk) position in descending order, or before it if reverse is set.
+        """
+        field = self.ordering_field
+        if not reverse:
+            if value is None:
+                return Q(**{field + '__isnull': True, 'id__lt': pk}) | Q(**{field + '__isnull': False})
+            return Q(**{field + '__lt': value}) | Q(**{field: value, 'id__lt': pk})
+        if value is None:
+            return Q(**{field + '__isnull': True, 'id__gt': pk})
+        return Q(**{field + '__isnull': True}) | Q(**{field + '__gt': value}) | Q(**{field: value, 'id__gt': pk})
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+        try:
+            value, pk, reverse = json.loads(urlsafe_b64decode(encoded.encode('ascii')).decode('utf-8'))
+            pk = int(pk)
+            if value is not None:
+                value = parse_datetime(value)
+                if value is None:
+                    raise ValueError(value)
+        except (TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        return value, pk, bool(reverse)
+
+    def encode_cursor(self, instance, reverse):
+        value = getattr(instance, self.ordering_field)
+        data = [value.isoformat() if value is not None else None, instance.pk, reverse]
+        encoded = urlsafe_b64encode(json.dumps(data).encode('utf-8')).decode('ascii')
+        return replace_query_param(self.base_url, self.cursor_query_param, encoded)
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        return self.encode_cursor(self.page[-1], False)
+
+    def get_previous_link(self):
+        if not self.has_previous or not self.page:
+            return None
+        return self.encode_cursor(self.page[0], True)
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data)
+        ]))
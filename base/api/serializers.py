@@ -1,7 +1,7 @@
 # -*- encoding: utf-8 -*-
 from rest_framework import serializers
 
-from base.models import ItemCategory, Item, TransactionItem, ItemSerial, Place, VItemMovement, VSerialMovement, \
+from base.models import ItemCategory, Item, TransactionItem, ItemSerial, Place, ItemMovement, SerialMovement, \
     Transaction
 
 
@@ -64,19 +64,19 @@ class PlaceSerializer(serializers.HyperlinkedModelSerializer):
         return None
 
 
-class VItemMovementSerializer(serializers.HyperlinkedModelSerializer):
+class ItemMovementSerializer(serializers.HyperlinkedModelSerializer):
     category = CategorySerializer(read_only=True)
 
     class Meta:
-        model = VItemMovement
+        model = ItemMovement
         fields = ('item_category_name', 'category', 'quantity', 'source_name', 'destination_name', 'completed_at')
 
 
-class VSerialMovementSerializer(serializers.HyperlinkedModelSerializer):
+class SerialMovementSerializer(serializers.HyperlinkedModelSerializer):
     category = CategorySerializer(read_only=True)
 
     class Meta:
-        model = VSerialMovement
+        model = SerialMovement
         fields = ('item_category_name', 'category', 'serial', 'source_name', 'destination_name', 'completed_at')
 
 
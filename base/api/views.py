@@ -3,6 +3,7 @@ from rest_framework.exceptions import NotFound
 from rest_framework.views import APIView
 from rest_framework.response import Response
 
+from base.models import StockBalance
 from .serializers import PlaceSerializer, ItemSerializer
 
 
@@ -21,13 +22,14 @@ class HomeView(APIView):
         if not place:
             raise NotFound()
 
+        stocked = StockBalance.objects.filter(place=place, available__gt=0).values('category_id')
+        items = place.items.filter(is_reserved=False, category_id__in=stocked).select_related(
+            'category').prefetch_related('serials')
         q = request.GET.get('q', None)
-        if not q:
-            items = place.items.all()
-        elif len(q) > 3:
-            items = place.items.filter(category__name__similar=q)
+        if q and len(q) > 3:
+            items = items.filter(category__name__similar=q)
         elif q:
-            items = place.items.filter(category__name__icontains=q)
+            items = items.filter(category__name__icontains=q)
         data = PlaceSerializer(place, context={'request': request}).data
         data['items'] = ItemSerializer(items, many=True, context={'request': request}).data
 
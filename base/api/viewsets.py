@@ -4,62 +4,81 @@ from pprint import pprint
 from django.http import Http404
 from django.utils.translation import ugettext_lazy as _
 from rest_framework import viewsets, filters, status
+from rest_framework.decorators import detail_route
 from rest_framework.exceptions import NotFound, PermissionDenied, ParseError
 from rest_framework.response import Response
 from django.db.models import Q
 
-from base.models import ItemCategory, VItemMovement, VSerialMovement, Transaction, Place, TransactionItem
+from base.models import ItemCategory, ItemMovement, SerialMovement, Transaction, Place, TransactionItem
+from base.rollup import subtree_stock
+from base.search import ranked
+from .pagination import KeysetPagination
 
-from .serializers import CategorySerializer, PlaceSerializer, VItemMovementSerializer, VSerialMovementSerializer, \
+from .serializers import CategorySerializer, PlaceSerializer, ItemMovementSerializer, SerialMovementSerializer, \
     TransactionSerializer, TransactionSerializerDetailed, TransactionItemSerializer
 
 
-class CategoryViewSet(viewsets.ReadOnlyModelViewSet):
+class StockMixin(object):
+    """
+    Adds /stock/ route with cached subtree summary of object and stock of other tree subtree,
+    ex: /place/3/stock/?category=12
+    """
+    stock_field = None
+    stock_filter = None
+
+    @detail_route()
+    def stock(self, request, pk=None):
+        obj = self.get_object()
+        data = {'summary': obj.stock_summary}
+        other = request.GET.get(self.stock_filter, None)
+        try:
+            other = int(other) if other else None
+        except ValueError:
+            raise ParseError()
+        data['stock'] = subtree_stock(**{self.stock_field: obj, self.stock_filter: other})
+        return Response(data)
+
+
+class CategoryViewSet(StockMixin, viewsets.ReadOnlyModelViewSet):
     queryset = ItemCategory.objects.all()
     serializer_class = CategorySerializer
     search_fields = ('name',)
+    stock_field = 'category'
+    stock_filter = 'place'
 
     def get_queryset(self):
         """
         queryset filtered by search
         """
         q = self.request.GET.get('q', None)
-        if not q:
-            categories = ItemCategory.objects.all()
-        elif len(q) > 3:
-            categories = ItemCategory.objects.filter(name__similar=q).extra(
-                select={'distance': "similarity(base_itemcategory.name, '%s')" % q}
-            ).order_by('-distance')
-        else:
-            categories = ItemCategory.objects.filter(name__icontains=q)
+        categories = ItemCategory.objects.all()
+        if q:
+            categories = ranked(categories, q)
         return categories
 
 
-class PlaceViewSet(viewsets.ReadOnlyModelViewSet):
+class PlaceViewSet(StockMixin, viewsets.ReadOnlyModelViewSet):
     queryset = Place.objects.all()
     serializer_class = PlaceSerializer
     search_fields = ('name',)
+    stock_field = 'place'
+    stock_filter = 'category'
 
     def get_queryset(self):
         """
         queryset filtered by search
         """
         q = self.request.GET.get('q', None)
-        if not q:
-            places = Place.objects.all()
-        elif len(q) > 3:
-            places = Place.objects.filter(name__similar=q).extra(
-                select={'distance': "similarity(base_place.name, '%s')" % q}
-            ).order_by('-distance')
-        else:
-            places = Place.objects.filter(name__icontains=q)
+        places = Place.objects.all()
+        if q:
+            places = ranked(places, q)
         return places
 
 
 class FilteredByPlaceMixin(object):
-    def get_queryset(self):
+    def get_place(self):
         """
-        queryset filtered for current user
+        place of current user
         """
         place = None
         try:
@@ -68,19 +87,36 @@ class FilteredByPlaceMixin(object):
             print(e)
         if not place:
             raise NotFound()
+        return place
+
+    def get_queryset(self):
+        """
+        queryset filtered for current user
+        """
+        place = self.get_place()
         return self.queryset.filter(Q(source=place)|Q(destination=place)).order_by('-completed_at')
 
 
-class VItemMovementViewSet(FilteredByPlaceMixin, viewsets.ReadOnlyModelViewSet):
-    queryset = VItemMovement.objects.all()
-    serializer_class = VItemMovementSerializer
+class MovementFilteredByPlaceMixin(FilteredByPlaceMixin):
+    def get_queryset(self):
+        """
+        movements of current user place, read by (place, completed_at) ledger index
+        """
+        return self.queryset.filter(place=self.get_place()).order_by('-completed_at', '-id')
+
+
+class ItemMovementViewSet(MovementFilteredByPlaceMixin, viewsets.ReadOnlyModelViewSet):
+    queryset = ItemMovement.objects.all()
+    serializer_class = ItemMovementSerializer
+    pagination_class = KeysetPagination
     search_fields = ('item_category_name', )
     filter_fields = ('category', )
 
 
-class VSerialMovementViewSet(FilteredByPlaceMixin, viewsets.ReadOnlyModelViewSet):
-    queryset = VSerialMovement.objects.all()
-    serializer_class = VSerialMovementSerializer
+class SerialMovementViewSet(MovementFilteredByPlaceMixin, viewsets.ReadOnlyModelViewSet):
+    queryset = SerialMovement.objects.all()
+    serializer_class = SerialMovementSerializer
+    pagination_class = KeysetPagination
     search_fields = ('item_category_name', 'serial')
     filter_fields = ('serial', )
 
@@ -88,6 +124,7 @@ class VSerialMovementViewSet(FilteredByPlaceMixin, viewsets.ReadOnlyModelViewSet
 class TransactionViewSet(FilteredByPlaceMixin, viewsets.ModelViewSet):
     queryset = Transaction.objects.all()
     serializer_class = TransactionSerializer
+    pagination_class = KeysetPagination
     filter_fields = ('source', 'destination')
 
     def create(self, request, *args, **kwargs):
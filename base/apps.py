@@ -0,0 +1,15 @@
+# -*- encoding: utf-8 -*-
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+from django.apps import AppConfig
+
+
+class BaseConfig(AppConfig):
+    name = 'base'
+
+    def ready(self):
+        # connect cache invalidation signals
+        import base.caching  # noqa
+        import base.locking  # noqa
+        import base.serials  # noqa
+        import base.treecache  # noqa
@@ -0,0 +1,118 @@
+# -*- encoding: utf-8 -*-
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+import time
+from collections import OrderedDict, namedtuple
+from datetime import timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+from base.models import Item, ItemSerial, ItemChunk, TransactionItem, Transaction, MovementLedger
+
+Violation = namedtuple('Violation', ['item_id', 'place_id', 'category_id', 'expected', 'actual'])
+
+# Every check is single aggregate query over items, returning rows (item_id, place_id, category_id, expected, actual)
+# of items which break invariant. For orphan_reserved expected is reserved_by TransactionItem and actual is its
+# transaction (missing or completed). {scope} is replaced by items filter of incremental mode.
+CHECKS = OrderedDict([
+    ('chunk_sum', """
+        SELECT i.id AS item_id, i.place_id, i.category_id, i.quantity AS expected, sum(c.chunk) AS actual
+        FROM {item} i
+            JOIN {chunk} c ON c.item_id = i.id
+        WHERE {{scope}}
+        GROUP BY i.id
+        HAVING i.quantity <> sum(c.chunk)
+    """),
+    ('serial_count', """
+        SELECT i.id AS item_id, i.place_id, i.category_id, i.quantity AS expected, count(s.id) AS actual
+        FROM {item} i
+            JOIN {serial} s ON s.item_id = i.id
+        WHERE {{scope}}
+        GROUP BY i.id
+        HAVING count(s.id) > i.quantity
+    """),
+    ('orphan_reserved', """
+        SELECT i.id AS item_id, i.place_id, i.category_id, i.reserved_by_id AS expected, t.id AS actual
+        FROM {item} i
+            LEFT JOIN {trans_item} ti ON ti.id = i.reserved_by_id
+            LEFT JOIN {trans} t ON t.id = ti.transaction_id
+        WHERE i.is_reserved AND i.quantity > 0 AND (t.id IS NULL OR t.is_completed) AND {{scope}}
+    """),
+    ('negative_quantity', """
+        SELECT i.id AS item_id, i.place_id, i.category_id, 0 AS expected, i.quantity AS actual
+        FROM {item} i
+        WHERE i.quantity < 0 AND {{scope}}
+    """),
+])
+CHECKS = OrderedDict((name, sql.format(
+    item=Item._meta.db_table, chunk=ItemChunk._meta.db_table, serial=ItemSerial._meta.db_table,
+    trans_item=TransactionItem._meta.db_table, trans=Transaction._meta.db_table,
+)) for name, sql in CHECKS.items())
+
+# Items of places and categories moved by transactions completed since watermark. Ledger is partitioned
+# by completed_at, so only recent partitions are scanned.
+INCREMENTAL_SCOPE = """
+    (i.place_id, i.category_id) IN (
+        SELECT place_id, category_id FROM {ledger} WHERE completed_at >= %s
+    )
+""".format(ledger=MovementLedger._meta.db_table)
+
+
+def run_check(name, since=None, limit=None):
+    """
+    :param name: key of CHECKS
+    :param since: if set - only items of places and categories moved since this time are checked
+    :type since: datetime.datetime
+    :param limit: max count (> 0) of returned violations, total count is returned anyway
+    :return: total count of violations and list of Violation
+    :rtype: tuple
+    """
+    scope, params = ("TRUE", []) if since is None else (INCREMENTAL_SCOPE, [since])
+    sql = "SELECT v.*, count(*) OVER () FROM ({check}) v ORDER BY v.item_id".format(
+        check=CHECKS[name].format(scope=scope))
+    if limit is not None:
+        sql += " LIMIT %s"
+        params.append(limit)
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+    total = rows[0][-1] if rows else 0
+    return total, [Violation(*row[:-1]) for row in rows]
+
+
+def audit(checks=None, since=None, limit=None):
+    """
+    Runs consistency checks of stock. Replaces replay and check_item_chunk_consistency helpers, which re-completed
+    whole history and compared items in python.
+    Incremental mode does not see items changed w/o transactions (by admin forms or fixes), full mode does.
+    :param checks: names of CHECKS to run, all by default
+    :param since: watermark of previous audit: only items moved since are checked
+    :type since: datetime.datetime
+    :param limit: max count of reported violations per check, settings.APP_AUDIT_LIMIT by default
+    :return: json serializable report with watermark for next incremental audit
+    :rtype: dict
+    """
+    if limit is None:
+        limit = settings.APP_AUDIT_LIMIT
+    # transactions committed during audit may have completed_at a bit earlier than audit start
+    watermark = timezone.now() - timedelta(seconds=settings.APP_AUDIT_WATERMARK_OVERLAP)
+    report = OrderedDict([
+        ("since", since.isoformat() if since else None),
+        ("watermark", watermark.isoformat()),
+        ("violations", 0),
+        ("checks", OrderedDict()),
+    ])
+    for name in checks or CHECKS.keys():
+        started = time.time()
+        total, violations = run_check(name, since=since, limit=limit)
+        report["violations"] += total
+        report["checks"][name] = OrderedDict([
+            ("violations", total),
+            ("seconds", round(time.time() - started, 3)),
+            ("items", [OrderedDict((field, str(value) if isinstance(value, Decimal) else value)
+                                   for field, value in v._asdict().items()) for v in violations]),
+        ])
+    return report
@@ -4,45 +4,25 @@ from __future__ import print_function, division, unicode_literals, absolute_impo
 import autocomplete_light
 from decimal import Decimal, InvalidOperation
 
+from django.db.models import Case, When, Value, IntegerField
+
 from .models import Place, ItemCategory, Item, ItemSerial, ItemChunk, Cell, Purchase, PurchaseItem
+from .search import search
+from .serials import prefix_search
 
 
 ###################################################################################
 ###################################################################################
 
 
-def addslashes(value):
-    """
-    Adds slashes before quotes. Useful for escaping strings in CSV, for
-    example. Less useful for escaping JavaScript; use the ``escapejs``
-    filter instead.
-    """
-    return value.replace('\\', '\\\\').replace('"', '\\"').replace("'", "\\'")
-
-
 class ItemCategoryAutocomplete(autocomplete_light.AutocompleteModelBase):
 
     def choices_for_request(self):
-        q = addslashes(self.request.GET.get('q', ''))
+        q = self.request.GET.get('q', '')
         all_nodes = int(self.request.GET.get('all_nodes', "0"))
         source_id = self.request.GET.get('source_id', None)
 
-        _choices = ItemCategory.objects.filter(name__icontains=q)
-
-        if not _choices.count():
-            choices = ItemCategory.objects.filter(name__similar=q).extra(
-                select={'distance': "similarity(base_itemcategory.name, '%s')" % q}                
-            ).order_by('-distance')
-        else:
-            choices = _choices
-
-        if not all_nodes:
-            choices = choices.filter(children__isnull=True)
-
-        if source_id:
-            choices = choices.filter(items__place_id=source_id)
-
-        return self.order_choices(choices)[0:self.limit_choices]
+        return search(ItemCategory, q, self.limit_choices, leaf_only=not all_nodes, source_id=source_id)
 
 
 autocomplete_light.register(ItemCategory, ItemCategoryAutocomplete, attrs={
@@ -80,15 +60,10 @@ class ItemSerialAutocomplete(autocomplete_light.AutocompleteModelBase):
         source_id = self.request.GET.get('source_id', None)
         category_id = self.request.GET.get('category_id', None)
 
-        choices = ItemSerial.objects.filter(serial__icontains=q)
+        refs = prefix_search(q, self.limit_choices, place_id=source_id, category_id=category_id)
+        serials = ItemSerial.objects.in_bulk([ref.serial_id for ref in refs])
 
-        if source_id:
-            choices = choices.filter(item__place_id=source_id)
-
-        if category_id:
-            choices = choices.filter(item__category_id=category_id)
-
-        return self.order_choices(choices)[0:self.limit_choices]
+        return [serials[ref.serial_id] for ref in refs if ref.serial_id in serials]
 
 
 autocomplete_light.register(ItemSerial, ItemSerialAutocomplete,attrs={
@@ -140,31 +115,8 @@ class SubPlaceAutocomplete(autocomplete_light.AutocompleteModelBase):
     def choices_for_request(self):
         q = self.request.GET.get('q', '')
         place_id = self.request.GET.get('place_id', None)
-        choices = []
-
-        if place_id:
-            try:
-                place = Place.objects.get(pk=place_id)
-            except Place.DoesNotExist:
-                pass
-            else:
-                choices = place.get_descendants(include_self=True)
-
-        if not choices:
-            choices = Place.objects.all()
 
-        _choices = choices.filter(name__icontains=q)
-
-        if not _choices.count():
-
-            choices = choices.filter(name__similar=q).extra(
-                select={'distance': "similarity(base_place.name, '%s')" % q}
-            ).order_by('-distance')
-
-        else:
-            choices = _choices
-
-        return self.order_choices(choices)[0:self.limit_choices]
+        return search(Place, q, self.limit_choices, within=place_id)
 
 
 autocomplete_light.register(Place, SubPlaceAutocomplete, attrs={
@@ -182,9 +134,7 @@ class CellAutocomplete(autocomplete_light.AutocompleteModelBase):
     def choices_for_request(self):
         q = self.request.GET.get('q', '')
 
-        choices = Cell.objects.filter(name__icontains=q)
-
-        return self.order_choices(choices)[0:self.limit_choices]
+        return search(Cell, q, self.limit_choices, trigram=False)
 
 
 autocomplete_light.register(Cell, CellAutocomplete, attrs={
@@ -207,19 +157,17 @@ class ItemAutocomplete(autocomplete_light.AutocompleteModelBase):
         if " - " in q:
             q, place = q.split(" - ")
 
-        _choices = Item.objects.filter(category__name__icontains=q)
-
-        if not _choices.count():
-            choices = Item.objects.filter(category__name__similar=q).extra(
-                select={'distance': "similarity(base_itemcategory.name, '%s')" % q}
-            ).order_by('-distance')
-        else:
-            choices = _choices
+        # place filter is applied to categories search too, before its limit
+        categories = [c.pk for c in search(ItemCategory, q, self.limit_choices, place_name=place)]
+        choices = Item.objects.filter(category_id__in=categories).select_related('category', 'place').annotate(
+            search_order=Case(*[When(category_id=pk, then=Value(i)) for i, pk in enumerate(categories)],
+                              output_field=IntegerField())
+        ).order_by('search_order', 'pk')
 
         if place:
             choices = choices.filter(place__name__icontains=place)
 
-        return self.order_choices(choices)[0:self.limit_choices]
+        return choices[0:self.limit_choices]
 
 
 autocomplete_light.register(Item, ItemAutocomplete, attrs={
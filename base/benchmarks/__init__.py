@@ -0,0 +1,118 @@
+# -*- encoding: utf-8 -*-
+"""
+Benchmarks of inventory engine against local database, see `manage.py benchmark`.
+
+Scenario is a function registered by @scenario(name), which gets Fixture and size n, prepares data and returns
+callable to measure. Queries count, wall time and peak python memory of the callable are measured. Every scenario
+runs in savepoint which is rolled back, so scenarios don't affect each other and results are repeatable.
+"""
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+import subprocess
+import time
+from collections import OrderedDict
+
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+SCENARIOS = OrderedDict()
+
+
+def scenario(name):
+    """
+    Registers benchmark scenario: function(fixture, n) returning callable to measure.
+    """
+    def wrapper(func):
+        SCENARIOS[name] = func
+        return func
+    return wrapper
+
+
+class Rollback(Exception):
+    pass
+
+
+def measure(func):
+    """
+    :return: queries count, seconds and peak memory (bytes allocated by python, None w/o tracemalloc) of func call
+    :rtype: dict
+    """
+    if tracemalloc:
+        tracemalloc.start()
+    with CaptureQueriesContext(connection) as queries:
+        started = time.time()
+        func()
+        seconds = time.time() - started
+    peak = None
+    if tracemalloc:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return OrderedDict([('queries', len(queries)), ('seconds', round(seconds, 4)), ('peak_memory', peak)])
+
+
+def run_scenario(name, fixture, n):
+    """
+    Prepares and measures scenario in savepoint rolled back afterwards.
+    :rtype: dict
+    """
+    result = None
+    try:
+        with transaction.atomic():
+            result = measure(SCENARIOS[name](fixture, n))
+            raise Rollback()
+    except Rollback:
+        pass
+    return result
+
+
+def get_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD']).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(fixture, names=None, n=100):
+    """
+    :param fixture: created base.benchmarks.fixtures.Fixture
+    :param names: scenarios to run, all by default
+    :param n: size of every scenario (items, serials, places)
+    :return: json serializable report
+    :rtype: dict
+    """
+    from base.benchmarks import scenarios  # noqa, registers scenarios
+    results = OrderedDict()
+    for name in names or SCENARIOS.keys():
+        results[name] = run_scenario(name, fixture, n)
+    return OrderedDict([
+        ('revision', get_revision()),
+        ('created_at', timezone.now().isoformat()),
+        ('scale', fixture.scale),
+        ('n', n),
+        ('results', results),
+    ])
+
+
+def compare(old, new):
+    """
+    :param old: report of previous run
+    :param new: report of current run
+    :return: per scenario differences: queries delta and seconds ratio
+    :rtype: dict
+    """
+    diff = OrderedDict()
+    for name, result in new['results'].items():
+        before = old['results'].get(name)
+        if not before:
+            continue
+        diff[name] = OrderedDict([
+            ('queries', result['queries'] - before['queries']),
+            ('seconds', round(result['seconds'] / before['seconds'], 2) if before['seconds'] else None),
+        ])
+    return diff
@@ -0,0 +1,88 @@
+# -*- encoding: utf-8 -*-
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+from collections import OrderedDict
+
+from django.contrib.auth.models import User
+from django.db.models import Max
+
+from base.models import Unit, ItemCategory, Place, Item, ItemSerial
+from userprofile.models import Profile
+
+SCALES = OrderedDict([
+    ('tiny', {'places': 5, 'categories': 20, 'serials': 100}),
+    ('small', {'places': 100, 'categories': 1000, 'serials': 50000}),
+    ('large', {'places': 1000, 'categories': 10000, 'serials': 1000000}),
+])
+
+BATCH_SIZE = 5000
+
+
+class Fixture(object):
+    """
+    Stock of benchmark scenarios, created by bulk inserts:
+      - storage place (tree root) with `places - 1` children, every child has items of 10 categories
+      - `categories` stackable root categories of pcs unit, storage has item of each of them
+      - `serials` serials spread over items of the first 1% of categories in storage
+      - user with storage in profile, for API scenarios
+    Names are prefixed with "bench", so fixture can be created only once in database.
+    """
+
+    def __init__(self, places, categories, serials):
+        self.scale = OrderedDict([('places', places), ('categories', categories), ('serials', serials)])
+        self.unit = None
+        self.storage = None
+        self.places = []
+        self.categories = []
+        self.serial_categories = []
+        self.user = None
+
+    def create(self):
+        scale = self.scale
+        self.unit = Unit.objects.create(name="bench pcs", unit_type=Unit.INTEGER)
+
+        tree_id = (ItemCategory.objects.aggregate(tree_id=Max('tree_id'))['tree_id'] or 0) + 1
+        ItemCategory.objects.bulk_create([
+            ItemCategory(name="bench category %06d" % i, unit=self.unit, is_stackable=True, tree_id=tree_id + i,
+                         lft=1, rght=2, level=0)
+            for i in range(scale['categories'])
+        ], batch_size=BATCH_SIZE)
+        self.categories = list(ItemCategory.objects.filter(name__startswith="bench category ").order_by('name'))
+
+        self.storage = Place.objects.create(name="bench storage")
+        children = scale['places'] - 1
+        Place.objects.bulk_create([
+            Place(name="bench place %06d" % i, parent=self.storage, tree_id=self.storage.tree_id,
+                  lft=2 + i * 2, rght=3 + i * 2, level=1)
+            for i in range(children)
+        ], batch_size=BATCH_SIZE)
+        Place.objects.filter(pk=self.storage.pk).update(rght=2 + children * 2)
+        self.storage.refresh_from_db()
+        self.places = list(Place.objects.filter(parent=self.storage).order_by('name'))
+
+        serial_count = max(1, len(self.categories) // 100)
+        self.serial_categories = self.categories[:serial_count]
+        per_category = [scale['serials'] // serial_count + (1 if i < scale['serials'] % serial_count else 0)
+                        for i in range(serial_count)]
+        items = [Item(category=category, place=self.storage, quantity=per_category[i] if i < serial_count else 1000)
+                 for i, category in enumerate(self.categories)]
+        items.extend(Item(category=self.categories[(i * 10 + j) % len(self.categories)], place=place, quantity=10)
+                     for i, place in enumerate(self.places) for j in range(10))
+        Item.objects.bulk_create(items, batch_size=BATCH_SIZE)
+
+        item_ids = dict(Item.objects.filter(place=self.storage, category__in=self.serial_categories).values_list(
+            'category_id', 'id'))
+        batch = []
+        number = 0
+        for i, category in enumerate(self.serial_categories):
+            for j in range(per_category[i]):
+                batch.append(ItemSerial(item_id=item_ids[category.pk], serial="BS%08d" % number))
+                number += 1
+                if len(batch) >= BATCH_SIZE:
+                    ItemSerial.objects.bulk_create(batch)
+                    batch = []
+        ItemSerial.objects.bulk_create(batch)
+
+        self.user = User.objects.create_user("bench", password="bench")
+        Profile.objects.create(user=self.user, place=self.storage)
+        return self
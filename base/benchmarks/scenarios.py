@@ -0,0 +1,169 @@
+# -*- encoding: utf-8 -*-
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+from decimal import Decimal
+
+from django.conf import settings
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from base.api.viewsets import CategoryViewSet, PlaceViewSet, TransactionViewSet, ItemMovementViewSet
+from base.benchmarks import scenario
+from base.export import iter_items_csv
+from base.models import Item, ItemCategory, ItemSerial, Transaction, TransactionItem, Purchase, PurchaseItem, \
+    Payer, FixCategoryMerge, InvalidParameters
+from base.serialranges import parse_serials_data, SerialList
+
+
+def _storage_item(fixture, index=-1):
+    return Item.objects.get(place=fixture.storage, category=fixture.categories[index], is_reserved=False)
+
+
+@scenario('item_withdraw')
+def item_withdraw(fixture, n):
+    item = _storage_item(fixture)
+
+    def func():
+        for i in range(n):
+            item.withdraw(1)
+    return func
+
+
+def _transaction(fixture, n, serials=False):
+    t = Transaction.objects.create(source=fixture.storage, destination=fixture.places[0])
+    if serials:
+        TransactionItem.objects.bulk_create([
+            TransactionItem(transaction=t, category_id=category_id, quantity=1, serial_id=serial_id)
+            for serial_id, category_id in ItemSerial.objects.filter(item__place=fixture.storage).values_list(
+                'id', 'item__category_id').order_by('id')[:n]
+        ])
+    else:
+        TransactionItem.objects.bulk_create([
+            TransactionItem(transaction=t, category=category, quantity=1)
+            for category in fixture.categories[-n:]
+        ])
+    return t
+
+
+@scenario('transaction_complete')
+def transaction_complete(fixture, n):
+    t = _transaction(fixture, n)
+    return lambda: t.force_complete(bulk=False)
+
+
+@scenario('transaction_complete_bulk')
+def transaction_complete_bulk(fixture, n):
+    t = _transaction(fixture, n)
+    return lambda: t.force_complete(bulk=True)
+
+
+@scenario('transaction_complete_serials')
+def transaction_complete_serials(fixture, n):
+    t = _transaction(fixture, n, serials=True)
+    return lambda: t.force_complete(bulk=False)
+
+
+@scenario('transaction_complete_serials_bulk')
+def transaction_complete_serials_bulk(fixture, n):
+    t = _transaction(fixture, n, serials=True)
+    return lambda: t.force_complete(bulk=True)
+
+
+def _purchase(fixture, n, bulk):
+    shop = fixture.places[-1]
+    shop.is_shop = True
+    shop.save()
+    payer, created = Payer.objects.get_or_create(name="bench payer")
+    p = Purchase.objects.create(source=shop, destination=fixture.places[0], is_auto_source=True, payer=payer)
+    PurchaseItem.objects.create(purchase=p, category=fixture.serial_categories[0], quantity=n, price=Decimal('1'),
+                                _serials=", ".join("BP%08d" % i for i in range(n)))
+    return lambda: p.complete(bulk=bulk)
+
+
+@scenario('purchase_complete')
+def purchase_complete(fixture, n):
+    return _purchase(fixture, n, bulk=False)
+
+
+@scenario('purchase_complete_bulk')
+def purchase_complete_bulk(fixture, n):
+    return _purchase(fixture, n, bulk=True)
+
+
+@scenario('category_merge')
+def category_merge(fixture, n):
+    old = ItemCategory.objects.create(name="bench merged", unit=fixture.unit, is_stackable=True)
+    new = fixture.categories[0]
+    Item.objects.bulk_create([Item(category=old, place=place, quantity=1) for place in fixture.places[:n]])
+    merge = FixCategoryMerge(old_category=old, new_category=new, old_category_sav_id=old.pk,
+                             old_category_sav_name=old.name)
+    return merge.do_merge
+
+
+@scenario('export_items')
+def export_items(fixture, n):
+    def func():
+        for line in iter_items_csv(fixture.storage):
+            pass
+    return func
+
+
+def _serial_count(n):
+    return max(1, min(n * 1000, settings.APP_SERIALS_RANGE_LIMIT))
+
+
+def _serial_range(n):
+    """
+    Single range of n * 1000 serials, not longer than settings.APP_SERIALS_RANGE_LIMIT.
+    """
+    return "P-000001--P-%06d" % _serial_count(n)
+
+
+@scenario('serial_ranges_parse')
+def serial_ranges_parse(fixture, n):
+    text = _serial_range(n)
+    return lambda: parse_serials_data(text)
+
+
+@scenario('serial_ranges_overlap')
+def serial_ranges_overlap(fixture, n):
+    text = _serial_range(n) + ", P-%06d" % ((_serial_count(n) + 1) // 2)
+
+    def func():
+        try:
+            SerialList(text)
+        except InvalidParameters:
+            pass
+    return func
+
+
+def _api_list(fixture, viewset, **params):
+    factory = APIRequestFactory()
+    view = viewset.as_view({'get': 'list'})
+
+    def func():
+        request = factory.get('/', params)
+        force_authenticate(request, user=fixture.user)
+        view(request).render()
+    return func
+
+
+@scenario('api_category_list')
+def api_category_list(fixture, n):
+    return _api_list(fixture, CategoryViewSet)
+
+
+@scenario('api_place_list')
+def api_place_list(fixture, n):
+    return _api_list(fixture, PlaceViewSet)
+
+
+@scenario('api_transaction_list')
+def api_transaction_list(fixture, n):
+    _transaction(fixture, n).force_complete()
+    return _api_list(fixture, TransactionViewSet)
+
+
+@scenario('api_item_movement_list')
+def api_item_movement_list(fixture, n):
+    _transaction(fixture, n).force_complete()
+    return _api_list(fixture, ItemMovementViewSet)
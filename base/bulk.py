@@ -0,0 +1,665 @@
+# -*- encoding: utf-8 -*-
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+import time
+from collections import OrderedDict, defaultdict
+
+from django.apps import apps
+from django.conf import settings
+from django.db import connection, IntegrityError
+from django.db.models import Count
+from django.utils import timezone
+from django.utils.translation import ugettext_lazy as _, ugettext
+
+from base.caching import bump_version
+from base.models import Item, ItemSerial, ItemChunk, Transaction, TransactionItem, Purchase, MovementLedger, Unit, \
+    ReplayBalance, ItemNotFound, QuantityNotEnough, InvalidParameters, IncompatibleUnitException
+
+
+def update_from_values(model, rows, assignments, columns, key="id"):
+    """
+    Updates many rows with different values by single `UPDATE ... FROM (VALUES ...)` statement.
+    Values are available in assignments as v.<column>, table is available as {table}.
+    :param model: model class which table will be updated
+    :type model: django.db.models.Model
+    :param rows: list of tuples, first value of each tuple is compared with `key` column
+    :type rows: list[tuple]
+    :param assignments: SET clause of statement, ex: "quantity = {table}.quantity - v.quantity"
+    :type assignments: str
+    :param columns: names of values in rows after key value
+    :type columns: list[str]
+    :param key: column of updated table to match rows with
+    :type key: str
+    :return: count of updated rows
+    :rtype: int
+    """
+    if not rows:
+        return 0
+    table = model._meta.db_table
+    row_sql = "(%s)" % ", ".join(["%s"] * (len(columns) + 1))
+    sql = "UPDATE {table} SET {assignments} FROM (VALUES {values}) AS v(v_key, {columns}) " \
+          "WHERE {table}.{key} = v.v_key".format(
+              table=table,
+              assignments=assignments.format(table=table),
+              values=", ".join([row_sql] * len(rows)),
+              columns=", ".join(columns),
+              key=key,
+          )
+    params = [value for row in rows for value in row]
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.rowcount
+
+
+# Foreign keys which are pointed to the new row when items (PlaceMerge, FixCategoryMerge.do_merge) or categories
+# (FixCategoryMerge.do_merge) are merged, as (model name, field name). Lists are explicit: aggregates with unique
+# keys and history records must not be repointed. Every other foreign key to Item and ItemCategory has to be listed
+# in *_SKIPPED, tests fail on foreign key which is in neither list.
+ITEM_MERGE_KEYS = (
+    ('Item', 'parent'),
+    ('ItemChunk', 'item'),
+    ('ItemSerial', 'item'),
+)
+ITEM_MERGE_SKIPPED = ()
+CATEGORY_MERGE_KEYS = (
+    ('FixSerialTransform', 'category'),
+    ('ItemCategoryComment', 'category'),
+    ('MovementLedger', 'category'),
+    ('PurchaseItem', 'category'),
+    ('ReturnItem', 'category'),
+    ('TransactionItem', 'category'),
+    ('TransmutationItem', 'category'),
+    ('TransmutationItem', 'transmuted'),
+)
+CATEGORY_MERGE_SKIPPED = (
+    # merged separately, see FixCategoryMerge.merge_pairs
+    ('Item', 'category'),
+    # tree children of old category are not moved
+    ('ItemCategory', 'parent'),
+    # aggregates unique by (place, category): maintained by triggers, summed by ReplayBalance.merge
+    ('StockBalance', 'category'),
+    ('ReplayBalance', 'category'),
+    # statistics, old category rows stay as they were
+    ('LockStat', 'category'),
+    # history of merges
+    ('FixCategoryMerge', 'old_category'),
+    ('FixCategoryMerge', 'new_category'),
+)
+
+
+def merge_foreign_keys(keys, exclude=()):
+    """
+    :param keys: tuples (model name, field name) of base app, see ITEM_MERGE_KEYS
+    :param exclude: models to skip
+    :return: list of tuples (model, foreign key field)
+    :rtype: list[tuple]
+    """
+    fields = [apps.get_model('base', model_name)._meta.get_field(field_name) for model_name, field_name in keys]
+    return [(field.model, field) for field in fields if field.model not in exclude]
+
+
+def reverse_foreign_keys(model, exclude=()):
+    """
+    Foreign keys of managed concrete models which point to model. Used to check merge lists, see ITEM_MERGE_KEYS.
+    :param model: referenced model
+    :param exclude: referencing models to skip
+    :return: list of tuples (referencing model, foreign key field), sorted by model and field name
+    :rtype: list[tuple]
+    """
+    keys = []
+    for rel in model._meta.get_fields(include_hidden=True):
+        if not (rel.one_to_many or rel.one_to_one) or not rel.auto_created or rel.concrete:
+            continue
+        related = rel.related_model
+        if not related._meta.managed or related._meta.proxy or related in exclude:
+            continue
+        keys.append((related, rel.field))
+    return sorted(keys, key=lambda key: (key[0].__name__, key[1].name))
+
+
+class BulkComplete(object):
+    """
+    Set-based replacement for Transaction.prepare, Transaction.check_prepared and deposit loop of
+    Transaction.complete. Items are withdrawn from source and deposited into destinations with a few grouped
+    queries per category instead of several queries per TransactionItem.
+
+    Categories which need chunks or cells processing, or have ambiguous items in source place are moved by
+    Transaction.prepare_item and Transaction.deposit_item, so result is always the same as for per-item path.
+    Categories are independent from each other (Item is unique by place and category), so splitting
+    transaction by category does not change result.
+    """
+
+    def __init__(self, trans):
+        self.transaction = trans
+        self.source = trans.source
+        self.trans_items = []
+        self.reserved = {}
+
+    @staticmethod
+    def is_enabled(bulk=None):
+        """
+        Switch between bulk and per-item paths.
+        :param bulk: explicit choice. If None - settings.APP_BULK_COMPLETE is used.
+        :type bulk: bool or None
+        :rtype: bool
+        """
+        if bulk is None:
+            return getattr(settings, 'APP_BULK_COMPLETE', False)
+        return bool(bulk)
+
+    def run(self):
+        trans = self.transaction
+        trans.transaction_items.filter(destination__isnull=True).update(destination=trans.destination)
+        self.trans_items = list(trans.transaction_items.select_related(
+            'category', 'category__unit', 'serial', 'serial__cell', 'destination'
+        ).order_by('pk'))
+        if not trans.is_prepared:
+            self.prepare()
+        self.check_prepared()
+        self.deposit()
+
+    def prepare(self):
+        """
+        Bulk version of Transaction.prepare
+        :return: None
+        """
+        trans = self.transaction
+        reserved_ti_ids = set(Item.objects.filter(
+            reserved_by__in=self.trans_items
+        ).values_list('reserved_by_id', flat=True))
+        pending = [ti for ti in self.trans_items if ti.pk not in reserved_ti_ids]
+
+        by_category = OrderedDict()
+        for ti in pending:
+            by_category.setdefault(ti.category_id, []).append(ti)
+
+        source_items = defaultdict(list)
+        for item in Item.objects.filter(place=self.source, category_id__in=list(by_category.keys()),
+                                        is_reserved=False, quantity__gt=0):
+            source_items[item.category_id].append(item)
+        candidates = dict((cat_id, items[0]) for cat_id, items in source_items.items() if len(items) == 1)
+
+        item_ids = [item.pk for item in candidates.values()]
+        serial_counts = dict(ItemSerial.objects.filter(item_id__in=item_ids).values_list('item_id').annotate(
+            cnt=Count('id')))
+        chunk_counts = dict(ItemChunk.objects.filter(item_id__in=item_ids).values_list('item_id').annotate(
+            cnt=Count('id')))
+
+        bulk_categories = []
+        for cat_id, tis in by_category.items():
+            item = candidates.get(cat_id)
+            if not item:
+                continue
+            if any(ti.chunk_id for ti in tis):
+                continue
+            if self.source.has_chunks and chunk_counts.get(item.pk):
+                continue
+            bulk_categories.append(cat_id)
+
+        # per-item path for everything else: already reserved items and complex categories
+        for ti in self.trans_items:
+            if ti.pk in reserved_ti_ids or ti.category_id not in bulk_categories:
+                trans.prepare_item(ti)
+
+        bulk_tis = [ti for cat_id in bulk_categories for ti in by_category[cat_id]]
+        if not bulk_tis:
+            trans.is_prepared = True
+            return
+
+        withdrawn = self.check_withdraw(bulk_tis, candidates, serial_counts)
+
+        Item.objects.bulk_create([
+            Item(
+                category_id=ti.category_id,
+                quantity=ti.quantity,
+                is_reserved=True,
+                reserved_by_id=ti.pk,
+                parent_id=candidates[ti.category_id].pk,
+                place_id=self.source.pk,
+                purchase_id=candidates[ti.category_id].purchase_id,
+            ) for ti in bulk_tis
+        ])
+        new_items = dict(Item.objects.filter(reserved_by__in=bulk_tis).values_list('reserved_by_id', 'id'))
+
+        # serials are moved to new items and taken out from cells. See Place.withdraw
+        update_from_values(
+            ItemSerial,
+            [(ti.serial_id, new_items[ti.pk]) for ti in bulk_tis if ti.serial_id],
+            "item_id = v.item_id, cell_id = NULL",
+            ['item_id']
+        )
+        update_from_values(
+            Item,
+            list(withdrawn.items()),
+            "quantity = {table}.quantity - v.quantity",
+            ['quantity']
+        )
+
+        # Item.withdraw_any removes chunks in places without chunks
+        if not self.source.has_chunks:
+            ItemChunk.objects.filter(item_id__in=set(
+                candidates[ti.category_id].pk for ti in bulk_tis if not ti.serial_id
+            )).delete()
+
+        # TransactionItem.save fills cell_from with serial cell, non serial items always have two rows in
+        # source at this moment, so cell_from is not changed for them.
+        by_purchase = defaultdict(list)
+        by_cell = defaultdict(list)
+        for ti in bulk_tis:
+            by_purchase[candidates[ti.category_id].purchase_id].append(ti.pk)
+            if not ti.cell_from and ti.serial_id and ti.serial.cell_id:
+                by_cell[ti.serial.cell.name].append(ti.pk)
+        for purchase_id, ti_ids in by_purchase.items():
+            TransactionItem.objects.filter(pk__in=ti_ids).update(purchase_item_id=purchase_id)
+        for cell_name, ti_ids in by_cell.items():
+            TransactionItem.objects.filter(pk__in=ti_ids).update(cell_from=cell_name)
+
+        trans.is_prepared = True
+
+    def check_withdraw(self, trans_items, source_items, serial_counts):
+        """
+        Replays Place.withdraw and Item.withdraw checks in memory, in the same order as per-item path does.
+        Raises the same exceptions.
+        :return: withdrawn quantity for each source item id
+        :rtype: dict
+        """
+        quantity = dict((item.pk, item.quantity) for item in source_items.values())
+        serials = dict((item.pk, serial_counts.get(item.pk, 0)) for item in source_items.values())
+        withdrawn = OrderedDict()
+        for ti in trans_items:
+            item = source_items[ti.category_id]
+            if quantity[item.pk] <= 0:
+                raise ItemNotFound(_("Can not withdraw <{item}> from <{place}>: not found.".format(
+                    item=ti,
+                    place=self.source
+                )))
+            if ti.serial_id:
+                if not ti.quantity == 1:
+                    raise InvalidParameters(
+                        _("Can not withdraw <{item}> from <{place}>: quantity >1 for serial <{serial}> ".format(
+                            item=ti,
+                            place=self.source,
+                            serial=None
+                        )))
+                if not ti.serial.item_id == item.pk:
+                    raise ItemNotFound(_("Can not withdraw <{item}> from <{place}>: serial <{serial}> not found".format(
+                        item=ti,
+                        place=self.source,
+                        serial=None
+                    )))
+            if ti.category.unit.unit_type == Unit.INTEGER:
+                if not int(ti.quantity) == ti.quantity:
+                    raise IncompatibleUnitException(_("Unit {unit} can not have value {quantity}".format(
+                        unit=ti.category.unit.name,
+                        quantity=ti.quantity)
+                    ))
+            if ti.quantity > quantity[item.pk]:
+                raise QuantityNotEnough(_("Requested quantity more than available"))
+            if ti.serial_id:
+                serials[item.pk] -= 1
+            elif quantity[item.pk] - serials[item.pk] < ti.quantity:
+                raise InvalidParameters(_("please provide serial to withdraw"))
+            quantity[item.pk] -= ti.quantity
+            withdrawn[item.pk] = withdrawn.get(item.pk, 0) + ti.quantity
+        return withdrawn
+
+    def check_prepared(self):
+        """
+        Bulk version of Transaction.check_prepared
+        :return: None
+        """
+        trans = self.transaction
+        items = defaultdict(list)
+        for item in Item.objects.filter(reserved_by__in=self.trans_items):
+            items[item.reserved_by_id].append(item)
+        trans.items_prepared = []
+        for ti in self.trans_items:
+            found = items.get(ti.pk, [])
+            if not found:
+                raise Item.DoesNotExist(ugettext("Item reserved by <%s> not found") % ti.pk)
+            if len(found) > 1:
+                raise Item.MultipleObjectsReturned(ugettext("Many items reserved by <%s>") % ti.pk)
+            item = found[0]
+            assert item.quantity == ti.quantity, ti.quantity
+            assert item.category_id == ti.category_id, ti.category
+            assert item.place_id == trans.source_id, trans.source
+            item.reserved_by = ti
+            self.reserved[ti.pk] = item
+            trans.items_prepared.append(item)
+
+    def deposit(self):
+        """
+        Bulk version of deposit loop in Transaction.complete.
+        :return: None
+        """
+        trans = self.transaction
+        for destination in dict((ti.destination_id, ti.destination) for ti in self.trans_items).values():
+            assert destination.is_descendant_of(trans.destination, include_self=True), ugettext(
+                "<{ti_dest}> must be child node of <{dest}>".format(
+                    ti_dest=destination.name,
+                    dest=trans.destination.name
+                )
+            )
+
+        chunked = set(ItemChunk.objects.filter(
+            item_id__in=[item.pk for item in self.reserved.values()]
+        ).values_list('item_id', flat=True))
+
+        groups = OrderedDict()
+        for ti in self.trans_items:
+            groups.setdefault((ti.destination_id, ti.category_id), []).append(ti)
+
+        existing = defaultdict(list)
+        for item in Item.objects.filter(place_id__in=set(key[0] for key in groups),
+                                        category_id__in=set(key[1] for key in groups),
+                                        is_reserved=False):
+            existing[(item.place_id, item.category_id)].append(item)
+
+        fallback = set()
+        for (destination_id, category_id), tis in groups.items():
+            if not tis[0].category.is_stackable or len(existing[(destination_id, category_id)]) > 1:
+                fallback.add(category_id)
+            for ti in tis:
+                if self.reserved[ti.pk].pk in chunked or (ti.destination.has_cells and ti.cell):
+                    fallback.add(category_id)
+
+        increments = OrderedDict()
+        promoted = []
+        serial_moves = []
+        dropped = []
+        strip_chunks = []
+        for (destination_id, category_id), tis in groups.items():
+            if category_id in fallback:
+                continue
+            destination = tis[0].destination
+            if existing[(destination_id, category_id)]:
+                target = existing[(destination_id, category_id)][0].pk
+                merged = tis
+                if not destination.has_chunks:
+                    strip_chunks.append(target)
+            else:
+                target = self.reserved[tis[0].pk].pk
+                promoted.append((target, destination_id))
+                merged = tis[1:]
+            for ti in merged:
+                item = self.reserved[ti.pk]
+                increments[target] = increments.get(target, 0) + item.quantity
+                serial_moves.append((item.pk, target))
+                dropped.append(item.pk)
+
+        update_from_values(ItemSerial, serial_moves, "item_id = v.item_id", ['item_id'], key='item_id')
+        update_from_values(Item, list(increments.items()), "quantity = {table}.quantity + v.quantity", ['quantity'])
+        update_from_values(
+            Item,
+            promoted,
+            "place_id = v.place_id, is_reserved = false, reserved_by_id = NULL, parent_id = NULL, cell_id = NULL",
+            ['place_id']
+        )
+        if strip_chunks:
+            ItemChunk.objects.filter(item_id__in=strip_chunks).delete()
+        if dropped:
+            Item.objects.filter(pk__in=dropped).delete()
+
+        for ti in self.trans_items:
+            if ti.category_id in fallback:
+                trans.deposit_item(self.reserved[ti.pk])
+
+
+class BulkPurchase(object):
+    """
+    Set-based replacement for Purchase.prepare_items_auto and serials loop of Purchase.complete. Items, serials and
+    per serial transaction items are created by bulk inserts, duplicate serials are found by single query before
+    insert, and created transaction is completed by BulkComplete. Used for auto source purchases only.
+    """
+
+    def __init__(self, purchase):
+        self.purchase = purchase
+        self.purchase_items = []
+        self.items = {}
+
+    def run(self):
+        self.purchase_items = list(self.purchase.purchase_items.select_related(
+            'category', 'category__unit'
+        ).order_by('pk'))
+        self.prepare()
+        trans = self.create_transaction()
+        trans.is_negotiated_source = True
+        trans.is_negotiated_destination = True
+        trans.is_confirmed_source = True
+        trans.is_confirmed_destination = True
+        trans.complete(bulk=True)
+
+    def prepare(self):
+        """
+        Bulk version of Purchase.prepare_items_auto
+        :return: None
+        """
+        purchase = self.purchase
+        purchase.items_prepared = []
+        purchase.is_prepared = False
+        Item.objects.filter(purchase__in=self.purchase_items).delete()
+        new_items = []
+        for pi in self.purchase_items:
+            item = Item(category=pi.category, place_id=purchase.source_id, purchase_id=pi.pk, quantity=pi.quantity)
+            # same validation as Item.save, bulk_create skips it. Related rows are loaded already, their
+            # existence checks (query per field) are skipped
+            item.full_clean(exclude=['category', 'place', 'purchase'])
+            new_items.append(item)
+        Item.objects.bulk_create(new_items)
+        self.items = dict((item.purchase_id, item) for item in Item.objects.filter(
+            purchase__in=self.purchase_items
+        ).select_related('category', 'place'))
+
+        serials = [(serial, pi) for pi in self.purchase_items for serial in sorted(pi.serials)]
+        self.check_serials(serials)
+        ItemSerial.objects.bulk_create([
+            ItemSerial(item_id=self.items[pi.pk].pk, serial=serial, purchase_id=pi.pk) for serial, pi in serials
+        ], batch_size=1000)
+        if serials:
+            bump_version(ItemSerial)
+
+        purchase.items_prepared = [self.items[pi.pk] for pi in self.purchase_items]
+        purchase.is_prepared = True
+        purchase.save()
+
+    def check_serials(self, serials):
+        """
+        Finds first serial which can not be inserted, in the same order as per-item path inserts them, and raises
+        the same IntegrityError, without savepoint per serial.
+        :param serials: list of tuples (serial, purchase item)
+        :type serials: list[tuple]
+        :return: None
+        """
+        existing = dict((item_serial.serial, item_serial.item) for item_serial in ItemSerial.objects.filter(
+            serial__in=[serial for serial, pi in serials]
+        ).select_related('item__category', 'item__place'))
+        for serial, pi in serials:
+            item = existing.get(serial)
+            if item is not None:
+                raise IntegrityError("serial %s duplicate. item <%s> place <%s> pk <%s>" % (
+                    serial,
+                    item.__str__(),
+                    item.place.__str__() if item.place else None,
+                    item.pk
+                ))
+            existing[serial] = self.items[pi.pk]
+
+    def create_transaction(self):
+        """
+        Creates transaction from purchase source to destination: one TransactionItem reserving prepared item
+        for every purchase item without serials, and bulk inserted TransactionItem for every serial.
+        :rtype: base.models.Transaction
+        """
+        purchase = self.purchase
+        trans = Transaction.objects.create(source=purchase.source, destination=purchase.destination)
+        serial_ids = dict(ItemSerial.objects.filter(
+            purchase__in=self.purchase_items
+        ).values_list('serial', 'id'))
+        reserved = []
+        serial_items = []
+        for pi in self.purchase_items:
+            if not pi.serials:
+                ti = TransactionItem.objects.create(purchase=purchase, transaction=trans, category=pi.category,
+                                                    quantity=pi.quantity, serial=None, cell=pi.cell,
+                                                    destination=purchase.destination)
+                reserved.append((self.items[pi.pk].pk, ti.pk))
+            else:
+                serial_items.extend(TransactionItem(purchase=purchase, transaction=trans, category=pi.category,
+                                                    quantity=1, serial_id=serial_ids[serial], cell=pi.cell)
+                                    for serial in pi.serials)
+        TransactionItem.objects.bulk_create(serial_items, batch_size=1000)
+        update_from_values(Item, reserved, "is_reserved = true, reserved_by_id = v.reserved_by_id",
+                           ['reserved_by_id'])
+        trans.is_prepared = not serial_items
+        return trans
+
+
+class PlaceMerge(object):
+    """
+    Set-based replacement for Place.join_to: all stock of source place is moved into destination place.
+      - one audit transaction with TransactionItem per serial and per non serial rest of every item is recorded
+        as completed, so movement history shows what was moved
+      - stock is moved by grouped statements: item is merged into the only free item of the same category
+        in destination, or just gets destination place.
+        Non stackable categories and places with chunks are moved by Place.deposit one by one.
+      - history of source place (transactions, purchases) is pointed to destination, except audit transaction
+    """
+
+    def __init__(self, source, destination, progress=None):
+        self.source = source
+        self.destination = destination
+        self.progress = progress
+        self.counts = OrderedDict()
+        self.timings = OrderedDict()
+        self.transaction = None
+        self.items = []
+
+    def step(self, number, name, func):
+        if self.progress:
+            self.progress(number, 4, name)
+        started = time.time()
+        func()
+        self.timings[name] = round(time.time() - started, 3)
+
+    def run(self):
+        """
+        :return: log with counts of affected rows and seconds spent by every step
+        :rtype: dict
+        """
+        self.step(0, "audit", self.create_transaction)
+        self.step(1, "stock", self.move_stock)
+        self.step(2, "complete", self.complete_transaction)
+        self.step(3, "history", self.move_history)
+        return OrderedDict([
+            ("source", {"id": self.source.pk, "name": self.source.name}),
+            ("destination", {"id": self.destination.pk, "name": self.destination.name}),
+            ("transaction", self.transaction.pk),
+            ("counts", self.counts),
+            ("timings", self.timings),
+        ])
+
+    def create_transaction(self):
+        source = self.source
+        trans = Transaction.objects.create(source=source, destination=self.destination)
+        self.items = list(source.items.filter(quantity__gt=0, is_reserved=False).select_related(
+            'category', 'category__unit'
+        ).order_by('pk'))
+        serials = defaultdict(list)
+        for item_id, serial_id in ItemSerial.objects.filter(item__in=self.items).values_list('item_id', 'id'):
+            serials[item_id].append(serial_id)
+        trans_items = []
+        for item in self.items:
+            fields = dict(transaction=trans, category=item.category, destination=self.destination,
+                          purchase_item_id=item.purchase_id)
+            trans_items.extend(TransactionItem(quantity=1, serial_id=serial_id, **fields)
+                               for serial_id in serials[item.pk])
+            rest = item.quantity - len(serials[item.pk])
+            if rest > 0:
+                trans_items.append(TransactionItem(quantity=rest, **fields))
+        TransactionItem.objects.bulk_create(trans_items, batch_size=1000)
+        self.transaction = trans
+        self.counts["TransactionItem"] = len(trans_items)
+
+    def move_stock(self):
+        source, destination = self.source, self.destination
+        simple = not source.has_chunks and not destination.has_chunks
+        targets = defaultdict(list)
+        for item in Item.objects.filter(place=destination, is_reserved=False,
+                                        category_id__in=set(item.category_id for item in self.items)):
+            targets[item.category_id].append(item.pk)
+
+        fallback = []
+        moves = []
+        merges = OrderedDict()
+        increments = OrderedDict()
+        for item in self.items:
+            if not simple or not item.category.is_stackable or len(targets[item.category_id]) > 1:
+                fallback.append(item)
+            elif targets[item.category_id]:
+                target = targets[item.category_id][0]
+                merges[item.pk] = target
+                increments[target] = increments.get(target, 0) + item.quantity
+            else:
+                moves.append((item.pk, destination.pk))
+                targets[item.category_id].append(item.pk)
+
+        # serials are taken out from cells of source place, see Place.withdraw
+        self.counts["ItemSerial.cell"] = ItemSerial.objects.filter(item__in=self.items).exclude(
+            cell=None).update(cell=None)
+        self.counts["Item.moved"] = update_from_values(
+            Item, moves, "place_id = v.place_id, parent_id = NULL, cell_id = NULL", ['place_id']
+        )
+        self.counts["Item.quantity"] = update_from_values(
+            Item, list(increments.items()), "quantity = {table}.quantity + v.quantity", ['quantity']
+        )
+        merged = list(merges.items())
+        ItemChunk.objects.filter(item_id__in=list(merges.keys())).delete()
+        for model, field in merge_foreign_keys(ITEM_MERGE_KEYS, exclude=(ItemChunk,)):
+            self.counts["%s.%s" % (model.__name__, field.name)] = update_from_values(
+                model, merged, "%s = v.new_item_id" % field.column, ['new_item_id'], key=field.column
+            )
+        if merged:
+            with connection.cursor() as cursor:
+                cursor.execute("DELETE FROM {table} WHERE id = ANY(%s)".format(table=Item._meta.db_table),
+                               [list(merges.keys())])
+        self.counts["Item.merged"] = len(merged)
+
+        for item in fallback:
+            destination.deposit(item)
+        self.counts["Item.deposited"] = len(fallback)
+
+        # reserved items follow transactions, which source is pointed to destination
+        self.counts["Item.reserved"] = Item.objects.filter(place=source, is_reserved=True).update(place=destination)
+
+    def complete_transaction(self):
+        """
+        Completes audit transaction without moving items, see Transaction.complete
+        """
+        trans = self.transaction
+        trans.is_prepared = True
+        trans.is_negotiated_source = True
+        trans.is_negotiated_destination = True
+        trans.is_confirmed_source = True
+        trans.is_confirmed_destination = True
+        trans.is_completed = True
+        trans.completed_at = timezone.now()
+        trans.save()
+        self.counts["MovementLedger"] = MovementLedger.record(trans)
+        from base.treecache import invalidate_transaction
+        invalidate_transaction(trans)
+
+    def move_history(self):
+        source, destination = self.source, self.destination
+        transactions = Transaction.objects.exclude(pk=self.transaction.pk)
+        self.counts["Transaction.source"] = transactions.filter(source=source).update(source=destination)
+        self.counts["Transaction.destination"] = transactions.filter(destination=source).update(
+            destination=destination)
+        self.counts["TransactionItem.destination"] = TransactionItem.objects.filter(destination=source).exclude(
+            transaction=self.transaction).update(destination=destination)
+        self.counts["Purchase.source"] = Purchase.objects.filter(source=source).update(source=destination)
+        self.counts["Purchase.destination"] = Purchase.objects.filter(destination=source).update(
+            destination=destination)
+        self.counts["ReplayBalance.place"] = ReplayBalance.merge('place', source.pk, destination.pk)
+        zero = Item.objects.filter(place=source, quantity=0)
+        self.counts["Item.zero_quantity_deleted"] = zero.count()
+        zero.delete()
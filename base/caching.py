@@ -0,0 +1,168 @@
+# -*- encoding: utf-8 -*-
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from mptt.signals import node_moved
+
+from base.models import Place, ItemCategory, Unit, Cell
+
+VERSIONED_MODELS = (Place, ItemCategory, Unit, Cell)
+
+
+def get_cache():
+    """
+    Cache of base app, settings.APP_CACHE alias. Should point to backend shared by all workers
+    (memcached, redis, database), so invalidation made by one process is seen by others.
+    """
+    return caches[settings.APP_CACHE]
+
+
+def get_timeout(timeout):
+    """
+    Timeout for entry of base app cache. Per-process backend (LocMemCache) doesn't see invalidation done by other
+    processes, so its entries live settings.APP_LOCAL_CACHE_TIMEOUT seconds at most.
+    :param timeout: seconds to keep entry in shared backend
+    :rtype: int
+    """
+    if isinstance(get_cache(), (LocMemCache, DummyCache)):
+        return min(timeout, settings.APP_LOCAL_CACHE_TIMEOUT)
+    return timeout
+
+
+def _version_key(model):
+    return "version:%s" % model._meta.model_name
+
+
+def get_versions(*models):
+    """
+    Current namespace versions of models, by single cache round trip. Missing version is started from 1.
+    :rtype: list[int]
+    """
+    cache = get_cache()
+    keys = [_version_key(model) for model in models]
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            cache.add(key, 1, None)
+            versions[key] = cache.get(key, 1)
+    return [versions[key] for key in keys]
+
+
+def bump_version(model):
+    """
+    Makes all keys built by versioned_key with this model unused. They are not deleted, but expire by timeout.
+    """
+    cache = get_cache()
+    try:
+        cache.incr(_version_key(model))
+    except ValueError:
+        cache.set(_version_key(model), 1, None)
+
+
+def versioned_key(key, *models):
+    """
+    :param key: key without versions
+    :param models: models data under the key depends on
+    :rtype: str
+    """
+    versions = get_versions(*models)
+    return "%s:%s" % (key, ".".join(str(version) for version in versions))
+
+
+def cached(key, models, func, timeout=None):
+    """
+    Value of func() stored under versioned key until one of models is changed.
+    :param models: models value depends on
+    :type models: tuple
+    :param func: callable without arguments building the value
+    """
+    cache = get_cache()
+    key = versioned_key(key, *models)
+    value = cache.get(key)
+    if value is None:
+        value = func()
+        cache.set(key, value, get_timeout(settings.APP_CACHE_TIMEOUT if timeout is None else timeout))
+    return value
+
+
+def _cached_rows(prefix, models, ids, fetch):
+    """
+    Per id cached rows: present ids are read by one get_many, missing ones are fetched by one query.
+    :param fetch: callable(list of ids) -> dict id -> row
+    :rtype: dict
+    """
+    ids = set(pk for pk in ids if pk)
+    if not ids:
+        return {}
+    cache = get_cache()
+    base = versioned_key(prefix, *models)
+    keys = dict(("%s:%s" % (base, pk), pk) for pk in ids)
+    result = dict((keys[key], value) for key, value in cache.get_many(list(keys.keys())).items())
+    missing = [pk for pk in ids if pk not in result]
+    if missing:
+        fresh = fetch(missing)
+        cache.set_many(dict(("%s:%s" % (base, pk), row) for pk, row in fresh.items()),
+                       get_timeout(settings.APP_CACHE_TIMEOUT))
+        result.update(fresh)
+    return result
+
+
+def get_unit_types():
+    """
+    :return: dict unit_id -> Unit.unit_type
+    :rtype: dict
+    """
+    return cached("unit_types", (Unit,), lambda: dict(Unit.objects.values_list('id', 'unit_type')))
+
+
+def get_unit_type(unit_id):
+    return get_unit_types().get(unit_id)
+
+
+def get_category_flags(category_ids):
+    """
+    For display and form checks: cached value may lag behind db, stock operations use Item.category_flags.
+    :return: dict category_id -> dict with keys is_stackable, unit_id, unit_type
+    :rtype: dict
+    """
+    def fetch(ids):
+        return dict((pk, {'is_stackable': is_stackable, 'unit_id': unit_id, 'unit_type': unit_type})
+                    for pk, is_stackable, unit_id, unit_type in ItemCategory.objects.filter(pk__in=ids).values_list(
+                        'id', 'is_stackable', 'unit_id', 'unit__unit_type'))
+    return _cached_rows("category_flags", (ItemCategory, Unit), category_ids, fetch)
+
+
+def get_place_flags(place_ids):
+    """
+    For display (has_cells columns of admin changelists), stock operations use Item.place_flags.
+    :return: dict place_id -> dict with keys has_chunks, has_cells
+    :rtype: dict
+    """
+    def fetch(ids):
+        return dict((pk, {'has_chunks': has_chunks, 'has_cells': has_cells})
+                    for pk, has_chunks, has_cells in Place.objects.filter(pk__in=ids).values_list(
+                        'id', 'has_chunks', 'has_cells'))
+    return _cached_rows("place_flags", (Place,), place_ids, fetch)
+
+
+def get_place_flag(place_id, flag):
+    return get_place_flags([place_id]).get(place_id, {}).get(flag)
+
+
+@receiver(post_save, sender=Place)
+@receiver(post_save, sender=ItemCategory)
+@receiver(post_save, sender=Unit)
+@receiver(post_save, sender=Cell)
+@receiver(post_delete, sender=Place)
+@receiver(post_delete, sender=ItemCategory)
+@receiver(post_delete, sender=Unit)
+@receiver(post_delete, sender=Cell)
+@receiver(node_moved, sender=Place)
+@receiver(node_moved, sender=ItemCategory)
+def model_changed(sender, **kwargs):
+    bump_version(sender)
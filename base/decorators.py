@@ -39,3 +39,19 @@ def memoize(function, limit=None):
     memoize_wrapper._memoize_origfunc = function
     memoize_wrapper.func_name = function.func_name
     return memoize_wrapper
+
+
+def depends(select_related=(), prefetch_related=(), annotate=None):
+    """
+    Declares data used by list_display callable (model method, property getter or ModelAdmin method), so it is
+    fetched for the whole changelist page at once, see base.admin.overrides.QueryPlanMixin.
+    :param select_related: lookups for QuerySet.select_related
+    :param prefetch_related: lookups or Prefetch objects for QuerySet.prefetch_related
+    :param annotate: annotations by name for QuerySet.annotate
+    """
+    def wrapper(fn):
+        fn.select_related = tuple(select_related)
+        fn.prefetch_related = tuple(prefetch_related)
+        fn.annotate = dict(annotate or {})
+        return fn
+    return wrapper
@@ -0,0 +1,136 @@
+# -*- encoding: utf-8 -*-
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+import csv
+from datetime import datetime
+
+import xlsxwriter
+from django.db import connection, transaction
+from django.template.defaultfilters import slugify
+from unidecode import unidecode
+
+from base.models import Place, Item, ItemSerial, ItemCategory, Unit
+
+EXPORT_COLUMNS = ('Місце', 'Категорія предмету', 'Кількість', 'Одиниця', 'Серійні номери')
+
+EXPORT_ITEMS_SQL = """
+    SELECT p.id, p.name, p.level, c.name, i.quantity, u.name,
+        (SELECT string_agg(s.serial, ', ' ORDER BY s.serial) FROM {serial} s WHERE s.item_id = i.id)
+    FROM {place} root
+        JOIN {place} p ON p.tree_id = root.tree_id AND p.lft BETWEEN root.lft AND root.rght
+        LEFT JOIN {item} i ON i.place_id = p.id AND i.quantity > 0
+        LEFT JOIN {category} c ON c.id = i.category_id
+        LEFT JOIN {unit} u ON u.id = c.unit_id
+    WHERE root.id = %s
+    ORDER BY p.lft, c.name, i.id
+""".format(place=Place._meta.db_table, item=Item._meta.db_table, serial=ItemSerial._meta.db_table,
+           category=ItemCategory._meta.db_table, unit=Unit._meta.db_table)
+
+
+def export_names(place):
+    """
+    :type place: Place
+    :return: worksheet name, sheet header and file name without extension
+    :rtype: tuple
+    """
+    safe_name = unidecode(place.name)[:30]
+    time_str = datetime.now().strftime("%Y-%m-%d %H:%M")
+    return safe_name, "%s -- %s" % (place.name, time_str), slugify("%s-%s" % (safe_name, time_str))
+
+
+def iter_subtree_items(place, chunk_size=2000):
+    """
+    Items with positive quantity of place subtree in tree order, read by single query through server side cursor,
+    so memory does not depend on subtree size. Place without items is yielded once with empty item columns.
+    Transaction and named cursor are opened on first iteration, not on call: generator consumed by streaming response
+    runs after view has returned and its request transaction is already closed.
+    :param place: root of places subtree
+    :type place: Place or int
+    :param chunk_size: rows fetched from server per round trip
+    :type chunk_size: int
+    :return: tuples (place_id, place_name, place_level, category_name, quantity, unit_name, serials)
+    :rtype: collections.Iterable[tuple]
+    """
+    with transaction.atomic():
+        cursor = None
+        try:
+            connection.ensure_connection()
+            cursor = connection.connection.cursor(name='base_export_items')
+            cursor.itersize = chunk_size
+            cursor.execute(EXPORT_ITEMS_SQL, [getattr(place, 'pk', place)])
+            for row in cursor:
+                yield row
+        finally:
+            if cursor is not None:
+                cursor.close()
+
+
+def write_items_xlsx(place, output, sheet_name, title):
+    """
+    Writes place subtree items to xlsx workbook in constant_memory mode: rows are flushed to temporary file as soon
+    as next row is started, so only current row is kept in memory.
+    :param place: root of places subtree
+    :type place: Place
+    :param output: file object to write workbook to
+    :param sheet_name: worksheet name, up to 31 chars without []:*?/\\
+    :param title: sheet header
+    """
+    base_level = place.level
+    book = xlsxwriter.Workbook(output, {'constant_memory': True})
+    blue_fmt = book.add_format({'bold': True, 'font_color': 'blue', 'align': 'center'})
+    bold_fmt = book.add_format({'bold': True, 'font_color': 'black', 'align': 'left'})
+    norm_fmt = book.add_format({'bold': False, 'font_color': 'black', 'align': 'left'})
+    norm_fmt.set_text_wrap()
+
+    sheet = book.add_worksheet(sheet_name)
+    sheet.merge_range('A1:E1', title, blue_fmt)
+    sheet.set_column(0, 0, 25)
+    sheet.set_column(1, 1, 50)
+    sheet.set_column(2, 2, 8)
+    sheet.set_column(3, 3, 8)
+    sheet.set_column(4, 4, 60)
+    for col, name in enumerate(EXPORT_COLUMNS):
+        sheet.write(1, col, name, bold_fmt)
+
+    row = 1
+    last_place_id = None
+    for place_id, place_name, level, category_name, quantity, unit_name, serials in iter_subtree_items(place):
+        if place_id != last_place_id:
+            last_place_id = place_id
+            row += 1
+            sheet.set_row(row, None, None, {'level': level - base_level})
+            sheet.merge_range(row, 0, row, 4, place_name, bold_fmt)
+        if category_name is None:
+            continue
+        row += 1
+        sheet.set_row(row, None, None, {'level': level - base_level + 1})
+        sheet.write(row, 0, place_name, norm_fmt)
+        sheet.write(row, 1, category_name, norm_fmt)
+        sheet.write(row, 2, quantity, norm_fmt)
+        sheet.write(row, 3, unit_name, norm_fmt)
+        sheet.write(row, 4, serials or '', norm_fmt)
+
+    book.close()
+
+
+class Echo(object):
+    """
+    File-like object which returns written value instead of buffering it, for csv.writer based streaming.
+    """
+    def write(self, value):
+        return value
+
+
+def iter_items_csv(place):
+    """
+    Place subtree items as csv lines, generated row by row for StreamingHttpResponse.
+    :param place: root of places subtree
+    :type place: Place
+    :rtype: collections.Iterable[str]
+    """
+    writer = csv.writer(Echo())
+    yield '\ufeff' + writer.writerow(EXPORT_COLUMNS)
+    for place_id, place_name, level, category_name, quantity, unit_name, serials in iter_subtree_items(place):
+        if category_name is None:
+            continue
+        yield writer.writerow((place_name, category_name, quantity, unit_name, serials or ''))
@@ -0,0 +1,134 @@
+# -*- encoding: utf-8 -*-
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+import io
+import json
+import logging
+import os
+import traceback
+import uuid
+
+from django.conf import settings
+from django.db import connections, transaction, OperationalError, InterfaceError, DEFAULT_DB_ALIAS
+from django.db.utils import load_backend
+
+from base.models import FixCategoryMerge, FixPlaceMerge, Return, Transmutation, Place, Job
+
+logger = logging.getLogger('base.jobs')
+
+# Errors which can pass on next attempt (deadlock, lost connection). Other errors fail job at once.
+RETRY_EXCEPTIONS = (OperationalError, InterfaceError)
+
+TASKS = {}
+
+
+def task(name):
+    """
+    Registers function as job task. Task is called with job params dict and progress callback
+    progress(done, total, message), and returns json serializable result.
+    """
+    def wrapper(func):
+        TASKS[name] = func
+        return func
+    return wrapper
+
+
+@task('category_merge')
+def category_merge(params, progress):
+    merge = FixCategoryMerge.objects.get(pk=params['merge_id'])
+    if merge.data:
+        return None
+    merge.do_merge(progress=progress)
+    return {'category': merge.new_category_id}
+
+
+@task('place_merge')
+def place_merge(params, progress):
+    merge = FixPlaceMerge.objects.select_related('old_place', 'new_place').get(pk=params['merge_id'])
+    if merge.data:
+        return None
+    log = merge.old_place.join_to(merge.new_place, progress=progress)
+    FixPlaceMerge.objects.filter(pk=merge.pk).update(data=json.dumps(log), transaction=log['transaction'])
+    return {'place': merge.new_place_id, 'transaction': log['transaction'], 'counts': log['counts']}
+
+
+@task('return')
+def return_items(params, progress):
+    ret = Return.objects.get(pk=params['return_id'])
+    ret.ret(progress=progress)
+    return {'transaction': ret.pk}
+
+
+@task('transmutation')
+def transmutation(params, progress):
+    t = Transmutation.objects.get(pk=params['transmutation_id'])
+    t.transmute(progress=progress)
+    return {'transaction': t.pk}
+
+
+@task('export_items')
+def export_items(params, progress):
+    from base.export import export_names, write_items_xlsx, iter_items_csv
+    place = Place.objects.get(pk=params['place_id'])
+    safe_name, title, filename = export_names(place)
+    directory = settings.APP_EXPORT_ROOT
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    progress(0, 1, title)
+    filename += '.csv' if params.get('format') == 'csv' else '.xlsx'
+    # random prefix: file is served by base.views.job_download, name must not be guessable in case of misconfiguration
+    stored = "%s-%s" % (uuid.uuid4().hex, filename)
+    if params.get('format') == 'csv':
+        with io.open(os.path.join(directory, stored), 'w', encoding='utf-8', newline='') as output:
+            for line in iter_items_csv(place):
+                output.write(line)
+    else:
+        with open(os.path.join(directory, stored), 'wb') as output:
+            write_items_xlsx(place, output, safe_name, title)
+    return {'file': stored, 'name': filename}
+
+
+class JobProgress(object):
+    """
+    Progress callback of running job. Task runs in transaction, so progress is written to job row through separate
+    autocommit connection, which is opened on first call and closed by close().
+    """
+    SQL = "UPDATE {job} SET progress = %s, message = %s WHERE id = %s".format(job=Job._meta.db_table)
+
+    def __init__(self, job):
+        """
+        :type job: Job
+        """
+        self.job = job
+        self.connection = None
+
+    def __call__(self, done, total=100, message=''):
+        self.job.set_progress(done, total, message)
+        if self.connection is None:
+            settings_dict = dict(connections[DEFAULT_DB_ALIAS].settings_dict)
+            self.connection = load_backend(settings_dict['ENGINE']).DatabaseWrapper(settings_dict, 'job_progress')
+        with self.connection.cursor() as cursor:
+            cursor.execute(self.SQL, [self.job.progress, self.job.message, self.job.pk])
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+def run_job(job):
+    """
+    Runs claimed job in transaction: operation is applied completely or not at all.
+    :type job: base.models.Job
+    """
+    progress = JobProgress(job)
+    try:
+        with transaction.atomic():
+            result = TASKS[job.name](job.get_params(), progress)
+    except Exception as e:
+        logger.exception("job %s failed", job)
+        job.fail(traceback.format_exc(), retry=isinstance(e, RETRY_EXCEPTIONS))
+    else:
+        job.finish(result)
+    finally:
+        progress.close()
@@ -0,0 +1,206 @@
+# -*- encoding: utf-8 -*-
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.signals import request_started
+from django.db import connection, transaction, OperationalError, IntegrityError, DatabaseError
+from django.dispatch import receiver
+
+from base.models import Item, LockStat
+
+logger = logging.getLogger('base.locking')
+
+LOCK_NOT_AVAILABLE = '55P03'
+DEADLOCK_DETECTED = '40P01'
+
+STATS_FIELDS = ('locks', 'wait', 'max_wait', 'retries', 'failures')
+
+# Adds counts of process to LockStat rows, inserts missing rows (no ON CONFLICT in PostgreSQL 9.4)
+STATS_FLUSH_SQL = """
+    WITH v (place_id, category_id, locks, wait, max_wait, retries, failures) AS (VALUES {values}),
+    updated AS (
+        UPDATE {table} s SET locks = s.locks + v.locks, wait = s.wait + v.wait,
+            max_wait = greatest(s.max_wait, v.max_wait), retries = s.retries + v.retries,
+            failures = s.failures + v.failures, updated_at = now()
+        FROM v
+        WHERE s.place_id = v.place_id AND s.category_id = v.category_id
+        RETURNING s.place_id, s.category_id
+    )
+    INSERT INTO {table} (place_id, category_id, locks, wait, max_wait, retries, failures, updated_at)
+    SELECT v.place_id, v.category_id, v.locks, v.wait, v.max_wait, v.retries, v.failures, now()
+    FROM v
+    WHERE NOT EXISTS (SELECT 1 FROM updated u WHERE u.place_id = v.place_id AND u.category_id = v.category_id)
+"""
+
+
+class LockStats(object):
+    """
+    Lock waits and retries of current process by (place_id, category_id). Totals are added to LockStat table at start
+    of request (or after job of worker) once in settings.APP_LOCK_STATS_FLUSH seconds, out of stock changing
+    transactions, so flush does not hold LockStat rows locked until their commit.
+    Waits longer than settings.APP_LOCK_SLOW are logged at once.
+    Statistics are shared by threads of process, they are changed and taken for flush under lock.
+    """
+
+    def __init__(self):
+        self.stats = {}
+        self.flushed_at = time.time()
+        self.lock = threading.Lock()
+
+    def record(self, keys, wait=0, retries=0, failures=0):
+        with self.lock:
+            for key in keys:
+                row = self.stats.setdefault(key, dict.fromkeys(STATS_FIELDS, 0))
+                row['locks'] += 1
+                row['wait'] += wait
+                row['max_wait'] = max(row['max_wait'], wait)
+                row['retries'] += retries
+                row['failures'] += failures
+        if wait > settings.APP_LOCK_SLOW or retries or failures:
+            logger.warning(json.dumps({'keys': keys, 'wait': round(wait, 3), 'retries': retries,
+                                       'failures': failures}))
+
+    def flush_due(self):
+        """
+        Flushes statistics if settings.APP_LOCK_STATS_FLUSH seconds passed and no transaction is open.
+        """
+        if time.time() - self.flushed_at > settings.APP_LOCK_STATS_FLUSH and not connection.in_atomic_block:
+            self.flush()
+
+    def flush(self):
+        """
+        Adds statistics of process to LockStat table. Statistics are dropped if database is not available.
+        """
+        with self.lock:
+            rows, self.stats = self.stats, {}
+            self.flushed_at = time.time()
+        if not rows:
+            return
+        sql = STATS_FLUSH_SQL.format(
+            table=LockStat._meta.db_table,
+            values=", ".join(["(%s::integer, %s::integer, %s, %s::float, %s::float, %s, %s)"] * len(rows))
+        )
+        params = [value for (place_id, category_id), row in sorted(rows.items())
+                  for value in [place_id, category_id] + [row[field] for field in STATS_FIELDS]]
+        try:
+            # concurrent flush may insert the same new row first, second attempt updates it
+            for attempt in range(2):
+                try:
+                    with transaction.atomic(), connection.cursor() as cursor:
+                        cursor.execute(sql, params)
+                    break
+                except IntegrityError:
+                    if attempt:
+                        raise
+        except DatabaseError:
+            logger.exception("lock statistics are not saved")
+
+
+stats = LockStats()
+
+
+@receiver(request_started)
+def flush_lock_stats(sender, **kwargs):
+    stats.flush_due()
+
+
+def get_lock_stats(limit=50):
+    """
+    Lock statistics of all processes, most waited (place, category) first.
+    :return: list of dicts with keys place_id, category_id and STATS_FIELDS
+    :rtype: list[dict]
+    """
+    stats.flush()
+    return list(LockStat.objects.order_by('-wait', '-retries').values('place_id', 'category_id', *STATS_FIELDS)[:limit])
+
+
+def _is_lock_error(exc):
+    return getattr(getattr(exc, '__cause__', None), 'pgcode', None) in (LOCK_NOT_AVAILABLE, DEADLOCK_DETECTED)
+
+
+held = threading.local()
+
+
+def held_pairs():
+    """
+    :return: pairs locked by enclosing hold_stock blocks of current thread
+    :rtype: frozenset
+    """
+    return getattr(held, 'pairs', frozenset())
+
+
+def lock_stock(pairs):
+    """
+    Locking protocol of stock changes. Every withdraw and deposit takes transaction level advisory lock of
+    (place_id, category_id) before reading items, so two transactions can't both find free item of category
+    (or both find none and create duplicates). Locks are taken in ascending order of pairs by single statement,
+    so transactions locking many pairs don't deadlock each other. Locks are reentrant and released at commit.
+    Pairs held by enclosing hold_stock block are skipped, so statistics count every acquisition once.
+    Lock wait is limited by settings.APP_LOCK_TIMEOUT, timed out attempt is rolled back to savepoint and retried
+    settings.APP_LOCK_RETRIES times with growing delay.
+    :param pairs: (place_id, category_id) pairs
+    :raise OperationalError: if lock is not acquired after retries
+    """
+    pairs = sorted(set((int(place_id), int(category_id)) for place_id, category_id in pairs if place_id)
+                   - held_pairs())
+    if not pairs:
+        return
+    started = time.time()
+    attempt = 0
+    while True:
+        try:
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute("SET LOCAL lock_timeout = %s", [int(settings.APP_LOCK_TIMEOUT * 1000)])
+                cursor.execute(
+                    "SELECT pg_advisory_xact_lock(p, c) FROM "
+                    "(SELECT unnest(%s::integer[]) AS p, unnest(%s::integer[]) AS c ORDER BY 1, 2) pairs",
+                    [[p for p, c in pairs], [c for p, c in pairs]]
+                )
+                cursor.execute("SET LOCAL lock_timeout = DEFAULT")
+        except OperationalError as e:
+            if not _is_lock_error(e):
+                raise
+            if attempt >= settings.APP_LOCK_RETRIES:
+                stats.record(pairs, wait=time.time() - started, retries=attempt, failures=1)
+                raise
+            attempt += 1
+            time.sleep(settings.APP_LOCK_RETRY_DELAY * attempt)
+        else:
+            stats.record(pairs, wait=time.time() - started, retries=attempt)
+            return
+
+
+@contextmanager
+def hold_stock(pairs):
+    """
+    Locks pairs by lock_stock and marks them held for the block, so lock_stock and lock_items called inside it
+    don't lock them again. Should be used inside transaction.atomic block, which keeps the locks till commit.
+    Pairs locked inside the block by other calls are not marked: their savepoint may be rolled back.
+    :param pairs: (place_id, category_id) pairs
+    """
+    pairs = set((int(place_id), int(category_id)) for place_id, category_id in pairs if place_id)
+    lock_stock(pairs)
+    outer = held_pairs()
+    held.pairs = outer | pairs
+    try:
+        yield
+    finally:
+        held.pairs = outer
+
+
+def lock_items(place_id, category_id):
+    """
+    Locks (place_id, category_id), unless held by hold_stock block, and its free items.
+    :return: not reserved items of category in place, locked FOR UPDATE, oldest first
+    :rtype: list[Item]
+    """
+    lock_stock([(place_id, category_id)])
+    return list(Item.with_flags(Item.objects.select_for_update()).filter(
+        place_id=place_id, category_id=category_id, is_reserved=False
+    ).order_by('pk'))
@@ -0,0 +1,46 @@
+# -*- encoding: utf-8 -*-
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+import io
+import json
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_datetime
+
+from base.audit import CHECKS, audit
+
+
+class Command(BaseCommand):
+    help = 'Check stock invariants (chunks, serials, reserved items, quantities) and print json report'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='append', dest='checks', choices=list(CHECKS.keys()),
+                            help='Run only this check, can be repeated')
+        parser.add_argument('--since', dest='since',
+                            help='Only items moved since this ISO datetime are checked')
+        parser.add_argument('--state', dest='state',
+                            help='Json report file: watermark of previous report is used as --since, '
+                                 'new report is written to it')
+        parser.add_argument('--limit', type=int, dest='limit', help='Max count of reported items per check')
+        parser.add_argument('--fail', action='store_true', dest='fail', default=False,
+                            help='Exit with error when violations are found')
+
+    def handle(self, *args, **options):
+        since = None
+        if options['since']:
+            since = parse_datetime(options['since'])
+            if since is None:
+                raise CommandError("invalid --since: %s" % options['since'])
+        elif options['state'] and os.path.exists(options['state']):
+            with io.open(options['state'], encoding='utf-8') as f:
+                since = parse_datetime(json.load(f)['watermark'])
+
+        report = audit(checks=options['checks'], since=since, limit=options['limit'])
+        output = json.dumps(report, indent=2)
+        if options['state']:
+            with io.open(options['state'], 'w', encoding='utf-8') as f:
+                f.write(output)
+        self.stdout.write(output)
+        if options['fail'] and report['violations']:
+            raise CommandError("%s violations found" % report['violations'])
@@ -0,0 +1,31 @@
+# -*- encoding: utf-8 -*-
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Min, Max
+
+from base.models import Transaction, MovementLedger
+
+
+class Command(BaseCommand):
+    help = 'Write movement ledger rows for completed transactions which are not in ledger yet'
+
+    def handle(self, *args, **options):
+        bounds = Transaction.objects.filter(is_completed=True).aggregate(
+            since=Min('completed_at'), until=Max('completed_at'))
+        if not bounds['since']:
+            self.stdout.write("no completed transactions")
+            return
+        since = bounds['since'].replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        total = 0
+        while since <= bounds['until']:
+            until = (since + timedelta(days=32)).replace(day=1)
+            with transaction.atomic():
+                rows = MovementLedger.backfill(since, until)
+            total += rows
+            self.stdout.write("%s: %s rows" % (since.strftime("%Y-%m"), rows))
+            since = until
+        self.stdout.write("%s rows written" % total)
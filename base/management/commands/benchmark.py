@@ -0,0 +1,51 @@
+# -*- encoding: utf-8 -*-
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+import io
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from base.benchmarks import run, compare, Rollback
+from base.benchmarks.fixtures import Fixture, SCALES
+
+
+class Command(BaseCommand):
+    help = 'Run inventory benchmarks against local database (nothing is committed) and print json report'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scale', dest='scale', default='small', choices=list(SCALES.keys()),
+                            help='Size of fixture: places, categories and serials')
+        parser.add_argument('--scenario', action='append', dest='scenarios',
+                            help='Run only this scenario, can be repeated')
+        parser.add_argument('-n', type=int, dest='n', default=100,
+                            help='Size of every scenario: items, serials or places')
+        parser.add_argument('--output', dest='output', help='Write report to this json file')
+        parser.add_argument('--compare', dest='compare', help='Report of previous run to compare with')
+
+    def handle(self, *args, **options):
+        from base.benchmarks import scenarios  # noqa, registers scenarios
+        from base.benchmarks import SCENARIOS
+        unknown = set(options['scenarios'] or []) - set(SCENARIOS.keys())
+        if unknown:
+            raise CommandError("unknown scenarios: %s" % ", ".join(sorted(unknown)))
+
+        report = None
+        try:
+            with transaction.atomic():
+                self.stderr.write("creating %s fixture" % options['scale'])
+                fixture = Fixture(**SCALES[options['scale']]).create()
+                report = run(fixture, names=options['scenarios'], n=options['n'])
+                raise Rollback()
+        except Rollback:
+            pass
+
+        if options['compare']:
+            with io.open(options['compare'], encoding='utf-8') as f:
+                report['compare'] = compare(json.load(f), report)
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with io.open(options['output'], 'w', encoding='utf-8') as f:
+                f.write(output)
+        self.stdout.write(output)
@@ -0,0 +1,20 @@
+# -*- encoding: utf-8 -*-
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+from django.core.management.base import BaseCommand
+
+from base.locking import get_lock_stats
+
+
+class Command(BaseCommand):
+    help = 'Print lock waits and retries of stock changes by place and category, most waited first'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, dest='limit', default=50, help='Max rows count')
+
+    def handle(self, *args, **options):
+        self.stdout.write("%8s %8s %8s %10s %10s %8s %8s" % (
+            "place", "category", "locks", "wait", "max_wait", "retries", "failures"))
+        for row in get_lock_stats(limit=options['limit']):
+            self.stdout.write("%(place_id)8s %(category_id)8s %(locks)8s %(wait)10.3f %(max_wait)10.3f "
+                              "%(retries)8s %(failures)8s" % row)
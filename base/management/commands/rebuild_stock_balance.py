@@ -0,0 +1,24 @@
+# -*- encoding: utf-8 -*-
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+from django.core.management.base import BaseCommand
+
+from base.models import StockBalance
+
+
+class Command(BaseCommand):
+    help = 'Reconcile stock balances table with items, serials and chunks'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true', dest='check', default=False,
+                            help='Only print mismatched balances, do not rebuild')
+
+    def handle(self, *args, **options):
+        mismatches = StockBalance.mismatches()
+        for place_id, category_id, stored, calculated in mismatches:
+            self.stdout.write("place %s category %s: stored %s calculated %s" % (
+                place_id, category_id, stored, calculated))
+        self.stdout.write("%s mismatched balances" % len(mismatches))
+        if not options['check']:
+            rows = StockBalance.rebuild()
+            self.stdout.write("%s balances rebuilt" % rows)
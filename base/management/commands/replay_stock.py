@@ -0,0 +1,37 @@
+# -*- encoding: utf-8 -*-
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_datetime
+
+from base.replay import Replay
+
+
+class Command(BaseCommand):
+    help = 'Replay completed movements in memory and compare result with items or write it to replay balances'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--until', dest='until', help='Replay movements completed until this ISO datetime')
+        parser.add_argument('--write', action='store_true', dest='write', default=False,
+                            help='Write replayed state to replay balances table instead of comparing with items')
+        parser.add_argument('--limit', type=int, dest='limit', help='Max count of reported mismatches')
+
+    def handle(self, *args, **options):
+        until = None
+        if options['until']:
+            until = parse_datetime(options['until'])
+            if until is None:
+                raise CommandError("invalid --until: %s" % options['until'])
+
+        def progress(done, total, message):
+            self.stderr.write("%s rows, %s" % (done, message))
+
+        replay = Replay().run(until=until, progress=progress)
+        if options['write']:
+            rows = replay.write()
+            self.stdout.write("%s movements (%s rows) replayed in %ss, %s balances written" % (
+                replay.movements, replay.rows, replay.seconds, rows))
+        else:
+            self.stdout.write(json.dumps(replay.diff(limit=options['limit']), indent=2))
@@ -0,0 +1,35 @@
+# -*- encoding: utf-8 -*-
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from base.jobs import run_job
+from base.locking import stats as lock_stats
+from base.models import Job
+
+
+class Command(BaseCommand):
+    help = 'Run queued background jobs (merges, returns, transmutations, exports)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', dest='once', default=False,
+                            help='Exit when queue is empty')
+        parser.add_argument('--sleep', type=float, dest='sleep', default=2.0,
+                            help='Seconds to wait before next poll of empty queue')
+
+    def handle(self, *args, **options):
+        while True:
+            close_old_connections()
+            job = Job.claim()
+            if job is None:
+                if options['once']:
+                    return
+                time.sleep(options['sleep'])
+                continue
+            self.stdout.write("%s: attempt %s" % (job, job.attempts))
+            run_job(job)
+            lock_stats.flush_due()
+            self.stdout.write("%s: %s" % (job, job.get_status_display()))
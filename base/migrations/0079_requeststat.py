@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0078_workersinstalled_workersused'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RequestStat',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('url_name', models.CharField(max_length=200, verbose_name='url name', db_index=True)),
+                ('path', models.CharField(max_length=255, verbose_name='path')),
+                ('method', models.CharField(max_length=10, verbose_name='method')),
+                ('status', models.PositiveSmallIntegerField(verbose_name='status')),
+                ('query_count', models.PositiveIntegerField(verbose_name='query count')),
+                ('query_time', models.FloatField(verbose_name='query time')),
+                ('repeated', models.PositiveIntegerField(default=0, verbose_name='max repeated query shape')),
+                ('is_over_budget', models.BooleanField(default=False, verbose_name='over budget')),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='created at', db_index=True)),
+            ],
+            options={
+                'ordering': ['-created_at'],
+                'verbose_name': 'request stat',
+                'verbose_name_plural': 'request stats',
+            },
+        ),
+    ]
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0079_requeststat'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockBalance',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('available', models.DecimalField(default=0, verbose_name='available', max_digits=12, decimal_places=3)),
+                ('reserved', models.DecimalField(default=0, verbose_name='reserved', max_digits=12, decimal_places=3)),
+                ('serial_count', models.IntegerField(default=0, verbose_name='serials count')),
+                ('chunk_total', models.DecimalField(default=0, verbose_name='chunks total', max_digits=12, decimal_places=3)),
+                ('category', models.ForeignKey(related_name='stock_balances', on_delete=django.db.models.deletion.DO_NOTHING, db_constraint=False, verbose_name='item category', to='base.ItemCategory')),
+                ('place', models.ForeignKey(related_name='stock_balances', on_delete=django.db.models.deletion.DO_NOTHING, db_constraint=False, verbose_name='place', to='base.Place')),
+            ],
+            options={
+                'verbose_name': 'stock balance',
+                'verbose_name_plural': 'stock balances',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='stockbalance',
+            unique_together=set([('place', 'category')]),
+        ),
+        migrations.RunSQL(
+            sql=[
+                """
+                CREATE OR REPLACE FUNCTION base_stockbalance_apply(p_place integer, p_category integer,
+                    d_available numeric, d_reserved numeric, d_serials integer, d_chunks numeric) RETURNS void AS $$
+                BEGIN
+                    IF p_place IS NULL OR p_category IS NULL THEN
+                        RETURN;
+                    END IF;
+                    IF d_available = 0 AND d_reserved = 0 AND d_serials = 0 AND d_chunks = 0 THEN
+                        RETURN;
+                    END IF;
+                    LOOP
+                        UPDATE base_stockbalance SET
+                            available = available + d_available,
+                            reserved = reserved + d_reserved,
+                            serial_count = serial_count + d_serials,
+                            chunk_total = chunk_total + d_chunks
+                        WHERE place_id = p_place AND category_id = p_category;
+                        IF found THEN
+                            RETURN;
+                        END IF;
+                        BEGIN
+                            INSERT INTO base_stockbalance (place_id, category_id, available, reserved, serial_count,
+                                chunk_total)
+                            VALUES (p_place, p_category, d_available, d_reserved, d_serials, d_chunks);
+                            RETURN;
+                        EXCEPTION WHEN unique_violation THEN
+                            -- row was inserted by concurrent transaction, update it
+                        END;
+                    END LOOP;
+                END;
+                $$ LANGUAGE plpgsql
+                """,
+                """
+                CREATE OR REPLACE FUNCTION base_stockbalance_item() RETURNS trigger AS $$
+                DECLARE
+                    moved boolean;
+                    n_serials integer := 0;
+                    n_chunks numeric := 0;
+                BEGIN
+                    IF TG_OP = 'INSERT' THEN
+                        -- serials and chunks of new item are counted by their own triggers
+                        PERFORM base_stockbalance_apply(NEW.place_id, NEW.category_id,
+                            CASE WHEN NEW.is_reserved THEN 0 ELSE NEW.quantity END,
+                            CASE WHEN NEW.is_reserved THEN NEW.quantity ELSE 0 END, 0, 0);
+                        RETURN NULL;
+                    END IF;
+                    IF TG_OP = 'DELETE' THEN
+                        -- serials and chunks are deleted or moved before item itself
+                        PERFORM base_stockbalance_apply(OLD.place_id, OLD.category_id,
+                            CASE WHEN OLD.is_reserved THEN 0 ELSE -OLD.quantity END,
+                            CASE WHEN OLD.is_reserved THEN -OLD.quantity ELSE 0 END, 0, 0);
+                        RETURN NULL;
+                    END IF;
+                    moved := OLD.place_id IS DISTINCT FROM NEW.place_id
+                        OR OLD.category_id IS DISTINCT FROM NEW.category_id
+                        OR OLD.is_reserved <> NEW.is_reserved;
+                    IF NOT moved THEN
+                        PERFORM base_stockbalance_apply(NEW.place_id, NEW.category_id,
+                            CASE WHEN NEW.is_reserved THEN 0 ELSE NEW.quantity - OLD.quantity END,
+                            CASE WHEN NEW.is_reserved THEN NEW.quantity - OLD.quantity ELSE 0 END, 0, 0);
+                        RETURN NULL;
+                    END IF;
+                    SELECT count(*) INTO n_serials FROM base_itemserial WHERE item_id = NEW.id;
+                    SELECT coalesce(sum(chunk), 0) INTO n_chunks FROM base_itemchunk WHERE item_id = NEW.id;
+                    PERFORM base_stockbalance_apply(OLD.place_id, OLD.category_id,
+                        CASE WHEN OLD.is_reserved THEN 0 ELSE -OLD.quantity END,
+                        CASE WHEN OLD.is_reserved THEN -OLD.quantity ELSE 0 END,
+                        CASE WHEN OLD.is_reserved THEN 0 ELSE -n_serials END,
+                        CASE WHEN OLD.is_reserved THEN 0 ELSE -n_chunks END);
+                    PERFORM base_stockbalance_apply(NEW.place_id, NEW.category_id,
+                        CASE WHEN NEW.is_reserved THEN 0 ELSE NEW.quantity END,
+                        CASE WHEN NEW.is_reserved THEN NEW.quantity ELSE 0 END,
+                        CASE WHEN NEW.is_reserved THEN 0 ELSE n_serials END,
+                        CASE WHEN NEW.is_reserved THEN 0 ELSE n_chunks END);
+                    RETURN NULL;
+                END;
+                $$ LANGUAGE plpgsql
+                """,
+                """
+                CREATE OR REPLACE FUNCTION base_stockbalance_serial() RETURNS trigger AS $$
+                DECLARE
+                    old_value integer := 0;
+                    new_value integer := 0;
+                    old_item integer;
+                    new_item integer;
+                    rec record;
+                BEGIN
+                    IF TG_OP <> 'INSERT' THEN
+                        old_item := OLD.item_id;
+                        old_value := 1;
+                    END IF;
+                    IF TG_OP <> 'DELETE' THEN
+                        new_item := NEW.item_id;
+                        new_value := 1;
+                    END IF;
+                    IF old_item IS NOT DISTINCT FROM new_item AND old_value = new_value THEN
+                        RETURN NULL;
+                    END IF;
+                    IF old_item IS NOT NULL THEN
+                        SELECT place_id, category_id, is_reserved INTO rec FROM base_item WHERE id = old_item;
+                        IF found AND NOT rec.is_reserved THEN
+                            PERFORM base_stockbalance_apply(rec.place_id, rec.category_id, 0, 0, -old_value, 0);
+                        END IF;
+                    END IF;
+                    IF new_item IS NOT NULL THEN
+                        SELECT place_id, category_id, is_reserved INTO rec FROM base_item WHERE id = new_item;
+                        IF found AND NOT rec.is_reserved THEN
+                            PERFORM base_stockbalance_apply(rec.place_id, rec.category_id, 0, 0, new_value, 0);
+                        END IF;
+                    END IF;
+                    RETURN NULL;
+                END;
+                $$ LANGUAGE plpgsql
+                """,
+                """
+                CREATE OR REPLACE FUNCTION base_stockbalance_chunk() RETURNS trigger AS $$
+                DECLARE
+                    old_value numeric := 0;
+                    new_value numeric := 0;
+                    old_item integer;
+                    new_item integer;
+                    rec record;
+                BEGIN
+                    IF TG_OP <> 'INSERT' THEN
+                        old_item := OLD.item_id;
+                        old_value := OLD.chunk;
+                    END IF;
+                    IF TG_OP <> 'DELETE' THEN
+                        new_item := NEW.item_id;
+                        new_value := NEW.chunk;
+                    END IF;
+                    IF old_item IS NOT DISTINCT FROM new_item AND old_value = new_value THEN
+                        RETURN NULL;
+                    END IF;
+                    IF old_item IS NOT NULL THEN
+                        SELECT place_id, category_id, is_reserved INTO rec FROM base_item WHERE id = old_item;
+                        IF found AND NOT rec.is_reserved THEN
+                            PERFORM base_stockbalance_apply(rec.place_id, rec.category_id, 0, 0, 0, -old_value);
+                        END IF;
+                    END IF;
+                    IF new_item IS NOT NULL THEN
+                        SELECT place_id, category_id, is_reserved INTO rec FROM base_item WHERE id = new_item;
+                        IF found AND NOT rec.is_reserved THEN
+                            PERFORM base_stockbalance_apply(rec.place_id, rec.category_id, 0, 0, 0, new_value);
+                        END IF;
+                    END IF;
+                    RETURN NULL;
+                END;
+                $$ LANGUAGE plpgsql
+                """,
+                """
+                CREATE TRIGGER base_item_stockbalance AFTER INSERT OR UPDATE OR DELETE ON base_item
+                    FOR EACH ROW EXECUTE PROCEDURE base_stockbalance_item()
+                """,
+                """
+                CREATE TRIGGER base_itemserial_stockbalance AFTER INSERT OR UPDATE OF item_id OR DELETE
+                    ON base_itemserial FOR EACH ROW EXECUTE PROCEDURE base_stockbalance_serial()
+                """,
+                """
+                CREATE TRIGGER base_itemchunk_stockbalance AFTER INSERT OR UPDATE OF item_id, chunk OR DELETE
+                    ON base_itemchunk FOR EACH ROW EXECUTE PROCEDURE base_stockbalance_chunk()
+                """,
+                """
+                INSERT INTO base_stockbalance (place_id, category_id, available, reserved, serial_count, chunk_total)
+                SELECT i.place_id, i.category_id,
+                    sum(CASE WHEN i.is_reserved THEN 0 ELSE i.quantity END),
+                    sum(CASE WHEN i.is_reserved THEN i.quantity ELSE 0 END),
+                    sum(CASE WHEN i.is_reserved THEN 0 ELSE coalesce(s.cnt, 0) END),
+                    sum(CASE WHEN i.is_reserved THEN 0 ELSE coalesce(c.total, 0) END)
+                FROM base_item i
+                    LEFT JOIN (SELECT item_id, count(*) AS cnt FROM base_itemserial GROUP BY item_id) s
+                        ON s.item_id = i.id
+                    LEFT JOIN (SELECT item_id, sum(chunk) AS total FROM base_itemchunk GROUP BY item_id) c
+                        ON c.item_id = i.id
+                WHERE i.place_id IS NOT NULL
+                GROUP BY i.place_id, i.category_id
+                """,
+            ],
+            reverse_sql="""
+                DROP TRIGGER base_item_stockbalance ON base_item;
+                DROP TRIGGER base_itemserial_stockbalance ON base_itemserial;
+                DROP TRIGGER base_itemchunk_stockbalance ON base_itemchunk;
+                DROP FUNCTION base_stockbalance_serial();
+                DROP FUNCTION base_stockbalance_chunk();
+                DROP FUNCTION base_stockbalance_item();
+                DROP FUNCTION base_stockbalance_apply(integer, integer, numeric, numeric, integer, numeric);
+            """,
+        ),
+    ]
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0080_stockbalance'),
+    ]
+
+    operations = [
+        migrations.DeleteModel(
+            name='VItemMovement',
+        ),
+        migrations.DeleteModel(
+            name='VSerialMovement',
+        ),
+        migrations.CreateModel(
+            name='MovementLedger',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('direction', models.SmallIntegerField(verbose_name='direction', choices=[(-1, 'outgoing'), (1, 'incoming')])),
+                ('source_name', models.CharField(max_length=100, verbose_name='source')),
+                ('destination_name', models.CharField(max_length=100, verbose_name='destination')),
+                ('item_category_name', models.CharField(max_length=100, verbose_name='item_category')),
+                ('serial', models.CharField(max_length=32, null=True, verbose_name='serial', blank=True)),
+                ('quantity', models.DecimalField(verbose_name='quantity', max_digits=9, decimal_places=3)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='created at')),
+                ('completed_at', models.DateTimeField(verbose_name='completed at')),
+                ('category', models.ForeignKey(on_delete=django.db.models.deletion.DO_NOTHING, db_constraint=False, verbose_name='item category', to='base.ItemCategory')),
+                ('destination', models.ForeignKey(related_name='destination_movements', on_delete=django.db.models.deletion.DO_NOTHING, db_constraint=False, verbose_name='destination', to='base.Place')),
+                ('item_serial', models.ForeignKey(on_delete=django.db.models.deletion.DO_NOTHING, db_column='serial_id', db_constraint=False, blank=True, to='base.ItemSerial', null=True, verbose_name='serial')),
+                ('place', models.ForeignKey(related_name='ledger_movements', on_delete=django.db.models.deletion.DO_NOTHING, db_constraint=False, verbose_name='place', to='base.Place')),
+                ('source', models.ForeignKey(related_name='source_movements', on_delete=django.db.models.deletion.DO_NOTHING, db_constraint=False, verbose_name='source', to='base.Place')),
+                ('transaction', models.ForeignKey(on_delete=django.db.models.deletion.DO_NOTHING, db_constraint=False, verbose_name='transaction', to='base.Transaction')),
+                ('transaction_item', models.ForeignKey(on_delete=django.db.models.deletion.DO_NOTHING, db_constraint=False, verbose_name='transaction_item', to='base.TransactionItem')),
+            ],
+            options={
+                'ordering': ['-completed_at', '-id'],
+                'verbose_name': 'movement',
+                'verbose_name_plural': 'movements',
+            },
+        ),
+        migrations.CreateModel(
+            name='ItemMovement',
+            fields=[
+            ],
+            options={
+                'verbose_name': 'item movement',
+                'proxy': True,
+                'verbose_name_plural': 'items movements',
+            },
+            bases=('base.movementledger',),
+        ),
+        migrations.CreateModel(
+            name='SerialMovement',
+            fields=[
+            ],
+            options={
+                'verbose_name': 'serial movement',
+                'proxy': True,
+                'verbose_name_plural': 'serials movements',
+            },
+            bases=('base.movementledger',),
+        ),
+        migrations.RunSQL(
+            sql=[
+                """
+                CREATE OR REPLACE FUNCTION base_movementledger_partition(ts timestamp with time zone) RETURNS text AS $$
+                DECLARE
+                    month_start timestamp := date_trunc('month', ts AT TIME ZONE 'UTC');
+                    part_name text := 'base_movementledger_' || to_char(month_start, 'YYYYMM');
+                BEGIN
+                    PERFORM pg_advisory_xact_lock(hashtext(part_name));
+                    IF NOT EXISTS (SELECT 1 FROM pg_class WHERE relname = part_name AND relkind = 'r') THEN
+                        EXECUTE format(
+                            'CREATE TABLE %I (CHECK (completed_at >= %L AND completed_at < %L)) '
+                            'INHERITS (base_movementledger)',
+                            part_name, month_start AT TIME ZONE 'UTC',
+                            (month_start + interval '1 month') AT TIME ZONE 'UTC');
+                        EXECUTE format('ALTER TABLE %I ADD PRIMARY KEY (id)', part_name);
+                        EXECUTE format('CREATE INDEX %I ON %I (place_id, completed_at)',
+                            part_name || '_place', part_name);
+                        EXECUTE format('CREATE INDEX %I ON %I (category_id, completed_at)',
+                            part_name || '_category', part_name);
+                        EXECUTE format('CREATE INDEX %I ON %I (serial_id, completed_at) WHERE serial_id IS NOT NULL',
+                            part_name || '_serial', part_name);
+                        EXECUTE format('CREATE INDEX %I ON %I (transaction_id)', part_name || '_transaction',
+                            part_name);
+                        EXECUTE format('CREATE INDEX %I ON %I (completed_at, id)', part_name || '_completed',
+                            part_name);
+                    END IF;
+                    RETURN part_name;
+                END;
+                $$ LANGUAGE plpgsql
+                """,
+                """
+                CREATE OR REPLACE FUNCTION base_movementledger_insert() RETURNS trigger AS $$
+                BEGIN
+                    EXECUTE format('INSERT INTO %I SELECT ($1).*', base_movementledger_partition(NEW.completed_at))
+                        USING NEW;
+                    RETURN NULL;
+                END;
+                $$ LANGUAGE plpgsql
+                """,
+                """
+                CREATE TRIGGER base_movementledger_insert BEFORE INSERT ON base_movementledger
+                    FOR EACH ROW EXECUTE PROCEDURE base_movementledger_insert()
+                """,
+                "DROP VIEW base_v_item_movement",
+                "DROP VIEW base_v_serial_movement",
+            ],
+            reverse_sql=[
+                "DROP TRIGGER base_movementledger_insert ON base_movementledger",
+                "DROP FUNCTION base_movementledger_insert()",
+                "DROP FUNCTION base_movementledger_partition(timestamp with time zone)",
+                """
+                CREATE OR REPLACE VIEW base_v_item_movement(
+                    item_category_name,
+                    source_name,
+                    destination_name,
+                    quantity,
+                    destination_id,
+                    source_id,
+                    transaction_item_id,
+                    category_id,
+                    transaction_id,
+                    created_at,
+                    completed_at)
+                AS
+                    SELECT base_itemcategory.name AS item_category_name,
+                        base_place1.name AS source_name,
+                        base_place.name AS destination_name,
+                        sum(base_transactionitem.quantity) AS quantity,
+                        base_transactionitem.destination_id,
+                        base_transaction.source_id,
+                        max(base_transactionitem.id) AS transaction_item_id,
+                        base_transactionitem.category_id,
+                        base_transactionitem.transaction_id,
+                        base_transaction.created_at,
+                        base_transaction.completed_at
+                    FROM base_transaction
+                        JOIN base_transactionitem ON base_transaction.id =
+                            base_transactionitem.transaction_id
+                        JOIN base_place ON base_transactionitem.destination_id = base_place.id
+                        JOIN base_place base_place1 ON base_transaction.source_id =
+                            base_place1.id
+                        JOIN base_itemcategory ON base_transactionitem.category_id =
+                            base_itemcategory.id
+                    GROUP BY base_place1.name,
+                        base_place.name,
+                        base_transactionitem.destination_id,
+                        base_transaction.source_id,
+                        base_transactionitem.category_id,
+                        base_transactionitem.transaction_id,
+                        base_transaction.created_at,
+                        base_transaction.completed_at,
+                        base_itemcategory.name
+                """,
+                """
+                CREATE OR REPLACE VIEW base_v_serial_movement AS
+                SELECT base_place1.name AS source_name,
+                    base_place.name AS destination_name,
+                    base_itemcategory.name AS item_category_name,
+                    base_transactionitem.quantity,
+                    base_transaction.destination_id,
+                    base_transaction.source_id,
+                    base_transactionitem.category_id,
+                    base_transactionitem.transaction_id,
+                    base_itemserial.serial,
+                    base_transactionitem.serial_id,
+                    base_transaction.created_at,
+                    base_transaction.completed_at,
+                    base_transactionitem.id as transaction_item_id
+                FROM base_transaction
+                    JOIN base_transactionitem ON base_transaction.id = base_transactionitem.transaction_id
+                    JOIN base_place ON base_transaction.destination_id = base_place.id
+                    JOIN base_place base_place1 ON base_transaction.source_id = base_place1.id
+                    JOIN base_itemcategory ON base_transactionitem.category_id = base_itemcategory.id
+                    JOIN base_itemserial ON base_transactionitem.serial_id = base_itemserial.id
+                """,
+            ],
+        ),
+    ]
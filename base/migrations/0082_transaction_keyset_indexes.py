@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0081_movementledger'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql=[
+                "CREATE INDEX base_transaction_source_completed_idx ON base_transaction (source_id, completed_at, id)",
+                "CREATE INDEX base_transaction_destination_completed_idx "
+                "ON base_transaction (destination_id, completed_at, id)",
+            ],
+            reverse_sql=[
+                "DROP INDEX base_transaction_destination_completed_idx",
+                "DROP INDEX base_transaction_source_completed_idx",
+            ],
+        ),
+    ]
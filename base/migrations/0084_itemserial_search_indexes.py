@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0083_job'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql=[
+                "CREATE INDEX base_itemserial_serial_upper_like_idx "
+                "ON base_itemserial (upper(serial) varchar_pattern_ops)",
+                "CREATE INDEX base_itemserial_serial_trgm_idx ON base_itemserial USING gin (serial gin_trgm_ops)",
+            ],
+            reverse_sql=[
+                "DROP INDEX base_itemserial_serial_trgm_idx",
+                "DROP INDEX base_itemserial_serial_upper_like_idx",
+            ],
+        ),
+    ]
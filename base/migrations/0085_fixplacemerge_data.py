@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0084_itemserial_search_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='fixplacemerge',
+            name='data',
+            field=models.TextField(null=True, blank=True),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0085_fixplacemerge_data'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReplayBalance',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('quantity', models.DecimalField(default=0, verbose_name='quantity', max_digits=12, decimal_places=3)),
+                ('serial_count', models.IntegerField(default=0, verbose_name='serials count')),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='created at')),
+                ('category', models.ForeignKey(related_name='replay_balances', on_delete=django.db.models.deletion.DO_NOTHING, db_constraint=False, verbose_name='item category', to='base.ItemCategory')),
+                ('place', models.ForeignKey(related_name='replay_balances', on_delete=django.db.models.deletion.DO_NOTHING, db_constraint=False, verbose_name='place', to='base.Place')),
+            ],
+            options={
+                'verbose_name': 'replayed balance',
+                'verbose_name_plural': 'replayed balances',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='replaybalance',
+            unique_together=set([('place', 'category')]),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_transaction(apps, schema_editor):
+    FixPlaceMerge = apps.get_model('base', 'FixPlaceMerge')
+    Transaction = apps.get_model('base', 'Transaction')
+    for merge in FixPlaceMerge.objects.exclude(data=None).exclude(data=''):
+        try:
+            transaction_id = json.loads(merge.data).get('transaction')
+        except (ValueError, AttributeError):
+            continue
+        if transaction_id and Transaction.objects.filter(pk=transaction_id).exists():
+            FixPlaceMerge.objects.filter(pk=merge.pk).update(transaction=transaction_id)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0086_replaybalance'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='fixplacemerge',
+            name='transaction',
+            field=models.ForeignKey(related_name='place_merges', on_delete=django.db.models.deletion.SET_NULL, blank=True, to='base.Transaction', null=True, verbose_name='audit transaction'),
+        ),
+        migrations.RunPython(fill_transaction, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0087_fixplacemerge_transaction'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LockStat',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('locks', models.IntegerField(default=0, verbose_name='locks')),
+                ('wait', models.FloatField(default=0, verbose_name='wait')),
+                ('max_wait', models.FloatField(default=0, verbose_name='max wait')),
+                ('retries', models.IntegerField(default=0, verbose_name='retries')),
+                ('failures', models.IntegerField(default=0, verbose_name='failures')),
+                ('updated_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='updated at')),
+                ('category', models.ForeignKey(related_name='lock_stats', on_delete=django.db.models.deletion.DO_NOTHING, db_constraint=False, verbose_name='item category', to='base.ItemCategory')),
+                ('place', models.ForeignKey(related_name='lock_stats', on_delete=django.db.models.deletion.DO_NOTHING, db_constraint=False, verbose_name='place', to='base.Place')),
+            ],
+            options={
+                'verbose_name': 'lock statistics',
+                'verbose_name_plural': 'lock statistics',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='lockstat',
+            unique_together=set([('place', 'category')]),
+        ),
+    ]
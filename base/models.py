@@ -1,9 +1,13 @@
 # -*- encoding: utf-8 -*-
 from __future__ import print_function, division, unicode_literals, absolute_import
 
+import json
+import os
+from collections import OrderedDict
+from datetime import timedelta
 from decimal import Decimal
 
-from django.db import models, IntegrityError
+from django.db import models, IntegrityError, connection
 from django.utils.safestring import mark_safe
 from django.utils.translation import ugettext_lazy as _, ugettext
 from django.contrib.staticfiles.templatetags.staticfiles import static
@@ -16,9 +20,8 @@ from django.conf import settings
 from filebrowser.fields import FileBrowseField
 from sorl.thumbnail import get_thumbnail
 import re
-from copy import copy
 
-from base.decorators import lazyprop
+from base.decorators import lazyprop, depends
 
 
 class Object(object):
@@ -194,6 +197,26 @@ class ItemCategory(MPTTModel):
     def autocomplete_search_fields():
         return "id__iexact", "name__icontains",
 
+    def get_stock(self, place=None):
+        """
+        Stock of this category and all its children, see base.rollup.subtree_stock
+        :param place: optional root of places subtree
+        :type place: Place or int or None
+        :return: dict with keys available, reserved, serial_count
+        :rtype: dict
+        """
+        from base.rollup import subtree_stock
+        return subtree_stock(place=place, category=self)
+
+    @property
+    def stock_summary(self):
+        """
+        Cached stock summary of this category subtree, see base.rollup.get_summary
+        :rtype: dict
+        """
+        from base.rollup import get_summary
+        return get_summary(self)
+
     @property
     def thumbnail(self):
         """
@@ -212,6 +235,15 @@ class ItemCategory(MPTTModel):
         """
         return reverse("admin:base_category_item_changelist", args=[self.pk])
 
+    @lazyprop
+    def items_count(self):
+        """
+        :return: count of items, num_items annotation of admin queryset is used if present
+        :rtype: int
+        """
+        num_items = getattr(self, 'num_items', None)
+        return self.items.count() if num_items is None else num_items
+
     def node_view_link(self):
         """
         Html code with link for base_category_item_changelist admin page
@@ -236,10 +268,11 @@ class ItemCategory(MPTTModel):
 
     @lazyprop
     def node_transfer_url(self):
-        if self.items.count():
+        if self.items_count:
             return reverse("admin:base_item_movement_filtered_changelist", args=[0, self.pk])
         return ''
 
+    @depends(annotate={'num_items': models.Count('items')})
     def node_transfer_link(self):
         if self.node_transfer_url:
             return mark_safe('<a href="%s"><img src="%s" width="11" height="10" alt="%s"></a>' % (
@@ -375,21 +408,43 @@ class Place(MPTTModel):
         """
         return reverse('admin:base_place_item_changelist', args=[self.pk])
 
+    def get_stock(self, category=None):
+        """
+        Stock stored in this place and all its children, see base.rollup.subtree_stock
+        :param category: optional root of categories subtree
+        :type category: ItemCategory or int or None
+        :return: dict with keys available, reserved, serial_count
+        :rtype: dict
+        """
+        from base.rollup import subtree_stock
+        return subtree_stock(place=self, category=category)
+
+    @property
+    def stock_summary(self):
+        """
+        Cached stock summary of this place subtree, see base.rollup.get_summary
+        :rtype: dict
+        """
+        from base.rollup import get_summary
+        return get_summary(self)
+
+    @transaction.atomic
     def deposit(self, item, cell=None):
         """
         Stores item in this place.
         If in this place exists item with the same ItemCategory - Item.deposit method will be called to join
           two items into single one.
         If in this place no item with the same ItemCategory - item.place can be safely changed into this place.
+        Category is locked in this place until commit, see base.locking.lock_stock
         :param item: Item that will be stored in this place
         :type item: Item
         :param cell: If not null - Item.cell will be set to this value.
         :type cell: str
         :return: None
         """
-        try:
-            i = self.items.get(category=item.category, is_reserved=False)
-        except Item.DoesNotExist:
+        from base.locking import lock_items
+        items = lock_items(self.pk, item.category_id)
+        if not items:
             item.place = self
             item.is_reserved = False
             item.reserved_by = None
@@ -400,28 +455,30 @@ class Place(MPTTModel):
                 if not item.chunks.count():
                     ItemChunk.objects.create(item=item, chunk=item.quantity, purchase=item.purchase, cell=cell)
         else:
-            new_item = i.deposit(item, cell=cell)
+            new_item = items[0].deposit(item, cell=cell)
 
             if not self.has_chunks:
                 new_item.chunks.all().delete()
 
+    @transaction.atomic
     def withdraw(self, item):
         """
         Removes Item from this place. Function finds Item with the same ItemCategory in this place and calls
-        Item.withdraw
+        Item.withdraw. Category is locked in this place until commit, see base.locking.lock_stock
         :param item: Item which is needed to be removed from this place
         :type item: Item
         :return: new Item.
         :rtype: Item
         """
-        try:
-            i = self.items.get(category=item.category, is_reserved=False, quantity__gt=0)
-        except Item.DoesNotExist:
+        from base.locking import lock_items
+        items = [i for i in lock_items(self.pk, item.category_id) if i.quantity > 0]
+        if not items:
             raise ItemNotFound(_("Can not withdraw <{item}> from <{place}>: not found.".format(
                 item=item,
                 place=self
             )))
         else:
+            i = items[0]
             serial = None
             if item.serial:
                 if not item.quantity == 1:
@@ -443,43 +500,44 @@ class Place(MPTTModel):
                 serial.save()
             return i.withdraw(quantity=item.quantity, serial=serial, chunk=item.chunk)
 
-    def join_to(self, place):
+    def join_to(self, place, progress=None):
         """
-        Helper function to join contents of 2 places into one. It creates transaction from this place to provided place
-        and all stored items are moved to provided place by this transaction.
+        Helper function to join contents of 2 places into one. It records completed transaction from this place to
+        provided place with all stored items, items are moved by grouped statements, see base.bulk.PlaceMerge.
         This place name will be marked with DEL prefix and can be safely deleted in future by storage manager.
         :param place:
         :type place: Place
-        :return: None
+        :param progress: callback(done, total, message), see Job.set_progress
+        :return: log of merge: counts of affected rows and seconds spent by every step
+        :rtype: dict
         """
-        t = Transaction.objects.create(source=self, destination=place)
-        for item in self.items.filter(quantity__gt=0):
-            if item.serials.count():
-                for serial in item.serials.all():
-                    TransactionItem.objects.create(transaction=t, category=item.category, quantity=1, serial=serial)
-            else:
-                TransactionItem.objects.create(transaction=t, category=item.category, quantity=item.quantity)
-        t.force_complete()
-        Transaction.objects.filter(source=self).update(source=place)
-        Transaction.objects.filter(destination=self).update(destination=place)
-        TransactionItem.objects.filter(destination=self).update(destination=place)
-        Purchase.objects.filter(source=self).update(source=place)
-        Purchase.objects.filter(destination=self).update(destination=place)
-        Item.objects.filter(place=self, quantity=0).delete()
+        from base.bulk import PlaceMerge
+        log = PlaceMerge(self, place, progress=progress).run()
         self.name = "DEL %s" % self.name
         self.save()
+        return log
 
     @staticmethod
     def autocomplete_search_fields():
         return "id__iexact", "name__icontains",
 
+    @lazyprop
+    def items_count(self):
+        """
+        :return: count of items, num_items annotation of admin queryset is used if present
+        :rtype: int
+        """
+        num_items = getattr(self, 'num_items', None)
+        return self.items.count() if num_items is None else num_items
+
     @lazyprop
     def node_view_url(self):
-        if self.items.count():
+        if self.items_count:
             return reverse("admin:base_place_item_changelist", args=[self.pk])
         else:
             return ''
 
+    @depends(annotate={'num_items': models.Count('items')})
     def node_view_link(self):
         if self.node_view_url:
             return mark_safe('<a href="%s"><img src="%s" width="16" height="8" alt="%s"></a>' % (
@@ -498,10 +556,11 @@ class Place(MPTTModel):
 
     @lazyprop
     def node_transfer_url(self):
-        if self.items.count():
+        if self.items_count:
             return reverse("admin:base_item_movement_filtered_changelist", args=[self.pk])
         return ''
 
+    @depends(annotate={'num_items': models.Count('items')})
     def node_transfer_link(self):
         if self.node_transfer_url:
             return mark_safe('<a href="%s"><img src="%s" width="11" height="10" alt="%s"></a>' % (
@@ -713,7 +772,6 @@ class Movement(models.Model):
     Abstract class for Transaction and Purchase
     Common fields and functions placed here
     """
-    items_prepared = []
     created_at = models.DateTimeField(_("created at"), default=timezone.now)
     completed_at = models.DateTimeField(_("completed at"), default=None, blank=True, null=True)
     is_completed = models.BooleanField(_("is completed"), blank=True, default=False)
@@ -722,6 +780,11 @@ class Movement(models.Model):
     class Meta:
         abstract = True
 
+    def __init__(self, *args, **kwargs):
+        super(Movement, self).__init__(*args, **kwargs)
+        # per instance, class level list would be shared by all requests of threaded worker
+        self.items_prepared = []
+
 
 class Purchase(Movement):
     """
@@ -818,7 +881,7 @@ class Purchase(Movement):
             self.prepare_items_auto()
 
     @transaction.atomic
-    def complete(self, pending=False):
+    def complete(self, pending=False, bulk=None):
         """
         Completes this Purchase. Process steps are:
           - check pending, if it's True - ignore and let PurchaseItems be saved first
@@ -827,6 +890,8 @@ class Purchase(Movement):
           - create new transaction, source is purchase source, destination is purchase destination, items ... the same
         :param pending: flag, if True then formset with PurchaseItems is not saved yet
         :type pending: bool
+        :param bulk: if True - auto source purchase is completed by base.bulk.BulkPurchase, see Transaction.complete
+        :type bulk: bool or None
         :return: None
         """
         if pending:
@@ -836,6 +901,22 @@ class Purchase(Movement):
         # print "purchase complete run"
         if self.is_completed:
             return
+        from base.bulk import BulkComplete, BulkPurchase
+        if self.is_auto_source and BulkComplete.is_enabled(bulk):
+            BulkPurchase(self).run()
+        else:
+            self.complete_items()
+
+        self.completed_at = timezone.now()
+        self.is_completed = True
+        self.save()
+        # self.fill_cells()
+
+    def complete_items(self):
+        """
+        Per item path of Purchase.complete
+        :return: None
+        """
         self.prepare()
         prepared = self.is_prepared
         t = Transaction.objects.create(source=self.source, destination=self.destination)
@@ -852,9 +933,9 @@ class Purchase(Movement):
                     item.save()
             else:
                 prepared = False
+                item = pi.item_set.get()
 
                 for serial in pi.serials:
-                    item = pi.item_set.get()
                     s, created = ItemSerial.objects.get_or_create(item=item, serial=serial)
                     s.purchase = pi
                     s.save()
@@ -868,11 +949,6 @@ class Purchase(Movement):
         t.is_confirmed_destination = True
         t.complete()
 
-        self.completed_at = timezone.now()
-        self.is_completed = True
-        self.save()
-        # self.fill_cells()
-
     def fill_cells(self):
         """
         Update Item.cell and ItemSerial.cell values if PurchaseItem.cell is set.
@@ -909,11 +985,13 @@ class Item(models.Model):
         verbose_name = _("item")
         verbose_name_plural = _("items")
 
+    @depends(select_related=('category', 'place'))
     def __str__(self):
         if self.place:
             return "%s - %s" % (self.category.name, self.place.name)
         return "%s - unknown place" % self.category.name
 
+    @depends(select_related=('category',))
     def category_name(self):
         return self.category.name
 
@@ -924,11 +1002,43 @@ class Item(models.Model):
     def unit(self):
         return self.category.unit
 
+    @property
+    def category_flags(self):
+        """
+        is_stackable, unit_id and unit_type of item category. They decide withdraw and deposit branches, so are read
+        from db rows, never from cache: values selected by Item.with_flags, otherwise category and unit of item.
+        """
+        if hasattr(self, 'flag_unit_type'):
+            return {'is_stackable': self.flag_is_stackable, 'unit_id': self.flag_unit_id,
+                    'unit_type': self.flag_unit_type}
+        return {'is_stackable': self.category.is_stackable, 'unit_id': self.category.unit_id,
+                'unit_type': self.category.unit.unit_type}
+
+    @property
+    def place_flags(self):
+        """
+        has_chunks and has_cells of item place, values selected by Item.with_flags or place of item.
+        """
+        if hasattr(self, 'flag_has_chunks'):
+            return {'has_chunks': self.flag_has_chunks, 'has_cells': self.flag_has_cells}
+        return {'has_chunks': self.place.has_chunks, 'has_cells': self.place.has_cells}
+
+    @classmethod
+    def with_flags(cls, qs):
+        """
+        Adds category, unit and place flags to item query as subqueries: select_related would lock category and
+        place rows too when query is select_for_update.
+        :type qs: django.db.models.QuerySet
+        :rtype: django.db.models.QuerySet
+        """
+        return qs.extra(select=ITEM_FLAGS_SELECT)
+
     @property
     def is_stackable(self):
-        return self.category.is_stackable
+        return self.category_flags['is_stackable']
 
     @property
+    @depends(select_related=('purchase',))
     def price(self):
         if self.purchase:
             if self.purchase.price_usd:
@@ -945,7 +1055,7 @@ class Item(models.Model):
         f = int
         # if self.category.unit.unit_type == Unit.INTEGER:
         #     f = int
-        if self.category.unit.unit_type == Unit.DECIMAL:
+        if self.category_flags['unit_type'] == Unit.DECIMAL:
             f = Decimal
 
         if self.quantity and not f(self.quantity) == self.quantity:
@@ -983,7 +1093,7 @@ class Item(models.Model):
 
         if self.quantity - self.serials.count() < quantity:
             raise InvalidParameters(_("please provide serial to withdraw"))
-        if self.place.has_chunks:
+        if self.place_flags['has_chunks']:
             if self.chunks.count() == 1:
                 return self.withdraw_chunk(quantity, self.chunks.get())
             if self.chunks.count() > 1:
@@ -1086,7 +1196,7 @@ class Item(models.Model):
         :rtype: base.models.Item()
         """
 
-        if self.unit.unit_type == Unit.INTEGER:
+        if self.category_flags['unit_type'] == Unit.INTEGER:
             if not int(quantity) == quantity:
                 raise IncompatibleUnitException(_("Unit {unit} can not have value {quantity}".format(
                     unit=self.unit.name,
@@ -1105,7 +1215,9 @@ class Item(models.Model):
         else:
             item = self.withdraw_any(quantity)
 
-        self.qs.update(quantity=models.F('quantity') - quantity)
+        # self.quantity may be stale if item was not locked (see Place.withdraw), the row is checked again
+        if not self.qs.filter(quantity__gte=quantity).update(quantity=models.F('quantity') - quantity):
+            raise QuantityNotEnough(_("Requested quantity more than available"))
         self.refresh_from_db()
 
         if False:  # temporary disable check block
@@ -1175,7 +1287,7 @@ class Item(models.Model):
         self.qs.update(quantity=models.F('quantity') + item.quantity, )
         self.refresh_from_db()
 
-        if self.place and not self.place.has_chunks:
+        if self.place_id and not self.place_flags['has_chunks']:
             item.chunks.all().delete()
         else:
             item.chunks.update(item=self)
@@ -1190,6 +1302,18 @@ class Item(models.Model):
         return self
 
 
+ITEM_FLAGS_SELECT = dict((key, sql.format(
+    item=Item._meta.db_table, category=ItemCategory._meta.db_table, unit=Unit._meta.db_table, place=Place._meta.db_table
+)) for key, sql in (
+    ('flag_is_stackable', "SELECT c.is_stackable FROM {category} c WHERE c.id = {item}.category_id"),
+    ('flag_unit_id', "SELECT c.unit_id FROM {category} c WHERE c.id = {item}.category_id"),
+    ('flag_unit_type', "SELECT u.unit_type FROM {category} c JOIN {unit} u ON u.id = c.unit_id "
+                       "WHERE c.id = {item}.category_id"),
+    ('flag_has_chunks', "SELECT p.has_chunks FROM {place} p WHERE p.id = {item}.place_id"),
+    ('flag_has_cells', "SELECT p.has_cells FROM {place} p WHERE p.id = {item}.place_id"),
+))
+
+
 class ItemSerial(models.Model):
     """
     Model for storing items serials.
@@ -1207,10 +1331,19 @@ class ItemSerial(models.Model):
     def __str__(self):
         return self.serial
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(ItemSerial, cls).from_db(db, field_names, values)
+        # serial as loaded, to tell renames from moves on save (see base.serials.serial_changed)
+        instance.loaded_serial = values[field_names.index('serial')] if 'serial' in field_names else None
+        return instance
+
+    @depends(select_related=('item__category',))
     def category_name(self):
         return self.item.category.name
 
     @property
+    @depends(select_related=('purchase',))
     def price(self):
         if self.purchase:
             if self.purchase.price_usd:
@@ -1238,12 +1371,15 @@ class ItemChunk(models.Model):
         verbose_name = _("chunk")
         verbose_name_plural = _("chunks")
 
+    @depends(select_related=('item__category__unit',))
     def __str__(self):
         return "ID_%s: %s %s%s" % (self.pk, self.chunk, self.item.unit, (" %s" % self.label) if self.label else "")
 
+    @depends(select_related=('item__category',))
     def category_name(self):
         return self.item.category.name
 
+    @depends(select_related=('item__place',))
     def place_name(self):
         return self.item.place.name
 
@@ -1252,6 +1388,170 @@ class ItemChunk(models.Model):
         return self.__class__.objects.filter(pk=self.pk)
 
 
+STOCK_BALANCE_REBUILD_SQL = """
+    SELECT i.place_id, i.category_id,
+        sum(CASE WHEN i.is_reserved THEN 0 ELSE i.quantity END) AS available,
+        sum(CASE WHEN i.is_reserved THEN i.quantity ELSE 0 END) AS reserved,
+        sum(CASE WHEN i.is_reserved THEN 0 ELSE coalesce(s.cnt, 0) END) AS serial_count,
+        sum(CASE WHEN i.is_reserved THEN 0 ELSE coalesce(c.total, 0) END) AS chunk_total
+    FROM base_item i
+        LEFT JOIN (SELECT item_id, count(*) AS cnt FROM base_itemserial GROUP BY item_id) s ON s.item_id = i.id
+        LEFT JOIN (SELECT item_id, sum(chunk) AS total FROM base_itemchunk GROUP BY item_id) c ON c.item_id = i.id
+    WHERE i.place_id IS NOT NULL
+    GROUP BY i.place_id, i.category_id
+"""
+
+
+class StockBalance(models.Model):
+    """
+    Denormalized stock of ItemCategory in Place. Rows are maintained by database triggers on base_item,
+    base_itemserial and base_itemchunk (see migration 0080_stockbalance), so every change of items is reflected
+    in the same db transaction, including bulk updates. StockBalance.rebuild reconciles table from scratch.
+     - available - sum of quantities of not reserved items
+     - reserved - sum of quantities of items reserved by not completed transactions
+     - serial_count - count of serials of not reserved items
+     - chunk_total - sum of chunks of not reserved items
+    """
+    place = models.ForeignKey("Place", verbose_name=_("place"), related_name="stock_balances",
+                              on_delete=models.DO_NOTHING, db_constraint=False)
+    category = models.ForeignKey("ItemCategory", verbose_name=_("item category"), related_name="stock_balances",
+                                 on_delete=models.DO_NOTHING, db_constraint=False)
+    available = models.DecimalField(_("available"), max_digits=12, decimal_places=3, default=0)
+    reserved = models.DecimalField(_("reserved"), max_digits=12, decimal_places=3, default=0)
+    serial_count = models.IntegerField(_("serials count"), default=0)
+    chunk_total = models.DecimalField(_("chunks total"), max_digits=12, decimal_places=3, default=0)
+
+    class Meta:
+        verbose_name = _("stock balance")
+        verbose_name_plural = _("stock balances")
+        unique_together = ('place', 'category')
+
+    def __str__(self):
+        return "%s - %s: %s" % (self.category_id, self.place_id, self.available)
+
+    @classmethod
+    def get_available(cls, place_id, category_id):
+        """
+        :return: available quantity of category in place or None if category was never stored there.
+        :rtype: Decimal or None
+        """
+        try:
+            return cls.objects.values_list('available', flat=True).get(place_id=place_id, category_id=category_id)
+        except cls.DoesNotExist:
+            return None
+
+    @classmethod
+    def mismatches(cls):
+        """
+        Compares table with balances calculated from items.
+        :return: list of tuples (place_id, category_id, stored values, calculated values)
+        :rtype: list[tuple]
+        """
+        sql = """
+            SELECT coalesce(b.place_id, r.place_id), coalesce(b.category_id, r.category_id),
+                b.available, b.reserved, b.serial_count, b.chunk_total,
+                r.available, r.reserved, r.serial_count, r.chunk_total
+            FROM {table} b FULL OUTER JOIN ({rebuild}) r ON r.place_id = b.place_id AND r.category_id = b.category_id
+            WHERE (b.available, b.reserved, b.serial_count, b.chunk_total) IS DISTINCT FROM
+                (r.available, r.reserved, r.serial_count, r.chunk_total)
+                AND NOT (r.place_id IS NULL AND b.available = 0 AND b.reserved = 0 AND b.serial_count = 0
+                         AND b.chunk_total = 0)
+        """.format(table=cls._meta.db_table, rebuild=STOCK_BALANCE_REBUILD_SQL)
+        with connection.cursor() as cursor:
+            cursor.execute(sql)
+            return [(row[0], row[1], row[2:6], row[6:10]) for row in cursor.fetchall()]
+
+    @classmethod
+    @transaction.atomic
+    def rebuild(cls):
+        """
+        Recalculates whole table from items. Items tables are locked for writing until rebuild is finished.
+        :return: count of rows in table
+        :rtype: int
+        """
+        with connection.cursor() as cursor:
+            cursor.execute("LOCK TABLE base_item, base_itemserial, base_itemchunk IN SHARE MODE")
+            cursor.execute("DELETE FROM {table}".format(table=cls._meta.db_table))
+            cursor.execute("""
+                INSERT INTO {table} (place_id, category_id, available, reserved, serial_count, chunk_total)
+                {rebuild}
+            """.format(table=cls._meta.db_table, rebuild=STOCK_BALANCE_REBUILD_SQL))
+            return cursor.rowcount
+
+
+class ReplayBalance(models.Model):
+    """
+    Stock of ItemCategory in Place rebuilt from history by base.replay.Replay.write, for comparing with
+    StockBalance by SQL (e.g. before and after migration which changes withdraw semantics).
+     - quantity - sum of quantities of items, reserved included
+     - serial_count - count of serials
+    """
+    place = models.ForeignKey("Place", verbose_name=_("place"), related_name="replay_balances",
+                              on_delete=models.DO_NOTHING, db_constraint=False)
+    category = models.ForeignKey("ItemCategory", verbose_name=_("item category"), related_name="replay_balances",
+                                 on_delete=models.DO_NOTHING, db_constraint=False)
+    quantity = models.DecimalField(_("quantity"), max_digits=12, decimal_places=3, default=0)
+    serial_count = models.IntegerField(_("serials count"), default=0)
+    created_at = models.DateTimeField(_("created at"), default=timezone.now)
+
+    class Meta:
+        verbose_name = _("replayed balance")
+        verbose_name_plural = _("replayed balances")
+        unique_together = ('place', 'category')
+
+    def __str__(self):
+        return "%s - %s: %s" % (self.category_id, self.place_id, self.quantity)
+
+    @classmethod
+    def merge(cls, field, old_id, new_id):
+        """
+        Sums balances of merged place or category into balances of new one, as replay after merge would do.
+        :param field: 'place' or 'category'
+        :return: count of merged balances
+        :rtype: int
+        """
+        other = 'category' if field == 'place' else 'place'
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                UPDATE {table} n SET quantity = n.quantity + o.quantity, serial_count = n.serial_count + o.serial_count
+                FROM {table} o
+                WHERE o.{field}_id = %s AND n.{field}_id = %s AND n.{other}_id = o.{other}_id
+            """.format(table=cls._meta.db_table, field=field, other=other), [old_id, new_id])
+            cursor.execute("""
+                DELETE FROM {table} o
+                WHERE o.{field}_id = %s AND EXISTS (
+                    SELECT 1 FROM {table} n WHERE n.{field}_id = %s AND n.{other}_id = o.{other}_id
+                )
+            """.format(table=cls._meta.db_table, field=field, other=other), [old_id, new_id])
+        return cls.objects.filter(**{"%s_id" % field: old_id}).update(**{"%s_id" % field: new_id})
+
+
+class LockStat(models.Model):
+    """
+    Lock waits and retries of stock changes by Place and ItemCategory, summed over all processes by
+    base.locking.LockStats.flush. See `manage.py lock_stats`.
+     - wait, max_wait - seconds
+    """
+    place = models.ForeignKey("Place", verbose_name=_("place"), related_name="lock_stats",
+                              on_delete=models.DO_NOTHING, db_constraint=False)
+    category = models.ForeignKey("ItemCategory", verbose_name=_("item category"), related_name="lock_stats",
+                                 on_delete=models.DO_NOTHING, db_constraint=False)
+    locks = models.IntegerField(_("locks"), default=0)
+    wait = models.FloatField(_("wait"), default=0)
+    max_wait = models.FloatField(_("max wait"), default=0)
+    retries = models.IntegerField(_("retries"), default=0)
+    failures = models.IntegerField(_("failures"), default=0)
+    updated_at = models.DateTimeField(_("updated at"), default=timezone.now)
+
+    class Meta:
+        verbose_name = _("lock statistics")
+        verbose_name_plural = _("lock statistics")
+        unique_together = ('place', 'category')
+
+    def __str__(self):
+        return "%s - %s: %s" % (self.category_id, self.place_id, self.locks)
+
+
 class TransactionItem(MovementItem):
     """
     M2M Model for Transaction and ItemCategory relations
@@ -1308,6 +1608,28 @@ class TransactionItem(MovementItem):
                     self.cell_from = item.cell
         super(TransactionItem, self).save(*args, **kwargs)
 
+    def split_by_serials(self, serials):
+        """
+        Saves copy of this (unsaved) transaction item with quantity 1 for every serial, by bulk insert.
+        Copies differ only by serial, so they are validated by single full_clean of this item.
+        :param serials: ItemSerial objects with cell selected
+        :type serials: list[ItemSerial]
+        :rtype: list[TransactionItem]
+        """
+        self.full_clean()
+        values = dict((field.attname, getattr(self, field.attname))
+                      for field in self._meta.concrete_fields if not field.primary_key)
+        items = []
+        for serial in serials:
+            item = TransactionItem(**values)
+            item.quantity = 1
+            item.serial = serial
+            if not item.cell_from and serial.cell_id:
+                item.cell_from = serial.cell.name
+            items.append(item)
+        TransactionItem.objects.bulk_create(items, batch_size=1000)
+        return items
+
 
 class Transaction(Movement):
     """
@@ -1369,18 +1691,51 @@ class Transaction(Movement):
         :return: None
         """
         self.items_prepared = []
-        for trans_item in self.transaction_items.all():
-            try:
-                item = Item.objects.get(reserved_by=trans_item)
-            except Item.DoesNotExist:
-                item = self.source.withdraw(trans_item)
-                item.is_reserved = True
-                item.reserved_by = trans_item
-                item.save()
-            trans_item.purchase_item = item.purchase
-            trans_item.save()
+        with self.lock_stock():
+            for trans_item in self.transaction_items.all():
+                self.prepare_item(trans_item)
         self.is_prepared = True
 
+    def lock_stock(self):
+        """
+        Locks categories of this transaction in source and destination places at once, in fixed order,
+        so Place.withdraw and Place.deposit of items one by one can't deadlock with other transaction.
+        They don't lock the same categories again inside returned block. See base.locking.hold_stock
+        :return: context manager
+        """
+        from base.locking import hold_stock
+        return hold_stock(self.stock_pairs())
+
+    def stock_pairs(self):
+        """
+        :return: (place_id, category_id) pairs changed by this transaction
+        :rtype: set
+        """
+        pairs = set()
+        for category_id, destination_id in self.transaction_items.values_list('category_id', 'destination_id'):
+            pairs.add((self.source_id, category_id))
+            pairs.add((destination_id or self.destination_id, category_id))
+        return pairs
+
+    def prepare_item(self, trans_item):
+        """
+        Withdraws item for single TransactionItem from source Place if it is not reserved yet.
+        :param trans_item: TransactionItem of this transaction
+        :type trans_item: TransactionItem
+        :return: item reserved by trans_item
+        :rtype: Item
+        """
+        try:
+            item = Item.objects.get(reserved_by=trans_item)
+        except Item.DoesNotExist:
+            item = self.source.withdraw(trans_item)
+            item.is_reserved = True
+            item.reserved_by = trans_item
+            item.save()
+        trans_item.purchase_item = item.purchase
+        trans_item.save()
+        return item
+
     def check_prepared(self):
         """
         Check validity of prepared items. Set TransactionItem destination if it was not set before.
@@ -1396,21 +1751,37 @@ class Transaction(Movement):
             assert item.place == ti.transaction.source, ti.transaction.source
             self.items_prepared.append(item)
 
-    def force_complete(self, pending=False):
+    def force_complete(self, pending=False, bulk=None):
         """
         Ignores 2-step handshake and completes transaction w/o any conditions.
         :param pending: see Transaction.complete
         :type pending: bool
+        :param bulk: see Transaction.complete
+        :type bulk: bool or None
         :return: None
         """
         self.is_negotiated_source = True
         self.is_negotiated_destination = True
         self.is_confirmed_source = True
         self.is_confirmed_destination = True
-        self.complete(pending)
+        self.complete(pending, bulk=bulk)
+
+    def check_ready(self):
+        """
+        Checks 2-step handshake flags.
+        :return: None
+        """
+        if not self.is_negotiated_source:
+            raise TransactionNotReady(_("list is not confirmed by source"))
+        if not self.is_negotiated_destination:
+            raise TransactionNotReady(_("list is not confirmed by destination"))
+        if not self.is_confirmed_source:
+            raise TransactionNotReady(_("transaction is not confirmed by source"))
+        if not self.is_confirmed_destination:
+            raise TransactionNotReady(_("transaction is not confirmed by destination"))
 
     @transaction.atomic
-    def complete(self, pending=False, transmutation=False):
+    def complete(self, pending=False, transmutation=False, bulk=None):
         """
         Completes this Transaction. Process steps are:
           - check pending, if it's True - ignore and let TransactionItems be saved first
@@ -1421,6 +1792,9 @@ class Transaction(Movement):
           - mark as completed and place timestamp
         :param pending: flag, if True then formset with TransactionItems is not saved yet
         :type pending: bool
+        :param bulk: if True - items are moved by base.bulk.BulkComplete, if False - one by one.
+                     None means settings.APP_BULK_COMPLETE. Transmutations are always moved one by one.
+        :type bulk: bool or None
         :return: None
         """
         if pending:
@@ -1430,35 +1804,45 @@ class Transaction(Movement):
         # print "transaction complete run"
         if self.is_completed:
             return
-        if not self.is_prepared:
-            self.prepare()
-        if not transmutation:
-            self.check_prepared()
-        if not self.is_negotiated_source:
-            raise TransactionNotReady(_("list is not confirmed by source"))
-        if not self.is_negotiated_destination:
-            raise TransactionNotReady(_("list is not confirmed by destination"))
-        if not self.is_confirmed_source:
-            raise TransactionNotReady(_("transaction is not confirmed by source"))
-        if not self.is_confirmed_destination:
-            raise TransactionNotReady(_("transaction is not confirmed by destination"))
-        for item in self.items_prepared:
-
-            cell = self.fill_cells(item.reserved_by)
-
-            if item.reserved_by.destination:
-                assert item.reserved_by.destination.is_descendant_of(self.destination, include_self=True), ugettext(
-                    "<{ti_dest}> must be child node of <{dest}>".format(
-                        ti_dest=item.reserved_by.destination.name,
-                        dest=self.destination.name
-                    )
-                )
-                item.reserved_by.destination.deposit(item, cell=cell)
+        from base.bulk import BulkComplete
+        with self.lock_stock():
+            if not transmutation and BulkComplete.is_enabled(bulk):
+                self.check_ready()
+                BulkComplete(self).run()
             else:
-                self.destination.deposit(item, cell=cell)
+                if not self.is_prepared:
+                    self.prepare()
+                if not transmutation:
+                    self.check_prepared()
+                self.check_ready()
+                for item in self.items_prepared:
+                    self.deposit_item(item)
         self.is_completed = True
         self.completed_at = timezone.now()
         self.save()
+        MovementLedger.record(self)
+        from base.treecache import invalidate_transaction
+        invalidate_transaction(self)
+
+    def deposit_item(self, item):
+        """
+        Deposits prepared item into TransactionItem destination or into transaction destination.
+        :param item: Item reserved by one of TransactionItems of this transaction
+        :type item: Item
+        :return: None
+        """
+        cell = self.fill_cells(item.reserved_by)
+
+        if item.reserved_by.destination:
+            assert item.reserved_by.destination.is_descendant_of(self.destination, include_self=True), ugettext(
+                "<{ti_dest}> must be child node of <{dest}>".format(
+                    ti_dest=item.reserved_by.destination.name,
+                    dest=self.destination.name
+                )
+            )
+            item.reserved_by.destination.deposit(item, cell=cell)
+        else:
+            self.destination.deposit(item, cell=cell)
 
     @staticmethod
     def fill_cells(ti):
@@ -1489,7 +1873,8 @@ class ProcessSerialMixin(object):
 
     @transaction.atomic
     def process(self):
-        assert self.item.place.pk in get_descendants_ids(Place, settings.APP_FILTERS["PLACE_WORKERS_ID"])
+        assert Place.objects.filter(subtree_q("", Place, settings.APP_FILTERS["PLACE_WORKERS_ID"], include_self=False),
+                                    pk=self.item.place_id).exists()
         tr = Transaction.objects.create(source=self.item.place, destination=self.void)
         TransactionItem.objects.create(transaction=tr, quantity=1, category=self.item.category, serial=self)
         tr.force_complete()
@@ -1516,6 +1901,35 @@ def get_descendants_ids(model, pk, include_self=False):
     return ids
 
 
+def subtree_q(path, model, node, include_self=True):
+    """
+    Filter of rows related by path to node of MPTT model or to its descendants. Compares tree_id and lft of joined
+    model with node bounds instead of IN list of descendants ids, so query size does not depend on subtree size.
+    :param path: lookup path of relation to model, empty string for model itself
+    :type path: str
+    :param model: any MPTT model class
+    :type model: MPTTModel
+    :param node: node or its primary key (bounds of node are read from database then, they change on every insert)
+    :type node: MPTTModel or int
+    :param include_self: if True, rows related to node itself match too
+    :type include_self: bool
+    :rtype: Q
+    """
+    if isinstance(node, model):
+        bounds = (node.tree_id, node.lft, node.rght)
+    else:
+        bounds = model.objects.filter(pk=node).values_list('tree_id', 'lft', 'rght').first()
+    if not bounds:
+        return models.Q(pk__in=[])
+    tree_id, lft, rght = bounds
+    prefix = path + "__" if path else ""
+    return models.Q(**{
+        prefix + "tree_id": tree_id,
+        prefix + ("lft__gte" if include_self else "lft__gt"): lft,
+        prefix + "lft__lt": rght,
+    })
+
+
 class OrderItemSerial(ItemSerial, ProcessSerialMixin):
     """
     Proxy model for filtering ItemSerial only for specific ItemCategory
@@ -1538,48 +1952,97 @@ class ContractItemSerial(ItemSerial, ProcessSerialMixin):
         verbose_name_plural = _("contract serials")
 
 
-class VItemMovement(models.Model):
-    """
-     Readonly model for display ing data from Postgresql's view.
+# Partition trigger of base_movementledger returns NULL, so INSERT reports 0 rows: inserted rows are counted by CTE
+MOVEMENT_LEDGER_SQL = """
+    WITH movements AS (
+        SELECT m.transaction_id, m.transaction_item_id,
+            CASE WHEN d.direction = 1 THEN m.destination_id ELSE m.source_id END, d.direction,
+            m.source_id, m.source_name, m.destination_id, m.destination_name, m.category_id, m.item_category_name,
+            m.serial_id, m.serial, m.quantity, m.created_at, m.completed_at
+        FROM (
+            SELECT ti.transaction_id, max(ti.id) AS transaction_item_id, t.source_id, src.name AS source_name,
+                dst.id AS destination_id, dst.name AS destination_name, ti.category_id, c.name AS item_category_name,
+                NULL::integer AS serial_id, NULL::varchar AS serial, sum(ti.quantity) AS quantity,
+                t.created_at, t.completed_at
+            FROM base_transaction t
+                JOIN base_transactionitem ti ON ti.transaction_id = t.id
+                JOIN base_place src ON src.id = t.source_id
+                JOIN base_place dst ON dst.id = coalesce(ti.destination_id, t.destination_id)
+                JOIN base_itemcategory c ON c.id = ti.category_id
+            WHERE {where}
+            GROUP BY ti.transaction_id, t.source_id, src.name, dst.id, dst.name, ti.category_id, c.name,
+                t.created_at, t.completed_at
+            UNION ALL
+            SELECT ti.transaction_id, ti.id, t.source_id, src.name, dst.id, dst.name, ti.category_id, c.name,
+                s.id, s.serial, ti.quantity, t.created_at, t.completed_at
+            FROM base_transaction t
+                JOIN base_transactionitem ti ON ti.transaction_id = t.id
+                JOIN base_place src ON src.id = t.source_id
+                JOIN base_place dst ON dst.id = coalesce(ti.destination_id, t.destination_id)
+                JOIN base_itemcategory c ON c.id = ti.category_id
+                JOIN base_itemserial s ON s.id = ti.serial_id
+            WHERE {where}
+        ) m CROSS JOIN (VALUES (-1), (1)) AS d(direction)
+    ), inserted AS (
+        INSERT INTO base_movementledger (transaction_id, transaction_item_id, place_id, direction, source_id,
+            source_name, destination_id, destination_name, category_id, item_category_name, serial_id, serial,
+            quantity, created_at, completed_at)
+        SELECT * FROM movements
+    )
+    SELECT count(*) FROM movements
+"""
+
 
-     item_category_name | character varying(100)   |           | extended |
-     source_name        | character varying(100)   |           | extended |
-     destination_name   | character varying(100)   |           | extended |
-     quantity           | numeric                  |           | main     |
-     destination_id     | integer                  |           | plain    |
-     source_id          | integer                  |           | plain    |
-     transaction_item_id | integer                  |           | plain    |
-     category_id        | integer                  |           | plain    |
-     transaction_id     | integer                  |           | plain    |
-     created_at         | timestamp with time zone |           | plain    |
-     completed_at       | timestamp with time zone |           | plain    |
+class MovementLedger(models.Model):
     """
-    item_category_name = models.CharField(_("item_category"), max_length=100)
+    Append-only history of completed transactions. Every movement is stored twice: for source place with
+    direction OUT and for destination place with direction IN, so history of single place is read by
+    (place, completed_at) index w/o OR conditions.
+    Rows w/o serial hold total quantity of category moved by transaction into destination,
+    rows with serial are written for every TransactionItem with serial.
+    Table is partitioned by month of completed_at (see migration 0081_movementledger), rows are inserted by
+    MovementLedger.record and MovementLedger.backfill only, Django ORM can't insert into partitioned table.
+    """
+    OUT = -1
+    IN = 1
+    DIRECTIONS = (
+        (OUT, _("outgoing")),
+        (IN, _("incoming")),
+    )
+
+    transaction = models.ForeignKey("Transaction", verbose_name=_("transaction"), on_delete=models.DO_NOTHING,
+                                    db_constraint=False)
+    transaction_item = models.ForeignKey("TransactionItem", verbose_name=_("transaction_item"),
+                                         on_delete=models.DO_NOTHING, db_constraint=False)
+    place = models.ForeignKey("Place", verbose_name=_("place"), related_name="ledger_movements",
+                              on_delete=models.DO_NOTHING, db_constraint=False)
+    direction = models.SmallIntegerField(_("direction"), choices=DIRECTIONS)
+    source = models.ForeignKey("Place", verbose_name=_("source"), related_name="source_movements",
+                               on_delete=models.DO_NOTHING, db_constraint=False)
     source_name = models.CharField(_("source"), max_length=100)
+    destination = models.ForeignKey("Place", verbose_name=_("destination"), related_name="destination_movements",
+                                    on_delete=models.DO_NOTHING, db_constraint=False)
     destination_name = models.CharField(_("destination"), max_length=100)
+    category = models.ForeignKey("ItemCategory", verbose_name=_("item category"), on_delete=models.DO_NOTHING,
+                                 db_constraint=False)
+    item_category_name = models.CharField(_("item_category"), max_length=100)
+    item_serial = models.ForeignKey("ItemSerial", verbose_name=_("serial"), db_column="serial_id", blank=True,
+                                    null=True, on_delete=models.DO_NOTHING, db_constraint=False)
+    serial = models.CharField(_("serial"), max_length=32, blank=True, null=True)
     quantity = models.DecimalField(_("quantity"), max_digits=9, decimal_places=3)
-    source = models.ForeignKey("Place", verbose_name=_("source"), related_name="source_item_movements",
-                               on_delete=models.DO_NOTHING)
-    transaction_item = models.OneToOneField("TransactionItem", verbose_name=_("transaction_item"),
-                                            on_delete=models.DO_NOTHING, primary_key=True)
-    destination = models.ForeignKey("Place", verbose_name=_("destination"), related_name="destination_item_movements",
-                                    on_delete=models.DO_NOTHING)
-    category = models.ForeignKey("ItemCategory", verbose_name=_("item category"), on_delete=models.DO_NOTHING)
-    transaction = models.ForeignKey("Transaction", verbose_name=_("transaction"), on_delete=models.DO_NOTHING)
     created_at = models.DateTimeField(_("created at"), default=timezone.now)
-    completed_at = models.DateTimeField(_("completed at"), default=None, blank=True, null=True)
+    completed_at = models.DateTimeField(_("completed at"))
 
     class Meta:
-        managed = False
-        db_table = "base_v_item_movement"
-        verbose_name = _("item movement")
-        verbose_name_plural = _("items movements")
-        ordering = ['-created_at']
+        verbose_name = _("movement")
+        verbose_name_plural = _("movements")
+        ordering = ['-completed_at', '-id']
 
     def __str__(self):
         return self.item_category_name
 
     @property
+    @depends(select_related=('transaction_item__purchase_item',))
     def price(self):
         if self.transaction_item.purchase_item:
             purchase = self.transaction_item.purchase_item
@@ -1589,64 +2052,76 @@ class VItemMovement(models.Model):
                 return "%s UAH" % (purchase.price,)
         return "?"
 
+    @staticmethod
+    def record(trans):
+        """
+        Writes movements of completed transaction. Called by Transaction.complete in the same db transaction.
+        :param trans: completed transaction
+        :type trans: Transaction
+        :return: count of written rows
+        :rtype: int
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(MOVEMENT_LEDGER_SQL.format(where="t.id = %s"), [trans.pk, trans.pk])
+            return cursor.fetchone()[0]
+
+    @staticmethod
+    def backfill(since=None, until=None):
+        """
+        Writes movements of completed transactions which are not in ledger yet.
+        :param since: optional, lower bound of Transaction.completed_at
+        :type since: datetime.datetime
+        :param until: optional, upper bound (exclusive) of Transaction.completed_at
+        :type until: datetime.datetime
+        :return: count of written rows
+        :rtype: int
+        """
+        where = "t.is_completed AND t.completed_at IS NOT NULL AND NOT EXISTS (" \
+                "SELECT 1 FROM base_movementledger l WHERE l.transaction_id = t.id)"
+        params = []
+        if since:
+            where += " AND t.completed_at >= %s"
+            params.append(since)
+        if until:
+            where += " AND t.completed_at < %s"
+            params.append(until)
+        with connection.cursor() as cursor:
+            cursor.execute(MOVEMENT_LEDGER_SQL.format(where=where), params + params)
+            return cursor.fetchone()[0]
+
+
+class ItemMovementManager(models.Manager):
+    def get_queryset(self):
+        return super(ItemMovementManager, self).get_queryset().filter(item_serial__isnull=True)
 
-class VSerialMovement(models.Model):
-    """
-     Readonly model for display ing data from Postgresql's view.
 
-     source         | character varying(100)   |           | extended |
-     destination    | character varying(100)   |           | extended |
-     item_category  | character varying(100)   |           | extended |
-     quantity       | numeric(9,3)             |           | main     |
-     destination_id | integer                  |           | plain    |
-     source_id      | integer                  |           | plain    |
-     category_id    | integer                  |           | plain    |
-     transaction_id | integer                  |           | plain    |
-     serial         | character varying(32)    |           | extended |
-     serial_id      | integer                  |           | plain    |
-     created_at     | timestamp with time zone |           | plain    |
-     completed_at   | timestamp with time zone |           | plain    |
-     transaction_item_id | integer                  |
+class SerialMovementManager(models.Manager):
+    def get_queryset(self):
+        return super(SerialMovementManager, self).get_queryset().filter(item_serial__isnull=False)
 
+
+class ItemMovement(MovementLedger):
+    """
+    Proxy model with category totals of MovementLedger
     """
+    objects = ItemMovementManager()
 
-    transaction_item = models.OneToOneField("TransactionItem", verbose_name=_("transaction_item"),
-                                            on_delete=models.DO_NOTHING, primary_key=True)
-    item_category_name = models.CharField(_("item_category"), max_length=100)
-    source_name = models.CharField(_("source"), max_length=100)
-    destination_name = models.CharField(_("destination"), max_length=100)
-    quantity = models.DecimalField(_("quantity"), max_digits=9, decimal_places=3)
-    serial = models.CharField(_("serial"), max_length=32)
-    serial_id = models.OneToOneField("ItemSerial", verbose_name=_("serial"), db_column="serial_id",
-                                     on_delete=models.DO_NOTHING)
-    source = models.ForeignKey("Place", verbose_name=_("source"), related_name="source_serial_movements",
-                               on_delete=models.DO_NOTHING)
-    destination = models.ForeignKey("Place", verbose_name=_("destination"), related_name="destination_serial_movements",
-                                    on_delete=models.DO_NOTHING)
-    category = models.ForeignKey("ItemCategory", verbose_name=_("item category"), on_delete=models.DO_NOTHING)
-    transaction = models.ForeignKey("Transaction", verbose_name=_("transaction"), on_delete=models.DO_NOTHING)
-    created_at = models.DateTimeField(_("created at"), default=timezone.now)
-    completed_at = models.DateTimeField(_("completed at"), default=None, blank=True, null=True)
+    class Meta:
+        proxy = True
+        verbose_name = _("item movement")
+        verbose_name_plural = _("items movements")
+
+
+class SerialMovement(MovementLedger):
+    """
+    Proxy model with serials of MovementLedger
+    """
+    objects = SerialMovementManager()
 
     class Meta:
-        managed = False
-        db_table = "base_v_serial_movement"
+        proxy = True
         verbose_name = _("serial movement")
         verbose_name_plural = _("serials movements")
-        ordering = ['-created_at']
-
-    def __str__(self):
-        return self.item_category_name
-
-    @property
-    def price(self):
-        if self.transaction_item.purchase_item:
-            purchase = self.transaction_item.purchase_item
-            if purchase.price_usd:
-                return "%s UAH (%s USD)" % (purchase.price, purchase.price_usd)
-            else:
-                return "%s UAH" % (purchase.price,)
-        return "?"
 
 
 class FixSerialTransform(models.Model):
@@ -1677,15 +2152,13 @@ class FixSerialTransform(models.Model):
             raise ValidationError({'old_serial': "Serial number not found"})
 
     def clean_new_serial(self):
-        try:
-            serial = ItemSerial.objects.get(serial=self.new_serial)
-        except ItemSerial.DoesNotExist:
-            pass
-        else:
+        from base.serials import resolve
+        ref = resolve([self.new_serial]).get(self.new_serial)
+        if ref:
             raise ValidationError({'new_serial': "Serial number already exists. "
                                                  "(%s, serial_id: %s, item_id: %s, category_id: %s, category_name: %s)" %
-                                                 (serial.serial, serial.pk, serial.item_id,
-                                                  serial.item.category_id, serial.item.category.name)
+                                                 (ref.serial, ref.serial_id, ref.item_id, ref.category_id,
+                                                  ItemCategory.objects.get(pk=ref.category_id).name)
                                    })
 
     def clean(self):
@@ -1731,87 +2204,117 @@ class FixCategoryMerge(models.Model):
         verbose_name_plural = _("fix: category merges")
         ordering = ['-timestamp']
 
-    @staticmethod
-    def get_related_models():
-        """
-        Setup which data will be altered and gathered for logging.
-        PS: Ugly shit but it works.
-        :return: list[list[model, *fields]]
-        """
-        return [
-            [ItemCategoryComment, 'category_id', None, None, None],
-            [Item, 'category_id', 'quantity', 'place_id', {'item': ['serials', 'chunks']}],
-            [TransactionItem, 'category_id', None, None, None],
-            [PurchaseItem, 'category_id', None, None, None],
-            [FixSerialTransform, 'category_id', None, None, None],
-            [FixCategoryMerge, 'old_category_id', None, None, None]
-        ]
-
-    def do_merge(self):
-        """
-        Don't touch this! Nobody knows how it works.
+    def merge_pairs(self):
+        """
+        Items of old category which are merged into item of new category in the same place. Reserved items
+        are not merged, they only get new category.
+        :return: list of tuples (old item id, quantity, new item id)
+        :rtype: list[tuple]
+        """
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                SELECT o.id, o.quantity, (
+                    SELECT min(n.id) FROM {table} n
+                    WHERE n.category_id = %s AND n.place_id = o.place_id AND NOT n.is_reserved AND n.quantity <> 0
+                ) FROM {table} o
+                WHERE o.category_id = %s AND NOT o.is_reserved AND o.quantity <> 0
+                ORDER BY o.id
+            """.format(table=Item._meta.db_table), [self.new_category_id, self.old_category_sav_id])
+            return [row for row in cursor.fetchall() if row[2]]
+
+    def do_merge(self, progress=None, dry_run=False):
+        """
+        Merges contents of old category into new category by a few set-based statements:
+          - items of old category with item of new category in the same place are summed up into it
+            (see merge_pairs), their serials, chunks and child items are moved to that item
+          - other items of old category get new category
+          - foreign keys listed in base.bulk.CATEGORY_MERGE_KEYS are pointed to new category.
+            Stock balances are maintained by database triggers, tree children of old category are not moved.
+        Log is saved into self.data as json, old category is deleted.
+        :param progress: callback(done, total, message), see Job.set_progress
+        :param dry_run: if True - nothing is changed, log with counts of affected rows is returned
+        :type dry_run: bool
+        :return: log of merge: counts of affected rows per "Model.field" and pairs of merged item ids (old, new)
+        :rtype: dict
+        """
+        from base.bulk import update_from_values, merge_foreign_keys, ITEM_MERGE_KEYS, CATEGORY_MERGE_KEYS
+        old_id, new_id = self.old_category_sav_id, self.new_category_id
+        item_keys = merge_foreign_keys(ITEM_MERGE_KEYS)
+        category_keys = merge_foreign_keys(CATEGORY_MERGE_KEYS)
+        steps = ["Item.quantity"] + ["%s.%s" % (model.__name__, field.name) for model, field in item_keys] + \
+            ["Item.category"] + ["%s.%s" % (model.__name__, field.name) for model, field in category_keys]
+        counts = OrderedDict()
+
+        def record(model, field_name, value):
+            name = "%s.%s" % (model.__name__, field_name)
+            if progress:
+                progress(steps.index(name), len(steps), name)
+            counts[name] = value
 
-        Iterate via list of related models and alter data to merge contents of two item categories.
-        :return:
-        """
-        data = {}
         # remove zero quantity items before merge
-        Item.objects.filter(quantity=0, category=self.old_category).delete()
-        Item.objects.filter(quantity=0, category=self.new_category).delete()
-        """
-        model - name of models which has relation with ItemCategory,
-        field - name of field which points to ItemCategory,
-        qf - quantity field - field which need to be summarized for two ItemCategories (actual only for Item)
-        uniq - summarize qf field grouping by this field (Item.place_id)
-        rel - reverse relation fields that need to be updated after summarization (ItemSerial, ItemChunk)
-        """
-        for model, field, qf, uniq, rel in self.get_related_models():
-            q = {field: self.old_category_sav_id}
-            u = {field: self.new_category_id}
-            qs = model.objects.filter(**q)
-            qs_list = copy(qs.values_list('id', flat=True))
-
-            # store data for logging
-            data.update({
-                model.__name__: qs_list
-            })
-
-            # quantity field summarization
-            if qf:
-
-                for new_ins in qs:
-                    # make filter for getting proper Item
-                    # place_id and category_id are in `cu` filter
-                    cu = copy(u)
-                    cu.update({
-                        uniq: getattr(new_ins, uniq)
-                    })
+        zero = Item.objects.filter(quantity=0, category_id__in=[old_id, new_id])
+        counts["Item.zero_quantity_deleted"] = zero.count()
+        if not dry_run:
+            zero.delete()
+
+        pairs = self.merge_pairs()
+        increments = OrderedDict()
+        for old_item_id, quantity, new_item_id in pairs:
+            increments[new_item_id] = increments.get(new_item_id, 0) + quantity
+        moves = [(old_item_id, new_item_id) for old_item_id, quantity, new_item_id in pairs]
+        merged_ids = [old_item_id for old_item_id, new_item_id in moves]
+
+        record(Item, "quantity", len(increments))
+        if not dry_run:
+            update_from_values(Item, list(increments.items()), "quantity = {table}.quantity + v.quantity",
+                               ['quantity'])
+        for model, field in item_keys:
+            record(model, field.name, model.objects.filter(**{"%s__in" % field.attname: merged_ids}).count())
+            if not dry_run:
+                update_from_values(model, moves, "%s = v.new_item_id" % field.column, ['new_item_id'],
+                                   key=field.column)
+        counts["Item.merged_deleted"] = len(merged_ids)
+        if not dry_run and merged_ids:
+            with connection.cursor() as cursor:
+                cursor.execute("DELETE FROM {table} WHERE id = ANY(%s)".format(table=Item._meta.db_table),
+                               [merged_ids])
+
+        for model, field in [(Item, Item._meta.get_field('category'))] + category_keys:
+            qs = model.objects.filter(**{field.attname: old_id})
+            if model is Item:
+                qs = qs.exclude(quantity=0).exclude(pk__in=merged_ids)
+            record(model, field.name, qs.count())
+            if not dry_run:
+                qs.update(**{field.attname: new_id})
+
+        counts["ReplayBalance.category"] = ReplayBalance.objects.filter(category_id=old_id).count()
+        if not dry_run:
+            ReplayBalance.merge('category', old_id, new_id)
+
+        log = OrderedDict([
+            ("old_category", {"id": old_id, "name": self.old_category_sav_name}),
+            ("new_category", {"id": new_id, "name": self.new_category.name}),
+            ("dry_run", dry_run),
+            ("counts", counts),
+            ("merged_items", moves),
+        ])
+        if dry_run:
+            return log
 
-                    try:
-                        # try to get Item instance with new ItemCategory and specific place_id
-                        old_ins = model.objects.get(**cu)
-                    except model.DoesNotExist:
-                        # no Item there: simply change category_id from old to new.
-                        model.objects.filter(pk=new_ins.pk).update(**{field: self.new_category_id})
-                    else:
-                        # Item found there: update quantity of that item.
-                        model.objects.filter(pk=old_ins.pk).update(**{qf: models.F(qf) + getattr(new_ins, qf)})
-                        # And update item_id for all ItemSerial and ItemChunk related to destroyed item
-                        for k in rel:
-                            for r in rel[k]:
-                                getattr(new_ins, r).all().update(**{k: old_ins})
-                        # destroy item.
-                        new_ins.delete()
-            else:
-                # if we don't need to fix quantity (all models except Item): simply update category_id value
-                qs.update(**u)
+        # zero balances of old category, left by triggers
+        StockBalance.objects.filter(category_id=old_id).delete()
 
         # save log data. We don't use self.data=data and self.save() to avoid merge infinite loop calling.
-        self.__class__.objects.filter(pk=self.pk).update(data=str(data))
-        c = self.old_category
+        self.__class__.objects.filter(pk=self.pk).update(data=json.dumps(log))
+        if progress:
+            progress(len(steps), len(steps), "ItemCategory")
 
         # delete old category.
-        c.delete()
+        ItemCategory.objects.get(pk=old_id).delete()
+        from base.treecache import invalidate_nodes
+        invalidate_nodes(ItemCategory, [new_id])
+        invalidate_nodes(Place, Item.objects.filter(category_id=new_id).values_list('place_id', flat=True).distinct())
+        return log
 
     def save(self, *args, **kwargs):
         if not self.old_category_sav_id:
@@ -1819,7 +2322,7 @@ class FixCategoryMerge(models.Model):
             self.old_category_sav_name = self.old_category.name
         super(FixCategoryMerge, self).save(*args, **kwargs)
         if not self.data:
-            self.do_merge()
+            Job.dispatch('category_merge', {'merge_id': self.pk})
 
 
 class FixPlaceMerge(models.Model):
@@ -1835,6 +2338,9 @@ class FixPlaceMerge(models.Model):
     old_place_sav_id = models.PositiveIntegerField(blank=True, null=True)
     old_place_sav_name = models.CharField(max_length=100, blank=True, null=True)
     timestamp = models.DateTimeField(default=timezone.now)
+    data = models.TextField(blank=True, null=True)
+    transaction = models.ForeignKey("Transaction", verbose_name=_("audit transaction"), blank=True, null=True,
+                                    related_name="place_merges", on_delete=models.SET_NULL)
 
     class Meta:
         verbose_name = _("fix: place merge")
@@ -1842,11 +2348,13 @@ class FixPlaceMerge(models.Model):
         ordering = ['-timestamp']
 
     def save(self, *args, **kwargs):
-        if not self.old_place_sav_id and self.old_place:
+        join = not self.old_place_sav_id and self.old_place
+        if join:
             self.old_place_sav_id = self.old_place_id
             self.old_place_sav_name = self.old_place.name
-            self.old_place.join_to(self.new_place)
         super(FixPlaceMerge, self).save(*args, **kwargs)
+        if join:
+            Job.dispatch('place_merge', {'merge_id': self.pk})
 
 
 class Cell(models.Model):
@@ -1918,6 +2426,15 @@ class Transmutation(Transaction):
         self.is_confirmed_destination = True
         self.complete(pending)
 
+    def stock_pairs(self):
+        """
+        Items are deposited into transmutator with transmuted categories
+        """
+        pairs = super(Transmutation, self).stock_pairs()
+        pairs.update((self.destination_id, category_id)
+                     for category_id in self.transmutation_items.values_list('transmuted_id', flat=True))
+        return pairs
+
     @transaction.atomic
     def complete(self, pending=False, transmutation=True):
         """
@@ -1942,10 +2459,11 @@ class Transmutation(Transaction):
 
         super(Transmutation, self).complete(pending=False, transmutation=True)
 
-    def transmute(self):
+    def transmute(self, progress=None):
         """
         Called from base.admin.TransmutationAdmin.save_formset
         Creates reversed transaction to return items with new categories from transmutator back to source Place
+        :param progress: callback(done, total, message), see Job.set_progress
         :return:
         """
         if not self.transmutation_items.count():
@@ -1976,7 +2494,11 @@ class Transmutation(Transaction):
                 serial=tr.serial,
                 cell=tr.cell
             )
+        if progress:
+            progress(1, 3, ugettext("moving items to transmutator"))
         self.complete()
+        if progress:
+            progress(2, 3, ugettext("returning transmuted items"))
         rev_t.force_complete()
 
     class Meta:
@@ -1996,9 +2518,11 @@ class Warranty(models.Model):
         verbose_name = _("warranty date")
         verbose_name_plural = _("warranty dates")
 
+    @depends(select_related=('serial',))
     def __str__(self):
         return self.serial.serial
 
+    @depends(select_related=('serial__item__category',))
     def category_name(self):
         return self.serial.item.category.name
 
@@ -2039,14 +2563,18 @@ class Return(Transaction):
     Purchase can be omitted if ReturnItem.destination has Item available to withdraw.
     """
     @transaction.atomic
-    def ret(self):
+    def ret(self, progress=None):
         """
         called from base.admin.ReturnAdmin.save_formset
+        :param progress: callback(done, total, message), see Job.set_progress
         :return:
         """
-        if not self.return_items.count():
+        total = self.return_items.count()
+        if not total:
             raise RuntimeError(ugettext("No return items added"))
-        for ri in self.return_items.all():
+        for step, ri in enumerate(self.return_items.select_related('category')):
+            if progress:
+                progress(step, total + 1, ri.category.name)
             if ri.source and not ri.source == self.source:
                 t_prep = Transaction.objects.create(
                     destination=self.source,
@@ -2122,6 +2650,8 @@ class Return(Transaction):
                 cell=ri.cell
             )
 
+        if progress:
+            progress(total, total + 1, ugettext("completing"))
         self.complete()
         self.transaction_ptr.created_at = timezone.now()
         self.transaction_ptr.save()
@@ -2179,3 +2709,208 @@ class WorkersInstalled(Transaction):
         proxy = True
         verbose_name = _("worker's installed item")
         verbose_name_plural = _("worker's installed items")
+
+
+class RequestStat(models.Model):
+    """
+    Queries count and time of single request, written by moneypot.middleware.QueryBudgetMiddleware.
+    Used for finding slow endpoints, see RequestStat.worst_endpoints.
+    """
+    url_name = models.CharField(_("url name"), max_length=200, db_index=True)
+    path = models.CharField(_("path"), max_length=255)
+    method = models.CharField(_("method"), max_length=10)
+    status = models.PositiveSmallIntegerField(_("status"))
+    query_count = models.PositiveIntegerField(_("query count"))
+    query_time = models.FloatField(_("query time"))
+    repeated = models.PositiveIntegerField(_("max repeated query shape"), default=0)
+    is_over_budget = models.BooleanField(_("over budget"), default=False)
+    created_at = models.DateTimeField(_("created at"), default=timezone.now, db_index=True)
+
+    class Meta:
+        verbose_name = _("request stat")
+        verbose_name_plural = _("request stats")
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return "%s %s" % (self.method, self.url_name)
+
+    @classmethod
+    def worst_endpoints(cls, limit=50, since=None):
+        """
+        Endpoints ordered by 95th percentile of queries count, then by 95th percentile of queries time.
+        :param limit: max rows count
+        :type limit: int
+        :param since: if set - only requests after this moment are used
+        :type since: datetime.datetime
+        :return: list of dicts with keys url_name, requests, p95_count, p95_time, max_count, max_repeated, violations
+        :rtype: list[dict]
+        """
+        where = ""
+        params = []
+        if since:
+            where = "WHERE created_at >= %s"
+            params.append(since)
+        params.append(limit)
+        sql = """
+            SELECT url_name, count(*) AS requests,
+                percentile_cont(0.95) WITHIN GROUP (ORDER BY query_count) AS p95_count,
+                percentile_cont(0.95) WITHIN GROUP (ORDER BY query_time) AS p95_time,
+                max(query_count) AS max_count,
+                max(repeated) AS max_repeated,
+                sum(CASE WHEN is_over_budget THEN 1 ELSE 0 END) AS violations
+            FROM {table} {where}
+            GROUP BY url_name
+            ORDER BY p95_count DESC, p95_time DESC
+            LIMIT %s
+        """.format(table=cls._meta.db_table, where=where)
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            columns = [col[0] for col in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+class Job(models.Model):
+    """
+    Long running operation (merge, return, export...) executed by `manage.py worker` outside of request.
+    Operations are registered in base.jobs.TASKS, see Job.dispatch.
+    Job row is created in request transaction, so worker sees it only after request data is committed.
+    """
+    PENDING = 0
+    RUNNING = 1
+    DONE = 2
+    FAILED = 3
+    STATUSES = (
+        (PENDING, _("pending")),
+        (RUNNING, _("running")),
+        (DONE, _("done")),
+        (FAILED, _("failed")),
+    )
+
+    name = models.CharField(_("name"), max_length=50, db_index=True)
+    params = models.TextField(_("params"), default='{}')
+    status = models.PositiveSmallIntegerField(_("status"), choices=STATUSES, default=PENDING)
+    progress = models.PositiveSmallIntegerField(_("progress"), default=0)
+    message = models.CharField(_("message"), max_length=255, blank=True, default='')
+    attempts = models.PositiveSmallIntegerField(_("attempts"), default=0)
+    max_attempts = models.PositiveSmallIntegerField(_("max attempts"), default=3)
+    result = models.TextField(_("result"), blank=True, null=True)
+    error = models.TextField(_("error"), blank=True, null=True)
+    created_by = models.ForeignKey(settings.AUTH_USER_MODEL, verbose_name=_("created by"), blank=True, null=True,
+                                   on_delete=models.SET_NULL)
+    created_at = models.DateTimeField(_("created at"), default=timezone.now)
+    run_after = models.DateTimeField(_("run after"), default=timezone.now)
+    started_at = models.DateTimeField(_("started at"), blank=True, null=True)
+    finished_at = models.DateTimeField(_("finished at"), blank=True, null=True)
+
+    class Meta:
+        verbose_name = _("job")
+        verbose_name_plural = _("jobs")
+        ordering = ['-created_at']
+        index_together = [['status', 'run_after']]
+
+    def __str__(self):
+        return "%s #%s" % (self.name, self.pk)
+
+    @classmethod
+    def enqueue(cls, name, params=None, user=None, max_attempts=3):
+        return cls.objects.create(name=name, params=json.dumps(params or {}), max_attempts=max_attempts,
+                                  created_by=user if user and user.is_authenticated() else None)
+
+    @classmethod
+    def dispatch(cls, name, params=None, user=None):
+        """
+        Enqueues job when settings.APP_JOBS_ASYNC is set, otherwise runs operation right here.
+        :param name: key of base.jobs.TASKS
+        :param params: json serializable task arguments
+        :type params: dict
+        :param user: request user, stored as job owner
+        :return: created job or None when operation is already done
+        :rtype: Job or None
+        """
+        if settings.APP_JOBS_ASYNC:
+            return cls.enqueue(name, params, user)
+        from base.jobs import TASKS
+        TASKS[name](params or {}, lambda *args, **kwargs: None)
+        return None
+
+    @classmethod
+    def claim(cls):
+        """
+        Locks next pending job (or job of died worker, running longer than settings.APP_JOBS_STALE_TIMEOUT)
+        and marks it as running. Concurrent workers wait for row lock, then skip the job.
+        Stale jobs without attempts left are marked as failed.
+        :rtype: Job or None
+        """
+        now = timezone.now()
+        stale = now - timedelta(seconds=settings.APP_JOBS_STALE_TIMEOUT)
+        with transaction.atomic():
+            cls.objects.filter(status=cls.RUNNING, started_at__lt=stale, attempts__gte=models.F('max_attempts')).update(
+                status=cls.FAILED, error="worker died on last attempt", finished_at=now)
+            job = cls.objects.select_for_update().filter(
+                models.Q(status=cls.PENDING, run_after__lte=now) |
+                models.Q(status=cls.RUNNING, started_at__lt=stale, attempts__lt=models.F('max_attempts'))
+            ).order_by('run_after', 'id').first()
+            if job is None:
+                return None
+            job.status = cls.RUNNING
+            job.attempts += 1
+            job.progress = 0
+            job.started_at = now
+            job.save()
+        return job
+
+    def get_params(self):
+        return json.loads(self.params)
+
+    def get_result(self):
+        return json.loads(self.result) if self.result else None
+
+    def set_progress(self, done, total=100, message=''):
+        """
+        Sets progress fields without saving. Running job writes them through base.jobs.JobProgress.
+        """
+        self.progress = int(100 * done / total) if total else 100
+        self.message = message[:255]
+
+    def get_progress(self):
+        """
+        :return: progress percent and message
+        :rtype: tuple
+        """
+        return self.progress, self.message
+
+    def get_export_path(self):
+        """
+        :return: path of file written by export job, it is kept in settings.APP_EXPORT_ROOT out of MEDIA_ROOT
+        :rtype: str or None
+        """
+        result = self.get_result() if self.status == self.DONE else None
+        if not result or 'file' not in result:
+            return None
+        return os.path.join(settings.APP_EXPORT_ROOT, os.path.basename(result['file']))
+
+    def get_download_url(self):
+        if self.get_export_path() is None:
+            return None
+        return reverse("base:job_download", args=[self.pk])
+
+    def finish(self, result=None):
+        self.status = self.DONE
+        self.progress = 100
+        self.result = json.dumps(result) if result is not None else None
+        self.error = None
+        self.finished_at = timezone.now()
+        self.save()
+
+    def fail(self, error, retry=False):
+        """
+        Marks job as failed, or returns it to queue with linear backoff while attempts are left.
+        """
+        self.error = error
+        if retry and self.attempts < self.max_attempts:
+            self.status = self.PENDING
+            self.run_after = timezone.now() + timedelta(seconds=settings.APP_JOBS_RETRY_DELAY * self.attempts)
+        else:
+            self.status = self.FAILED
+            self.finished_at = timezone.now()
+        self.save()
@@ -0,0 +1,237 @@
+# -*- encoding: utf-8 -*-
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+import time
+from array import array
+from collections import OrderedDict
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from base.models import Purchase, PurchaseItem, Transaction, TransactionItem, TransmutationItem, Item, ItemSerial, \
+    ReplayBalance, FixPlaceMerge
+
+PURCHASE, TRANSFER = 0, 1
+
+# Movements of completed history as rows (completed_at, kind, movement_id, source_id, destination_id,
+# category_id, new_category_id, quantity, serial_id), in order of completion.
+# Auto source purchase creates its items in source place right before its transaction, so purchase rows
+# get time of the first transaction with its items and are sorted before transaction rows.
+# Transmuted items change category on the way to destination.
+# Audit transaction of place merge is skipped: history of merged place is pointed to new place (see
+# base.bulk.PlaceMerge.move_history), so moved stock is already counted there.
+REPLAY_SQL = """
+    WITH pt AS (
+        SELECT ti.purchase_id, min(t.completed_at) AS completed_at
+        FROM {trans_item} ti JOIN {trans} t ON t.id = ti.transaction_id
+        WHERE t.is_completed AND ti.purchase_id IS NOT NULL
+        GROUP BY ti.purchase_id
+    )
+    SELECT * FROM (
+        SELECT coalesce(pt.completed_at, p.completed_at) AS at, {purchase_kind} AS kind, p.id,
+            NULL::integer, p.source_id, pi.category_id, pi.category_id, pi.quantity, NULL::integer
+        FROM {purchase} p
+            JOIN {purchase_item} pi ON pi.purchase_id = p.id
+            LEFT JOIN pt ON pt.purchase_id = p.id
+        WHERE p.is_completed AND p.is_auto_source
+        UNION ALL
+        SELECT coalesce(pt.completed_at, p.completed_at), {purchase_kind}, p.id,
+            NULL, p.source_id, pi.category_id, pi.category_id, 0, s.id
+        FROM {purchase} p
+            JOIN {purchase_item} pi ON pi.purchase_id = p.id
+            JOIN {serial} s ON s.purchase_id = pi.id
+            LEFT JOIN pt ON pt.purchase_id = p.id
+        WHERE p.is_completed AND p.is_auto_source
+        UNION ALL
+        SELECT t.completed_at, {transfer_kind}, t.id,
+            t.source_id, coalesce(ti.destination_id, t.destination_id), ti.category_id,
+            coalesce(tm.transmuted_id, ti.category_id), ti.quantity, ti.serial_id
+        FROM {trans} t
+            JOIN {trans_item} ti ON ti.transaction_id = t.id
+            LEFT JOIN {transmutation_item} tm ON tm.ti_id = ti.id
+        WHERE t.is_completed AND NOT EXISTS (SELECT 1 FROM {place_merge} f WHERE f.transaction_id = t.id)
+    ) m
+    WHERE m.at <= %s
+    ORDER BY 1, 2, 3
+""".format(purchase=Purchase._meta.db_table, purchase_item=PurchaseItem._meta.db_table,
+           trans=Transaction._meta.db_table, trans_item=TransactionItem._meta.db_table,
+           transmutation_item=TransmutationItem._meta.db_table, serial=ItemSerial._meta.db_table,
+           place_merge=FixPlaceMerge._meta.db_table, purchase_kind=PURCHASE, transfer_kind=TRANSFER)
+
+# Live stock by place and category: all items (reserved too, as reservation is not a movement) and their serials
+LIVE_SQL = """
+    SELECT i.place_id, i.category_id, sum(i.quantity), coalesce(sum(s.cnt), 0)
+    FROM {item} i
+        LEFT JOIN (SELECT item_id, count(*) AS cnt FROM {serial} GROUP BY item_id) s ON s.item_id = i.id
+    WHERE i.place_id IS NOT NULL
+    GROUP BY i.place_id, i.category_id
+""".format(item=Item._meta.db_table, serial=ItemSerial._meta.db_table)
+
+LIVE_SERIALS_SQL = """
+    SELECT s.id, i.place_id, i.category_id
+    FROM {serial} s
+        JOIN {item} i ON i.id = s.item_id
+""".format(item=Item._meta.db_table, serial=ItemSerial._meta.db_table)
+
+
+def stream(sql, params, name, itersize=None):
+    """
+    Rows of query read through server side cursor, so memory does not depend on result size.
+    :rtype: collections.Iterable[tuple]
+    """
+    with transaction.atomic():
+        connection.ensure_connection()
+        cursor = connection.connection.cursor(name=name)
+        cursor.itersize = itersize or settings.APP_REPLAY_ITERSIZE
+        try:
+            cursor.execute(sql, params)
+            for row in cursor:
+                yield row
+        finally:
+            cursor.close()
+
+
+class Replay(object):
+    """
+    Rebuilds stock by applying completed history to in-memory state, without touching items:
+      - quantities: dict (place_id, category_id) -> Decimal
+      - serials: two arrays indexed by serial id: place_id and category_id, 0 if serial was never moved
+    Only movements are replayed: items created or changed w/o transaction (admin forms, serial transforms)
+    and chunks (splits of chunks are not recorded in history) are not. Merges rewrite history, so they are replayed
+    as if merged places and categories were always one: audit transactions of place merges are skipped.
+    State can be compared with live items (Replay.diff) or written into ReplayBalance table (Replay.write).
+    """
+
+    def __init__(self, itersize=None):
+        self.itersize = itersize
+        self.quantities = {}
+        max_serial = ItemSerial.objects.aggregate(max_id=Max('id'))['max_id'] or 0
+        self.serial_places = array(str('l'), [0]) * (max_serial + 1)
+        self.serial_categories = array(str('l'), [0]) * (max_serial + 1)
+        self.movements = 0
+        self.rows = 0
+        self.negative = OrderedDict()
+        self.seconds = 0
+
+    def run(self, until=None, progress=None):
+        """
+        :param until: replay movements completed before this time only, all by default
+        :type until: datetime.datetime
+        :param progress: callback(done, total, message), called every settings.APP_REPLAY_ITERSIZE rows
+        :return: self
+        """
+        until = until or timezone.now()
+        started = time.time()
+        last = None
+        itersize = self.itersize or settings.APP_REPLAY_ITERSIZE
+        for row in stream(REPLAY_SQL, [until], 'base_replay', self.itersize):
+            if (row[1], row[2]) != last:
+                last = (row[1], row[2])
+                self.movements += 1
+            self.apply(*row[3:])
+            self.rows += 1
+            if progress and not self.rows % itersize:
+                progress(self.rows, None, "%s" % row[0])
+        self.seconds = round(time.time() - started, 3)
+        return self
+
+    def apply(self, source_id, destination_id, category_id, new_category_id, quantity, serial_id):
+        quantities = self.quantities
+        if source_id is not None and quantity:
+            key = (source_id, category_id)
+            rest = quantities.get(key, 0) - quantity
+            quantities[key] = rest
+            if rest < 0 and key not in self.negative:
+                self.negative[key] = rest
+        key = (destination_id, new_category_id)
+        quantities[key] = quantities.get(key, 0) + quantity
+        if serial_id is not None:
+            if serial_id >= len(self.serial_places):
+                grow = serial_id + 1 - len(self.serial_places)
+                self.serial_places.extend([0] * grow)
+                self.serial_categories.extend([0] * grow)
+            self.serial_places[serial_id] = destination_id
+            self.serial_categories[serial_id] = new_category_id
+
+    def balances(self):
+        """
+        :return: dict (place_id, category_id) -> (quantity, serial_count), keys with zero stock are skipped
+        :rtype: dict
+        """
+        serial_counts = {}
+        for serial_id, place_id in enumerate(self.serial_places):
+            if place_id:
+                key = (place_id, self.serial_categories[serial_id])
+                serial_counts[key] = serial_counts.get(key, 0) + 1
+        result = {}
+        for key in set(self.quantities) | set(serial_counts):
+            quantity, serial_count = self.quantities.get(key, 0), serial_counts.get(key, 0)
+            if quantity or serial_count:
+                result[key] = (Decimal(quantity), serial_count)
+        return result
+
+    def diff(self, limit=None):
+        """
+        Compares replayed state with live items.
+        :param limit: max count of reported balances and serials
+        :return: json serializable report
+        :rtype: dict
+        """
+        replayed = self.balances()
+        balances = []
+        mismatched = 0
+        seen = set()
+        for place_id, category_id, quantity, serial_count in stream(LIVE_SQL, [], 'base_replay_live', self.itersize):
+            key = (place_id, category_id)
+            seen.add(key)
+            expected = replayed.get(key, (Decimal(0), 0))
+            if not expected == (quantity, serial_count):
+                mismatched += 1
+                balances.append((key, expected, (quantity, serial_count)))
+        for key, expected in replayed.items():
+            if key not in seen:
+                mismatched += 1
+                balances.append((key, expected, (Decimal(0), 0)))
+
+        serials = []
+        misplaced = 0
+        for serial_id, place_id, category_id in stream(LIVE_SERIALS_SQL, [], 'base_replay_serials', self.itersize):
+            if serial_id < len(self.serial_places) and self.serial_places[serial_id] and \
+                    (self.serial_places[serial_id], self.serial_categories[serial_id]) != (place_id, category_id):
+                misplaced += 1
+                serials.append((serial_id, self.serial_places[serial_id], place_id))
+
+        limit = limit or settings.APP_AUDIT_LIMIT
+        return OrderedDict([
+            ("movements", self.movements),
+            ("rows", self.rows),
+            ("seconds", self.seconds),
+            ("mismatched_balances", mismatched),
+            ("balances", [OrderedDict([
+                ("place_id", key[0]), ("category_id", key[1]),
+                ("replayed", [str(expected[0]), expected[1]]), ("live", [str(live[0]), live[1]]),
+            ]) for key, expected, live in sorted(balances)[:limit]]),
+            ("misplaced_serials", misplaced),
+            ("serials", [OrderedDict([
+                ("serial_id", serial_id), ("replayed_place_id", replayed_place), ("live_place_id", live_place),
+            ]) for serial_id, replayed_place, live_place in serials[:limit]]),
+            ("negative", [OrderedDict([
+                ("place_id", key[0]), ("category_id", key[1]), ("quantity", str(value))
+            ]) for key, value in list(self.negative.items())[:limit]]),
+        ])
+
+    @transaction.atomic
+    def write(self):
+        """
+        Replaces contents of ReplayBalance table with replayed state.
+        :return: count of written rows
+        :rtype: int
+        """
+        ReplayBalance.objects.all().delete()
+        rows = [ReplayBalance(place_id=place_id, category_id=category_id, quantity=quantity, serial_count=serial_count)
+                for (place_id, category_id), (quantity, serial_count) in self.balances().items()]
+        ReplayBalance.objects.bulk_create(rows, batch_size=1000)
+        return len(rows)
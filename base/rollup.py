@@ -0,0 +1,144 @@
+# -*- encoding: utf-8 -*-
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import connection
+
+from base.caching import get_cache, get_timeout, versioned_key
+from base.models import Place, ItemCategory, StockBalance
+
+SUMMARY_FIELDS = ('available', 'reserved', 'serial_count', 'positions')
+
+
+def _tree_condition(alias, root_alias):
+    return "{alias}.tree_id = {root}.tree_id AND {alias}.lft BETWEEN {root}.lft AND {root}.rght".format(
+        alias=alias, root=root_alias
+    )
+
+
+def subtree_stock(place=None, category=None):
+    """
+    Total stock of category subtree under place subtree, calculated by single aggregate over StockBalance
+    joined with nodes by tree_id/lft/rght ranges. Empty argument means any place or any category.
+    :param place: root of places subtree
+    :type place: Place or int or None
+    :param category: root of categories subtree
+    :type category: ItemCategory or int or None
+    :return: dict with keys available, reserved, serial_count
+    :rtype: dict
+    """
+    joins = []
+    params = []
+    if place is not None:
+        joins.append("JOIN base_place p ON p.id = b.place_id JOIN base_place p_root ON p_root.id = %s AND " +
+                     _tree_condition('p', 'p_root'))
+        params.append(getattr(place, 'pk', place))
+    if category is not None:
+        joins.append("JOIN base_itemcategory c ON c.id = b.category_id "
+                     "JOIN base_itemcategory c_root ON c_root.id = %s AND " + _tree_condition('c', 'c_root'))
+        params.append(getattr(category, 'pk', category))
+    sql = """
+        SELECT coalesce(sum(b.available), 0), coalesce(sum(b.reserved), 0), coalesce(sum(b.serial_count), 0)
+        FROM {table} b {joins}
+    """.format(table=StockBalance._meta.db_table, joins=" ".join(joins))
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        available, reserved, serial_count = cursor.fetchone()
+    return {'available': available, 'reserved': reserved, 'serial_count': serial_count}
+
+
+def subtree_summaries(model, node_ids):
+    """
+    Per-node stock summary of whole subtree for each of provided nodes, calculated by single query.
+    positions is count of distinct categories (for places) or places (for categories) with available stock.
+    :param model: Place or ItemCategory
+    :param node_ids: ids of subtrees roots
+    :type node_ids: list[int]
+    :return: dict node_id -> dict with SUMMARY_FIELDS keys
+    :rtype: dict
+    """
+    if model is Place:
+        own, other = 'place_id', 'category_id'
+    elif model is ItemCategory:
+        own, other = 'category_id', 'place_id'
+    else:
+        raise ValueError("model must be Place or ItemCategory")
+    node_ids = list(node_ids)
+    result = dict((pk, dict(zip(SUMMARY_FIELDS, (Decimal(0), Decimal(0), 0, 0)))) for pk in node_ids)
+    if not node_ids:
+        return result
+    sql = """
+        SELECT root.id, sum(b.available), sum(b.reserved), sum(b.serial_count),
+            count(DISTINCT CASE WHEN b.available > 0 THEN b.{other} END)
+        FROM {table} root
+            JOIN {table} n ON {tree_condition}
+            JOIN {balance} b ON b.{own} = n.id
+        WHERE root.id = ANY(%s)
+        GROUP BY root.id
+    """.format(table=model._meta.db_table, balance=StockBalance._meta.db_table, own=own, other=other,
+               tree_condition=_tree_condition('n', 'root'))
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [node_ids])
+        for row in cursor.fetchall():
+            result[row[0]] = dict(zip(SUMMARY_FIELDS, row[1:]))
+    return result
+
+
+def _summary_keys(model, node_ids):
+    """
+    Cache keys of summaries, in namespace of model version: tree moves, renames and deletes make all of them unused.
+    :return: dict key -> node id
+    :rtype: dict
+    """
+    prefix = versioned_key("rollup:%s" % model._meta.model_name, model)
+    return dict(("%s:%s" % (prefix, pk), pk) for pk in node_ids)
+
+
+def get_summaries(model, node_ids):
+    """
+    Cached version of subtree_summaries. Entries live settings.APP_ROLLUP_CACHE_TIMEOUT seconds.
+    :rtype: dict
+    """
+    node_ids = list(node_ids)
+    keys = _summary_keys(model, node_ids)
+    cache = get_cache()
+    cached = cache.get_many(list(keys.keys()))
+    result = dict((keys[key], value) for key, value in cached.items())
+    missing = [pk for pk in node_ids if pk not in result]
+    if missing:
+        fresh = subtree_summaries(model, missing)
+        cache.set_many(dict((key, fresh[pk]) for key, pk in keys.items() if pk in fresh),
+                       get_timeout(getattr(settings, 'APP_ROLLUP_CACHE_TIMEOUT', 300)))
+        result.update(fresh)
+    return result
+
+
+def invalidate_summaries(model, node_ids):
+    """
+    Drops cached summaries of provided nodes.
+    """
+    get_cache().delete_many(list(_summary_keys(model, node_ids).keys()))
+
+
+def get_summary(node):
+    """
+    Cached stock summary of node subtree.
+    :param node: Place or ItemCategory instance
+    :rtype: dict
+    """
+    return get_summaries(node.__class__, [node.pk])[node.pk]
+
+
+def format_summary(summary):
+    """
+    Short text for tree labels.
+    :rtype: str
+    """
+    if not summary['positions'] and not summary['reserved']:
+        return ""
+    text = "%s: %s" % (summary['positions'], '{0:f}'.format(Decimal(summary['available']).normalize()))
+    if summary['serial_count']:
+        text += " / SN %s" % summary['serial_count']
+    return text
@@ -0,0 +1,108 @@
+# -*- encoding: utf-8 -*-
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+import hashlib
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db.models import F
+
+from base.caching import get_cache, get_timeout, versioned_key, VERSIONED_MODELS
+from base.models import Item
+
+EXACT, PREFIX, SUBSTRING, SIMILAR = range(4)
+
+
+def escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def ranked(queryset, q, field='name', trigram=True):
+    """
+    Rows of queryset matching q, in single query ordered by match rank (exact, prefix, substring, trigram similar)
+    and then by trigram similarity. Rows get search_rank and distance attributes.
+    Substring and similarity conditions are served by gin_trgm_ops index on field.
+    :param queryset: base queryset, may be filtered by scope
+    :param q: search string
+    :param field: column of queryset model to search by
+    :param trigram: if False - only prefix and substring matches are returned
+    :rtype: django.db.models.query.QuerySet
+    """
+    column = '"%s"."%s"' % (queryset.model._meta.db_table, queryset.model._meta.get_field(field).column)
+    prefix = escape_like(q) + '%'
+    substring = '%' + escape_like(q) + '%'
+    where = "{col} ILIKE %s".format(col=column)
+    params = [substring]
+    if trigram:
+        where = "({where} OR {col} %% %s)".format(where=where, col=column)
+        params.append(q)
+    return queryset.extra(
+        select=OrderedDict([
+            ('search_rank', "CASE WHEN lower({col}) = lower(%s) THEN {exact} WHEN {col} ILIKE %s THEN {prefix} "
+                            "WHEN {col} ILIKE %s THEN {substring} ELSE {similar} END".format(
+                                col=column, exact=EXACT, prefix=PREFIX, substring=SUBSTRING, similar=SIMILAR)),
+            ('distance', "similarity({col}, %s)".format(col=column)),
+        ]),
+        select_params=[q, prefix, substring, q],
+        where=[where],
+        params=params,
+    ).order_by('search_rank', '-distance', field)
+
+
+def scoped(queryset, leaf_only=False, source_id=None, within=None, place_name=None):
+    """
+    Scope filters of search.
+    :param leaf_only: only MPTT nodes without children
+    :param source_id: only categories which have items in this place
+    :param place_name: only categories which have items in places with name containing this string
+    :param within: only MPTT nodes of this node subtree (node itself included)
+    :rtype: django.db.models.query.QuerySet
+    """
+    if leaf_only:
+        queryset = queryset.filter(rght=F('lft') + 1)
+    if source_id:
+        queryset = queryset.filter(pk__in=Item.objects.filter(place_id=source_id).values('category_id'))
+    if place_name:
+        queryset = queryset.filter(pk__in=Item.objects.filter(place__name__icontains=place_name).values('category_id'))
+    if within:
+        table = queryset.model._meta.db_table
+        queryset = queryset.extra(
+            where=["EXISTS (SELECT 1 FROM {table} root WHERE root.id = %s AND root.tree_id = {table}.tree_id "
+                   "AND {table}.lft BETWEEN root.lft AND root.rght)".format(table=table)],
+            params=[within]
+        )
+    return queryset
+
+
+def search(model, q, limit=20, field='name', trigram=True, **scope):
+    """
+    Cached ranked search for autocompletes: every typed prefix costs one query, repeated prefixes are
+    served from cache for settings.APP_SEARCH_CACHE_TIMEOUT seconds (and until model changes, for versioned models).
+    :param model: model to search
+    :param q: search string
+    :param limit: max results count
+    :param scope: scoped keyword arguments
+    :return: model instances with search_rank and distance attributes
+    :rtype: list
+    """
+    key = "search:%s:%s:%s:%s" % (
+        model._meta.model_name, field, ":".join("%s=%s" % (k, v) for k, v in sorted(scope.items()) if v),
+        hashlib.md5(("%s:%s:%s" % (q, limit, int(trigram))).encode('utf-8')).hexdigest()
+    )
+    if model in VERSIONED_MODELS:
+        key = versioned_key(key, model)
+    cache = get_cache()
+    hits = cache.get(key)
+    if hits is None:
+        results = list(ranked(scoped(model._default_manager.all(), **scope), q, field, trigram)[:limit])
+        cache.set(key, [(obj.pk, obj.search_rank, obj.distance) for obj in results],
+                  get_timeout(settings.APP_SEARCH_CACHE_TIMEOUT))
+        return results
+    objects = model._default_manager.in_bulk([pk for pk, rank, distance in hits])
+    results = []
+    for pk, rank, distance in hits:
+        if pk in objects:
+            obj = objects[pk]
+            obj.search_rank, obj.distance = rank, distance
+            results.append(obj)
+    return results
@@ -0,0 +1,146 @@
+# -*- encoding: utf-8 -*-
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+import heapq
+import re
+from collections import namedtuple
+
+from django.conf import settings
+from django.utils.translation import ugettext
+
+from base.models import InvalidParameters
+
+TOKEN_RE = re.compile(r"[\w-]+")
+NUMBERED_RE = re.compile(r"^([a-z0-9\-]*?)([0-9]+)$", re.I)
+
+
+class SerialRange(namedtuple('SerialRange', ['base', 'start', 'stop', 'width', 'raw'])):
+    """
+    Inclusive range of serials with common base and zero padded number of fixed width, like A0001--A0500.
+    Numbered single serial is range of one. Base never ends with digit, so every serial string has one
+    (base, width, number) representation, and ranges of the same base and width can be compared as intervals.
+    """
+    __slots__ = ()
+
+    @property
+    def size(self):
+        return self.stop - self.start + 1
+
+    def serials(self):
+        """
+        Serials of range in ascending order, generated one by one.
+        :rtype: collections.Iterable[str]
+        """
+        fmt = "%s%0{width}d".format(width=self.width)
+        for number in range(self.start, self.stop + 1):
+            yield fmt % (self.base, number)
+
+
+def parse_range(raw_serial):
+    """
+    :param raw_serial: range token, like A0001--A0500
+    :rtype: SerialRange
+    :raise InvalidParameters: on malformed or too large range
+    """
+    l, sep, r = raw_serial.partition('--')
+    if not len(r) == len(l):
+        raise InvalidParameters(ugettext(
+            u'serials range left and right parts length mismatch: {raw_serial}'.format(
+                raw_serial=raw_serial
+            )
+        ))
+    lm = NUMBERED_RE.match(l)
+    rm = NUMBERED_RE.match(r)
+    if not lm or not rm:
+        raise InvalidParameters(ugettext(
+            u'serials range format error: {raw_serial}'.format(
+                raw_serial=raw_serial
+            )
+        ))
+    lb, ld = lm.groups()
+    rb, rd = rm.groups()
+    if not lb == rb:
+        raise InvalidParameters(ugettext(
+            u'serials range left and right parts base mismatch: {raw_serial}, {lb}≠{rb}'.format(
+                raw_serial=raw_serial,
+                rb=rb,
+                lb=lb,
+            )
+        ))
+    li = int(ld)
+    ri = int(rd)
+    if not ri > li:
+        raise InvalidParameters(ugettext(
+            u'serials range left part must be lesser than rigth: {raw_serial}, {li}>={ri}'.format(
+                raw_serial=raw_serial,
+                ri=ri,
+                li=li,
+            )
+        ))
+    if ri - li >= settings.APP_SERIALS_RANGE_LIMIT:
+        raise InvalidParameters(ugettext(
+            u'serials range too large: {raw_serial} {size}>{limit}'.format(
+                raw_serial=raw_serial,
+                size=ri - li + 1,
+                limit=settings.APP_SERIALS_RANGE_LIMIT
+            )
+        ))
+    return SerialRange(lb, li, ri, len(ld), raw_serial)
+
+
+class SerialList(object):
+    """
+    Parsed serials text, like "A0001--A0500, B17, C". Ranges are kept as intervals: uniqueness is checked by
+    sorting intervals, not serials, and serials are generated in sorted order only when list is iterated.
+    """
+    def __init__(self, serials):
+        """
+        :param serials: serials separated by any non word chars, ranges are joined by --
+        :raise InvalidParameters: on malformed range, duplicate serial or overlapping ranges
+        """
+        self.ranges = []
+        self.plain = []
+        for token in TOKEN_RE.findall(serials or ''):
+            if '--' in token:
+                self.ranges.append(parse_range(token))
+                continue
+            match = NUMBERED_RE.match(token)
+            if match:
+                base, digits = match.groups()
+                self.ranges.append(SerialRange(base, int(digits), int(digits), len(digits), token))
+            else:
+                self.plain.append(token)
+        self.check_unique()
+
+    def __len__(self):
+        return sum(r.size for r in self.ranges) + len(self.plain)
+
+    def __iter__(self):
+        singles = sorted(self.plain + [r.raw for r in self.ranges if r.size == 1])
+        return heapq.merge(singles, *(r.serials() for r in self.ranges if r.size > 1))
+
+    def check_unique(self):
+        plain = sorted(self.plain)
+        for first, second in zip(plain, plain[1:]):
+            if first == second:
+                raise InvalidParameters(ugettext(
+                    u'serials data non unique: {serial}'.format(serial=first)
+                ))
+        previous = None
+        for current in sorted(self.ranges, key=lambda r: (r.base, r.width, r.start)):
+            if previous and previous.base == current.base and previous.width == current.width and \
+                    current.start <= previous.stop:
+                raise InvalidParameters(ugettext(
+                    u'serials data non unique: {first}, {second}'.format(first=previous.raw, second=current.raw)
+                ))
+            previous = current
+
+
+def parse_serials_data(serials):
+    """
+    :param serials: serials text of Movement._serials form field
+    :return: unique serials in ascending order
+    :rtype: list[str]
+    :raise InvalidParameters: on malformed range, duplicate serial or overlapping ranges
+    """
+    return list(SerialList(serials))
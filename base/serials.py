@@ -0,0 +1,207 @@
+# -*- encoding: utf-8 -*-
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import namedtuple, OrderedDict
+
+from django.conf import settings
+from django.db import connection
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from django.utils.translation import ugettext
+
+from base.caching import get_versions, bump_version
+from base.models import ItemSerial, Item
+from base.search import escape_like
+
+SerialRef = namedtuple('SerialRef', ['serial_id', 'serial', 'item_id', 'place_id', 'category_id', 'cell_id'])
+
+SERIALS_SQL = """
+    SELECT s.id, s.serial, s.item_id, i.place_id, i.category_id, s.cell_id
+    FROM {serial} s
+        JOIN {item} i ON i.id = s.item_id
+    WHERE {{where}}
+""".format(serial=ItemSerial._meta.db_table, item=Item._meta.db_table)
+
+
+def _fetch(where, params, tail=''):
+    with connection.cursor() as cursor:
+        cursor.execute(SERIALS_SQL.format(where=where) + tail, params)
+        return [SerialRef(*row) for row in cursor.fetchall()]
+
+
+def resolve(serials):
+    """
+    Resolves batch of serial numbers by single query over unique serial index.
+    :param serials: serial numbers, duplicates and empty values are ignored
+    :return: dict serial -> SerialRef, unknown serials are missing
+    :rtype: dict
+    """
+    serials = list(set(serial for serial in serials if serial))
+    if not serials:
+        return {}
+    return dict((ref.serial, ref) for ref in _fetch("s.serial = ANY(%s)", [serials]))
+
+
+def resolve_ids(serial_ids):
+    """
+    :return: dict serial_id -> SerialRef, unknown ids are missing
+    :rtype: dict
+    """
+    serial_ids = list(set(int(pk) for pk in serial_ids if pk))
+    if not serial_ids:
+        return {}
+    return dict((ref.serial_id, ref) for ref in _fetch("s.id = ANY(%s)", [serial_ids]))
+
+
+def find_serials(serials, category, place):
+    """
+    Validates pasted serial list by single query: every serial should exist and belong to item of category in place.
+    :param serials: serial numbers
+    :type serials: list[str]
+    :type category: base.models.ItemCategory
+    :type place: base.models.Place
+    :return: found ItemSerial objects (with item and cell selected) in order of serials, and error messages
+             for all missing and misplaced serials, grouped by category and place where they are
+    :rtype: tuple
+    """
+    found = dict((obj.serial, obj) for obj in ItemSerial.objects.filter(serial__in=serials).select_related(
+        'item__place', 'item__category', 'cell'))
+    result = []
+    missing = []
+    misplaced = OrderedDict()
+    for serial in serials:
+        obj = found.get(serial)
+        if obj is None:
+            missing.append(serial)
+        elif not obj.item.category_id == getattr(category, 'pk', None) or \
+                not obj.item.place_id == getattr(place, 'pk', None):
+            misplaced.setdefault((obj.item.category, obj.item.place), []).append(serial)
+        else:
+            result.append(obj)
+    errors = []
+    if missing:
+        errors.append(ugettext('serials not found: {serials}').format(serials=", ".join(missing)))
+    for (item_category, item_place), group in misplaced.items():
+        errors.append(ugettext(
+            'serials <{serials}> are <{category}> in <{place}>, not <{expected}> in <{source}>'
+        ).format(serials=", ".join(group), category=item_category, place=item_place,
+                 expected=category, source=place if place else "<unknown place>"))
+    return result, errors
+
+
+def existing_serials(serials, purchase_item=None):
+    """
+    Serial numbers already used, by single query. Serials added by purchase_item itself are not counted.
+    :type serials: list[str]
+    :type purchase_item: base.models.PurchaseItem
+    :rtype: list[str]
+    """
+    qs = ItemSerial.objects.filter(serial__in=serials)
+    if purchase_item is not None and purchase_item.pk:
+        qs = qs.exclude(purchase_id=purchase_item.pk)
+    return sorted(qs.values_list('serial', flat=True))
+
+
+class SerialIndex(object):
+    """
+    Process local sorted array of upper cased serials, for prefix search without database round trip.
+    Array is valid while ItemSerial cache version is not changed (serial created or renamed), moves of items are
+    not tracked here: search results are always resolved from database by ids.
+    Index is shared by threads of process: version, keys and ids are replaced by single assignment of data tuple,
+    and only one thread rebuilds them at a time.
+    """
+    def __init__(self):
+        self.data = (None, [], array(str('l')))
+        self.warmed_at = 0
+        self.lock = threading.Lock()
+
+    @property
+    def version(self):
+        return self.data[0]
+
+    def warm(self):
+        """
+        Rebuilds index, unless other thread is rebuilding it already.
+        :return: False if index was being rebuilt by other thread
+        :rtype: bool
+        """
+        if not self.lock.acquire(False):
+            return False
+        try:
+            version = get_versions(ItemSerial)[0]
+            rows = sorted((serial.upper(), pk)
+                          for pk, serial in ItemSerial.objects.values_list('id', 'serial').iterator())
+            self.data = (version, [key for key, pk in rows], array(str('l'), (pk for key, pk in rows)))
+            self.warmed_at = time.time()
+        finally:
+            self.lock.release()
+        return True
+
+    def is_fresh(self):
+        return self.version is not None and self.version == get_versions(ItemSerial)[0]
+
+    def can_warm(self):
+        return time.time() - self.warmed_at > settings.APP_SERIAL_INDEX_REFRESH
+
+    def prefix_ids(self, prefix, limit):
+        """
+        :return: ids of serials starting with prefix (case insensitive), in serial order
+        :rtype: list[int]
+        """
+        version, keys, ids = self.data
+        prefix = prefix.upper()
+        result = []
+        for pos in range(bisect_left(keys, prefix), len(keys)):
+            if len(result) >= limit or not keys[pos].startswith(prefix):
+                break
+            result.append(ids[pos])
+        return result
+
+
+index = SerialIndex()
+
+
+def prefix_search(prefix, limit=20, place_id=None, category_id=None):
+    """
+    Serials starting with prefix (case insensitive). Served by btree upper(serial) varchar_pattern_ops index,
+    or by in-memory SerialIndex of current process, when settings.APP_SERIAL_INDEX_WARM is set and search is not
+    scoped by place or category. Stale SerialIndex is rebuilt not more often than settings.APP_SERIAL_INDEX_REFRESH
+    seconds, database is queried in between.
+    :param prefix: beginning of serial
+    :param limit: max results count
+    :param place_id: only serials of items in this place
+    :param category_id: only serials of items of this category
+    :rtype: list[SerialRef]
+    """
+    if settings.APP_SERIAL_INDEX_WARM and not place_id and not category_id:
+        if not index.is_fresh() and index.can_warm():
+            index.warm()
+        if index.is_fresh():
+            ids = index.prefix_ids(prefix, limit)
+            refs = resolve_ids(ids)
+            return [refs[pk] for pk in ids if pk in refs and refs[pk].serial.upper().startswith(prefix.upper())]
+    where = ["upper(s.serial) LIKE %s"]
+    params = [escape_like(prefix.upper()) + '%']
+    if place_id:
+        where.append("i.place_id = %s")
+        params.append(place_id)
+    if category_id:
+        where.append("i.category_id = %s")
+        params.append(category_id)
+    params.append(limit)
+    return _fetch(" AND ".join(where), params, " ORDER BY upper(s.serial) LIMIT %s")
+
+
+@receiver(post_save, sender=ItemSerial)
+def serial_changed(sender, instance, created, **kwargs):
+    """
+    Invalidates SerialIndex when serial is created or renamed. Moves of serials between items and cells save them
+    too, but do not change indexed keys.
+    """
+    if created or instance.serial != getattr(instance, 'loaded_serial', None):
+        bump_version(ItemSerial)
+    instance.loaded_serial = instance.serial
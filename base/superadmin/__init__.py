@@ -8,6 +8,7 @@ from django.contrib import messages
 from django.contrib.admin.utils import quote
 from django.core.exceptions import ValidationError
 from django.core.urlresolvers import reverse
+from django.db.models import Count
 from django.utils.html import mark_safe
 from django.utils.translation import ugettext_lazy as _, ugettext
 from django_mptt_admin import util
@@ -16,7 +17,8 @@ from filebrowser.settings import ADMIN_THUMBNAIL
 from grappelli_filters import RelatedAutocompleteFilter, FiltersMixin
 
 from base.models import Unit, ItemCategory, Place, PurchaseItem, Payer, Purchase, Item, ItemSerial, ItemChunk, \
-    TransactionItem, Transaction, Cell, GeoName, Warranty
+    TransactionItem, Transaction, Cell, GeoName, Warranty, RequestStat
+from base.treecache import CachedTreeMixin, invalidate_nodes
 from .actions import process_to_void, update_cell
 from .filters import MPTTRelatedAutocompleteFilter
 from .forms import ItemCategoryForm, PlaceForm, PurchaseItemForm, TransactionItemForm, PurchaseForm, TransactionForm, \
@@ -60,7 +62,7 @@ class UnitAdmin(admin.ModelAdmin):
 admin_site.register(Unit, UnitAdmin)
 
 
-class ItemCategoryAdmin(DjangoMpttAdmin):
+class ItemCategoryAdmin(CachedTreeMixin, DjangoMpttAdmin):
     class Media:
         js = ('base/js/category_parent_autocomplete.js',)
 
@@ -88,11 +90,12 @@ class ItemCategoryAdmin(DjangoMpttAdmin):
 
     def get_tree_data(self, qs, max_level):
         pk_attname = self.model._meta.pk.attname
+        qs = qs.annotate(num_items=Count('items'))
 
         def handle_create_node(instance, node_info):
             pk = quote(getattr(instance, pk_attname))
 
-            if Item.objects.filter(category_id=pk).count():
+            if instance.num_items:
                 node_info.update(
                     view_url=reverse("admin:base_category_item_changelist", args=[pk]),
                     transfer_url=reverse("admin:base_item_movement_filtered_changelist", args=[0, pk]),
@@ -112,7 +115,7 @@ class ItemCategoryAdmin(DjangoMpttAdmin):
 admin_site.register(ItemCategory, ItemCategoryAdmin)
 
 
-class PlaceAdmin(DjangoMpttAdmin):
+class PlaceAdmin(CachedTreeMixin, DjangoMpttAdmin):
     change_tree_template = u'admin/mptt_change_list.html'
     search_fields = ['name', ]
     tree_auto_open = False
@@ -127,11 +130,12 @@ class PlaceAdmin(DjangoMpttAdmin):
 
     def get_tree_data(self, qs, max_level):
         pk_attname = self.model._meta.pk.attname
+        qs = qs.annotate(num_items=Count('items'))
 
         def handle_create_node(instance, node_info):
             pk = quote(getattr(instance, pk_attname))
 
-            if Item.objects.filter(place_id=pk).count():
+            if instance.num_items:
                 node_info.update(
                     view_url=reverse("admin:base_place_item_changelist", args=[pk]),
                     transfer_url=reverse("admin:base_item_movement_filtered_changelist", args=[pk]),
@@ -203,8 +207,6 @@ class PurchaseAdmin(FiltersMixin, admin.ModelAdmin):
         else:
             inlines = self.inlines
 
-        self._obj = obj
-
         for inline_class in inlines:
             inline = inline_class(self.model, self.admin_site)
             inline_instances.append(inline)
@@ -224,8 +226,8 @@ class PurchaseAdmin(FiltersMixin, admin.ModelAdmin):
                     raise ValidationError(ugettext("purchase items data is read only!"))
             instance.save()
         formset.save_m2m()
-        if self._obj:
-            p = self._obj
+        if form.instance.pk:
+            p = form.instance
             if hasattr(p, "is_pending") and p.is_pending:
                 # print "complete pending purchase"
                 p.is_pending = False
@@ -291,8 +293,6 @@ class TransactionAdmin(FiltersMixin, admin.ModelAdmin):
         else:
             inlines = self.inlines
 
-        self._obj = obj
-
         for inline_class in inlines:
             inline = inline_class(self.model, self.admin_site)
             inline_instances.append(inline)
@@ -317,8 +317,8 @@ class TransactionAdmin(FiltersMixin, admin.ModelAdmin):
                 elif instance.pk:
                     instance.delete()
         formset.save_m2m()
-        if self._obj:
-            t = self._obj
+        if form.instance.pk:
+            t = form.instance
             if hasattr(t, "is_pending") and t.is_pending:
                 # print "complete pending transaction"
                 t.is_pending = False
@@ -352,6 +352,16 @@ class ItemAdmin(FiltersMixin, admin.ModelAdmin):
     list_filter = [('category', MPTTRelatedAutocompleteFilter), 'cell']
     list_display = ['category_name', 'quantity', 'place', 'cell']
 
+    def save_model(self, request, obj, form, change):
+        super(ItemAdmin, self).save_model(request, obj, form, change)
+        invalidate_nodes(Place, [obj.place_id, form.initial.get('place')])
+        invalidate_nodes(ItemCategory, [obj.category_id, form.initial.get('category')])
+
+    def delete_model(self, request, obj):
+        super(ItemAdmin, self).delete_model(request, obj)
+        invalidate_nodes(Place, [obj.place_id])
+        invalidate_nodes(ItemCategory, [obj.category_id])
+
 
 admin_site.register(Item, ItemAdmin)
 
@@ -443,3 +453,19 @@ class WarrantyAdmin(FiltersMixin, admin.ModelAdmin):
 
 
 admin_site.register(Warranty, WarrantyAdmin)
+
+
+class RequestStatAdmin(AdminReadOnly):
+    change_list_template = 'admin/request_stat_change_list.html'
+    list_display = ['url_name', 'method', 'status', 'query_count', 'query_time', 'repeated', 'is_over_budget',
+                    'created_at']
+    list_filter = ['is_over_budget', ('created_at', DateRangeFilter), 'method']
+    search_fields = ['url_name', 'path']
+
+    def changelist_view(self, request, extra_context=None):
+        extra_context = extra_context or {}
+        extra_context.update({'worst_endpoints': RequestStat.worst_endpoints()})
+        return super(RequestStatAdmin, self).changelist_view(request, extra_context=extra_context)
+
+
+admin_site.register(RequestStat, RequestStatAdmin)
@@ -5,6 +5,8 @@ from django.utils.translation import ugettext_lazy as _
 from grappelli_filters import RelatedAutocompleteFilter
 from mptt.models import MPTTModel
 
+from base.models import subtree_q
+
 
 class MPTTRelatedAutocompleteFilter(RelatedAutocompleteFilter):
     def __init__(self, field, request, params, model, model_admin, field_path):
@@ -42,8 +44,7 @@ class MPTTRelatedAutocompleteFilter(RelatedAutocompleteFilter):
                         request.mptt_filter = '%s | %s:"%s"' % (request.mptt_filter, _(last_field_path), obj)
                     else:
                         request.mptt_filter = '%s:"%s"' % (_(last_field_path), obj)
-                    tree = obj.get_descendants(include_self=True)
-                    param = tree.values_list("id", flat=True)
+                    return queryset.filter(subtree_q(self.field_path, mptt_model, obj))
 
             filter_parameter = self.filter_parameter if self.filter_parameter else self.get_parameter_name(
                 self.field_path)
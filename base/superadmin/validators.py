@@ -6,6 +6,7 @@ import re
 from django.core.exceptions import ValidationError
 
 from base.models import GeoName
+from base.search import search, EXACT
 
 
 def validate_place_name(value, fix=False):
@@ -17,21 +18,15 @@ def validate_place_name(value, fix=False):
     """
 
     def geoname_lookup(q, fix=False):
-        try:
-            geoname = GeoName.objects.get(name__iexact=q)
-        except GeoName.DoesNotExist:
-            geonames = GeoName.objects.filter(name__similar=q).extra(
-                select={'distance': "similarity(base_geoname.name, '%s')" % q.replace("'", "")}
-            ).order_by('-distance')
-            if geonames.count():
-                if geonames[0].name.replace(" ", "") == q.replace(" ", ""):
-                    fix = True
-                if not fix:
-                    raise ValidationError("%s: Можливо ви мали на увазі `%s`?" % (value, geonames[0].name))
-                else:
-                    geoname = geonames[0]
-            else:
-                raise ValidationError("%s: географічний об'єкт не знайдено `%s`" % (value, q))
+        geonames = search(GeoName, q, limit=1)
+        if not geonames:
+            raise ValidationError("%s: географічний об'єкт не знайдено `%s`" % (value, q))
+        geoname = geonames[0]
+        if geoname.search_rank != EXACT:
+            if geoname.name.replace(" ", "") == q.replace(" ", ""):
+                fix = True
+            if not fix:
+                raise ValidationError("%s: Можливо ви мали на увазі `%s`?" % (value, geoname.name))
         return geoname
 
     def street_parse(street_match):
@@ -1,8 +1,23 @@
 # -*- encoding: utf-8 -*-
 from __future__ import print_function, division, unicode_literals, absolute_import
 
+import json
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib import admin
+from django.contrib.admin.templatetags.admin_list import results
+from django.contrib.auth.models import User
+from django.core.exceptions import PermissionDenied
+from django.core.urlresolvers import reverse
 from django.forms import ValidationError
-from django.test import TransactionTestCase
+from django.utils import timezone
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+from django.test import TransactionTestCase, SimpleTestCase, RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
 
 # Create your tests here.
 
@@ -11,9 +26,36 @@ from model_mommy import mommy
 from decimal import Decimal
 
 from .models import Unit, ItemCategory, Item, ItemSerial, ItemChunk, IncompatibleUnitException, InvalidParameters, \
-    DryRun, Place, Purchase, PurchaseItem, FixCategoryMerge
-
-from django.db import models
+    DryRun, QuantityNotEnough, Place, Purchase, PurchaseItem, FixCategoryMerge, FixPlaceMerge, Transaction, \
+    TransactionItem, StockBalance, ReplayBalance, MovementLedger, ItemMovement, SerialMovement, Job, Cell, \
+    get_descendants_ids, subtree_q
+
+from django.db import models, connection, transaction, IntegrityError
+
+from base.admin import PlaceItemAdmin, ItemCategoryAdmin, ItemSerialsFilteredAdmin
+from base.admin.forms import TransactionItemForm
+from base.admin.pagination import EstimatedCountPaginator
+from base.api.pagination import KeysetPagination
+from base.audit import audit
+from base.autocomplete_light_registry import ItemSerialAutocomplete
+from base.bulk import reverse_foreign_keys, ITEM_MERGE_KEYS, ITEM_MERGE_SKIPPED, CATEGORY_MERGE_KEYS, \
+    CATEGORY_MERGE_SKIPPED
+from base.benchmarks import run as run_benchmarks, compare as compare_benchmarks, \
+    SCENARIOS as BENCHMARK_SCENARIOS
+from base.benchmarks.fixtures import Fixture, SCALES
+from base.export import iter_subtree_items, iter_items_csv
+from base.jobs import run_job, JobProgress
+from base.locking import stats as lock_stats, get_lock_stats, lock_items, hold_stock, LockStats
+from base.caching import get_cache, get_timeout, get_versions, get_unit_types, get_category_flags, get_place_flags
+from base.search import search, EXACT
+from base.serialranges import parse_serials_data, SerialList
+from base.serials import resolve, resolve_ids, prefix_search, find_serials, existing_serials, SerialRef, \
+    index as serials_index
+from base.treecache import ancestors_ids, invalidate_nodes, _node_keys
+from base.replay import Replay
+from base.rollup import subtree_stock, subtree_summaries, get_summaries
+from base.views import ajax_job
+from moneypot.middleware import query_shape, get_query_budget, QueryBudgetMiddleware
 
 
 class ItemTestCase(TransactionTestCase):
@@ -259,4 +301,715 @@ class MovementTestCase(TransactionTestCase):
         for item in Item.objects.all():
             self.assertEqual(item.category, cat2)
 
+    def _bulk_scenario(self, prefix, bulk):
+        source = mommy.make(Place, name="%s source" % prefix, is_shop=False)
+        destination = mommy.make(Place, name="%s destination" % prefix, is_shop=False)
+        p = mommy.make(Purchase, source=self.shop, destination=source, is_auto_source=True)
+        mommy.make(PurchaseItem, purchase=p, price=Decimal('13.52'), category=self.cat_router, quantity=4,
+                   _serials=", ".join(["%s%02d" % (prefix, i) for i in range(4)]))
+        mommy.make(PurchaseItem, purchase=p, price=Decimal('3.5'), category=self.cat_fuel, quantity=Decimal('10'))
+        p.prepare()
+        p.complete()
+        mommy.make(Item, category=self.cat_fuel, place=destination, quantity=Decimal('1.5'))
+        t = Transaction.objects.create(source=source, destination=destination)
+        for i in range(3):
+            TransactionItem.objects.create(transaction=t, category=self.cat_router, quantity=1,
+                                           serial=ItemSerial.objects.get(serial="%s%02d" % (prefix, i)))
+        TransactionItem.objects.create(transaction=t, category=self.cat_fuel, quantity=Decimal('2.5'))
+        TransactionItem.objects.create(transaction=t, category=self.cat_fuel, quantity=Decimal('4'))
+        t.force_complete(bulk=bulk)
+        result = []
+        for place in (source, destination):
+            for item in Item.objects.filter(place=place).order_by('category__pk', 'is_reserved'):
+                result.append((place.name.split()[1], item.category_id, item.quantity, item.is_reserved,
+                               sorted(s[len(prefix):] for s in item.serials.values_list('serial', flat=True))))
+        return result
+
+    def test_03_transaction_bulk_complete(self):
+        self.assertEqual(self._bulk_scenario("one", bulk=False), self._bulk_scenario("bulk", bulk=True))
+        self.assertEqual(Item.objects.filter(is_reserved=True).count(), 0)
+
+    def test_04_stock_balance(self):
+        self._bulk_scenario("one", bulk=False)
+        self._bulk_scenario("bulk", bulk=True)
+        self.assertEqual(StockBalance.mismatches(), [])
+        destination = Place.objects.get(name="bulk destination")
+        self.assertEqual(StockBalance.get_available(destination.pk, self.cat_fuel.pk), Decimal('8'))
+        self.assertEqual(StockBalance.objects.get(place=destination, category=self.cat_router).serial_count, 3)
+        self.assertEqual(StockBalance.get_available(destination.pk, self.cat_cable.pk), None)
+
+    def test_05_subtree_stock(self):
+        region = mommy.make(Place, name="region", is_shop=False)
+        child = mommy.make(Place, name="child", is_shop=False, parent=region)
+        grandchild = mommy.make(Place, name="grandchild", is_shop=False, parent=child)
+        cat_cables = mommy.make(ItemCategory, name="cables", unit=self.unit_m, is_stackable=True)
+        cat_utp = mommy.make(ItemCategory, name="utp", unit=self.unit_m, is_stackable=True, parent=cat_cables)
+        mommy.make(Item, category=cat_utp, place=child, quantity=Decimal('10'))
+        mommy.make(Item, category=cat_utp, place=grandchild, quantity=Decimal('5'))
+        mommy.make(Item, category=cat_cables, place=grandchild, quantity=Decimal('1'))
+        mommy.make(Item, category=self.cat_fuel, place=region, quantity=Decimal('2'))
+        self.assertEqual(subtree_stock(place=region, category=cat_cables)['available'], Decimal('16'))
+        self.assertEqual(subtree_stock(place=child, category=cat_utp)['available'], Decimal('15'))
+        self.assertEqual(subtree_stock(place=grandchild)['available'], Decimal('6'))
+        self.assertEqual(region.get_stock()['available'], Decimal('18'))
+        summaries = subtree_summaries(Place, [region.pk, child.pk, self.source.pk])
+        self.assertEqual(summaries[region.pk]['positions'], 3)
+        self.assertEqual(summaries[child.pk]['available'], Decimal('16'))
+        self.assertEqual(summaries[self.source.pk]['positions'], 0)
+
+    def test_06_movement_ledger(self):
+        self._bulk_scenario("led", bulk=False)
+        destination = Place.objects.get(name="led destination")
+        t = Transaction.objects.get(destination=destination)
+        self.assertEqual(MovementLedger.objects.filter(transaction=t).count(), 10)
+        self.assertEqual(
+            sorted(ItemMovement.objects.filter(place=destination).values_list('quantity', flat=True)),
+            [Decimal('3'), Decimal('6.5')]
+        )
+        self.assertEqual(
+            sorted(SerialMovement.objects.filter(place=t.source, direction=MovementLedger.OUT).values_list(
+                'serial', flat=True)),
+            ["led00", "led01", "led02"]
+        )
+        MovementLedger.objects.filter(transaction=t).delete()
+        self.assertEqual(MovementLedger.backfill(), 10)
+        self.assertEqual(MovementLedger.backfill(), 0)
+        MovementLedger.objects.filter(transaction=t).delete()
+        self.assertEqual(MovementLedger.record(t), 10)
+
+    def test_07_export_items(self):
+        region = mommy.make(Place, name="export region", is_shop=False)
+        child = mommy.make(Place, name="export child", is_shop=False, parent=region)
+        mommy.make(Place, name="export empty", is_shop=False, parent=region)
+        mommy.make(Item, category=self.cat_fuel, place=region, quantity=Decimal('2'))
+        router = mommy.make(Item, category=self.cat_router, place=child, quantity=Decimal('2'))
+        mommy.make(ItemSerial, item=router, serial="exp02")
+        mommy.make(ItemSerial, item=router, serial="exp01")
+        mommy.make(Item, category=self.cat_cable, place=child, quantity=Decimal('0'))
+        rows = list(iter_subtree_items(region))
+        self.assertEqual([(row[1], row[3]) for row in rows], [
+            ("export region", self.cat_fuel.name),
+            ("export child", self.cat_router.name),
+            ("export empty", None),
+        ])
+        self.assertEqual(rows[1][6], "exp01, exp02")
+        lines = list(iter_items_csv(region))
+        self.assertEqual(len(lines), 3)
+        self.assertIn("exp01, exp02", lines[2])
+        partial = iter_items_csv(region)
+        next(partial)
+        next(partial)
+        partial.close()
+        self.assertEqual(len(list(iter_subtree_items(region))), 3)
+
+    @override_settings(APP_JOBS_ASYNC=True)
+    def test_08_job_queue(self):
+        cat1 = mommy.make(ItemCategory, name="job1", unit=self.unit_pcs, is_stackable=True)
+        cat2 = mommy.make(ItemCategory, name="job2", unit=self.unit_pcs, is_stackable=True)
+        p = mommy.make(Purchase, source=self.shop, destination=self.destination, is_auto_source=True)
+        mommy.make(PurchaseItem, purchase=p, price=Decimal('1'), category=cat1, quantity=2, _serials="job01, job02")
+        mommy.make(PurchaseItem, purchase=p, price=Decimal('1'), category=cat2, quantity=1, _serials="job03")
+        p.prepare()
+        p.complete()
+        fix = mommy.prepare(FixCategoryMerge, old_category=cat1, new_category=cat2)
+        fix.save()
+        self.assertEqual(Item.objects.filter(category=cat1).count(), 1)
+        job = Job.claim()
+        self.assertEqual((job.name, job.status, job.attempts), ('category_merge', Job.RUNNING, 1))
+        self.assertEqual(Job.claim(), None)
+        run_job(job)
+        self.assertEqual(Job.objects.get(pk=job.pk).status, Job.DONE)
+        self.assertEqual(Item.objects.get(category=cat2).serials.count(), 3)
+        failed = Job.enqueue('return', {'return_id': 0})
+        run_job(Job.claim())
+        failed = Job.objects.get(pk=failed.pk)
+        self.assertEqual(failed.status, Job.FAILED)
+        self.assertIn("DoesNotExist", failed.error)
+        running = Job.enqueue('return', {'return_id': 0})
+        progress = JobProgress(Job.claim())
+        progress(1, 4, "quarter")
+        progress.close()
+        self.assertEqual(Job.objects.get(pk=running.pk).get_progress(), (25, "quarter"))
+        Job.objects.filter(pk=running.pk).update(attempts=3, started_at=timezone.now() - timedelta(days=1))
+        self.assertEqual(Job.claim(), None)
+        self.assertEqual(Job.objects.get(pk=running.pk).status, Job.FAILED)
+        owner = User.objects.create_user("job owner", is_staff=True)
+        own = Job.enqueue('return', {'return_id': 0}, user=owner)
+        request = RequestFactory().get('/')
+        request.user = owner
+        self.assertEqual(json.loads(ajax_job(request, own.pk).content.decode('utf-8'))['status'],
+                         own.get_status_display())
+        request.user = User.objects.create_user("other staff", is_staff=True)
+        self.assertRaises(PermissionDenied, ajax_job, request, own.pk)
+
+    def test_09_tree_cache(self):
+        region = mommy.make(Place, name="tree region", is_shop=False)
+        child = mommy.make(Place, name="tree child", is_shop=False, parent=region)
+        version = get_versions(Place)[0]
+        child.name = "tree child renamed"
+        child.save()
+        self.assertEqual(get_versions(Place)[0], version + 1)
+        self.assertEqual(sorted(ancestors_ids(Place, [child.pk])), sorted([region.pk, child.pk]))
+        keys = _node_keys(Place, [None, region.pk])
+        other = _node_keys(Place, [self.source.pk])[0]
+        cache = get_cache()
+        cache.set_many(dict((key, {'admin:1': b'[]'}) for key in keys + [other]))
+        invalidate_nodes(Place, [child.pk])
+        self.assertEqual(cache.get_many(keys), {})
+        self.assertEqual(cache.get(other), {'admin:1': b'[]'})
+        self.assertEqual(get_summaries(Place, [region.pk])[region.pk]['positions'], 0)
+        # balances changed by triggers only: cached summary is kept until tree of places changes
+        mommy.make(Item, category=self.cat_fuel, place=child, quantity=Decimal('2'))
+        self.assertEqual(get_summaries(Place, [region.pk])[region.pk]['positions'], 0)
+        child.save()
+        self.assertEqual(get_summaries(Place, [region.pk])[region.pk]['positions'], 1)
+        self.assertEqual(get_timeout(3600), settings.APP_LOCAL_CACHE_TIMEOUT)
+
+    def test_10_cache_layer(self):
+        self.assertEqual(get_unit_types()[self.unit_pcs.pk], Unit.INTEGER)
+        self.assertFalse(get_category_flags([self.cat_cable.pk])[self.cat_cable.pk]['is_stackable'])
+        self.cat_cable.is_stackable = True
+        self.cat_cable.save()
+        self.assertTrue(get_category_flags([self.cat_cable.pk])[self.cat_cable.pk]['is_stackable'])
+        self.unit_m.unit_type = Unit.INTEGER
+        self.unit_m.save()
+        self.assertEqual(get_category_flags([self.cat_cable.pk])[self.cat_cable.pk]['unit_type'], Unit.INTEGER)
+        child = mommy.make(Place, name="cache child", is_shop=False, parent=self.source, has_cells=True)
+        self.assertEqual(list(get_descendants_ids(Place, self.source.pk)), [child.pk])
+        self.assertTrue(get_place_flags([child.pk])[child.pk]['has_cells'])
+        grandchild = mommy.make(Place, name="cache grandchild", is_shop=False, parent=child)
+        self.assertEqual(sorted(get_descendants_ids(Place, self.source.pk)), sorted([child.pk, grandchild.pk]))
+        item = mommy.make(Item, category=self.cat_cable, place=child, quantity=Decimal('2'))
+        ItemCategory.objects.filter(pk=self.cat_cable.pk).update(is_stackable=False)
+        Place.objects.filter(pk=child.pk).update(has_chunks=True)
+        self.assertTrue(get_category_flags([self.cat_cable.pk])[self.cat_cable.pk]['is_stackable'])
+        locked = lock_items(child.pk, self.cat_cable.pk)
+        self.assertEqual([i.pk for i in locked], [item.pk])
+        self.assertFalse(locked[0].is_stackable)
+        self.assertTrue(locked[0].place_flags['has_chunks'])
+        self.assertEqual(locked[0].category_flags['unit_type'], Unit.INTEGER)
+
+    def test_11_search(self):
+        parent = mommy.make(ItemCategory, name="switch", unit=self.unit_pcs, is_stackable=True)
+        exact = mommy.make(ItemCategory, name="Switch 8", unit=self.unit_pcs, is_stackable=True, parent=parent)
+        prefix = mommy.make(ItemCategory, name="switch 8 port", unit=self.unit_pcs, is_stackable=True)
+        substring = mommy.make(ItemCategory, name="managed switch 8", unit=self.unit_pcs, is_stackable=True)
+        similar = mommy.make(ItemCategory, name="swich 8", unit=self.unit_pcs, is_stackable=True)
+        mommy.make(Item, category=substring, place=self.source, quantity=Decimal('1'))
+        results = search(ItemCategory, "switch 8")
+        # parent "switch" is trigram similar to "switch 8" too, more than "swich 8"
+        self.assertEqual([c.pk for c in results], [exact.pk, prefix.pk, substring.pk, parent.pk, similar.pk])
+        self.assertEqual(results[0].search_rank, EXACT)
+        self.assertEqual([c.pk for c in search(ItemCategory, "switch 8")], [c.pk for c in results])
+        self.assertNotIn(parent.pk, [c.pk for c in search(ItemCategory, "switch", leaf_only=True)])
+        self.assertEqual([c.pk for c in search(ItemCategory, "switch", source_id=self.source.pk)], [substring.pk])
+        self.assertEqual([c.pk for c in search(ItemCategory, "switch", 1, place_name=self.source.name)], [substring.pk])
+        self.assertEqual([c.pk for c in search(ItemCategory, "100%")], [])
+
+    def test_12_serial_index(self):
+        router = mommy.make(Item, category=self.cat_router, place=self.source, quantity=Decimal('3'))
+        first = mommy.make(ItemSerial, item=router, serial="IDX-0002")
+        second = mommy.make(ItemSerial, item=router, serial="IDX-0001")
+        mommy.make(ItemSerial, item=router, serial="OTHER-IDX")
+        refs = resolve(["IDX-0001", "IDX-0002", "IDX-0001", "missing", ""])
+        self.assertEqual(sorted(refs.keys()), ["IDX-0001", "IDX-0002"])
+        self.assertEqual(refs["IDX-0002"], SerialRef(first.pk, "IDX-0002", router.pk, self.source.pk,
+                                                     self.cat_router.pk, None))
+        self.assertEqual(list(resolve_ids([second.pk]).keys()), [second.pk])
+        self.assertEqual([ref.serial_id for ref in prefix_search("idx-")], [second.pk, first.pk])
+        self.assertEqual(prefix_search("idx-", place_id=self.destination.pk), [])
+        with override_settings(APP_SERIAL_INDEX_WARM=True, APP_SERIAL_INDEX_REFRESH=-1):
+            self.assertEqual([ref.serial_id for ref in prefix_search("idx-", limit=1)], [second.pk])
+            self.assertTrue(serials_index.is_fresh())
+            zero = mommy.make(ItemSerial, item=router, serial="IDX-0000")
+            self.assertFalse(serials_index.is_fresh())
+            self.assertEqual(len(prefix_search("idx-")), 3)
+            self.assertTrue(serials_index.is_fresh())
+            # moves of serials keep index fresh, renames do not
+            moved = ItemSerial.objects.get(pk=first.pk)
+            moved.item = mommy.make(Item, category=self.cat_router, place=self.destination, quantity=1)
+            moved.save()
+            self.assertTrue(serials_index.is_fresh())
+            moved.serial = "IDX-0003"
+            moved.save()
+            self.assertFalse(serials_index.is_fresh())
+        request = RequestFactory().get('/', {'q': 'idx-', 'source_id': self.source.pk})
+        autocomplete = ItemSerialAutocomplete(request=request)
+        self.assertEqual([obj.pk for obj in autocomplete.choices_for_request()], [zero.pk, second.pk])
+
+    def test_13_serial_batch_validation(self):
+        router = mommy.make(Item, category=self.cat_router, place=self.source, quantity=Decimal('3'))
+        other = mommy.make(Item, category=self.cat_router, place=self.destination, quantity=Decimal('1'))
+        cell = mommy.make(Cell, place=self.source, name="B-1")
+        mommy.make(ItemSerial, item=router, serial="BV-01", cell=cell)
+        mommy.make(ItemSerial, item=router, serial="BV-02")
+        mommy.make(ItemSerial, item=other, serial="BV-03")
+        found, errors = find_serials(["BV-01", "BV-02", "BV-03", "BV-04", "BV-05"], self.cat_router, self.source)
+        self.assertEqual([s.serial for s in found], ["BV-01", "BV-02"])
+        self.assertEqual(len(errors), 2)
+        self.assertIn("BV-04, BV-05", errors[0])
+        self.assertIn("BV-03", errors[1])
+        self.assertEqual(existing_serials(["BV-02", "BV-09"]), ["BV-02"])
+        t = Transaction.objects.create(source=self.source, destination=self.destination)
+        ti = TransactionItem(transaction=t, category=self.cat_router, quantity=2)
+        ti.split_by_serials(found)
+        items = TransactionItem.objects.filter(transaction=t).order_by('serial__serial')
+        self.assertEqual([(i.quantity, i.serial.serial, i.cell_from) for i in items],
+                         [(1, "BV-01", "B-1"), (1, "BV-02", None)])
+
+    def _purchase_scenario(self, prefix, bulk):
+        destination = mommy.make(Place, name="%s destination" % prefix, is_shop=False)
+        p = mommy.make(Purchase, source=self.shop, destination=destination, is_auto_source=True)
+        mommy.make(PurchaseItem, purchase=p, price=Decimal('13.52'), category=self.cat_router, quantity=5,
+                   _serials=", ".join(["%s%02d" % (prefix, i) for i in range(5)]))
+        mommy.make(PurchaseItem, purchase=p, price=Decimal('3.5'), category=self.cat_fuel, quantity=Decimal('10'))
+        p.complete(bulk=bulk)
+        return p, destination
+
+    def test_14_bulk_purchase(self):
+        results = []
+        for prefix, bulk in (("one", False), ("bulk", True)):
+            p, destination = self._purchase_scenario(prefix, bulk)
+            self.assertTrue(p.is_completed)
+            results.append((
+                sorted((item.category_id, item.quantity, item.is_reserved, item.serials.count())
+                       for item in Item.objects.filter(place=destination)),
+                sorted((ti.category_id, ti.quantity, ti.serial.serial[len(prefix):] if ti.serial else None)
+                       for ti in TransactionItem.objects.filter(purchase=p)),
+                ItemSerial.objects.filter(serial__startswith=prefix, purchase__purchase=p).count(),
+            ))
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(StockBalance.mismatches(), [])
+        p = mommy.make(Purchase, source=self.shop, destination=self.destination, is_auto_source=True)
+        mommy.make(PurchaseItem, purchase=p, price=Decimal('1'), category=self.cat_router, quantity=2,
+                   _serials="bulk01, new01")
+        with self.assertRaisesRegexp(IntegrityError, "serial bulk01 duplicate. item <.*> place <bulk destination>"):
+            p.complete(bulk=True)
+        p = mommy.make(Purchase, source=self.shop, destination=self.destination, is_auto_source=True)
+        pi = mommy.make(PurchaseItem, purchase=p, price=Decimal('1'), category=self.cat_router, quantity=2)
+        PurchaseItem.objects.filter(pk=pi.pk).update(quantity=Decimal('1.5'))
+        self.assertRaises(ValidationError, p.complete, bulk=True)
+        self.assertFalse(Item.objects.filter(purchase=pi).exists())
+
+    def test_15_category_merge_set_based(self):
+        old = mommy.make(ItemCategory, name="merge old", unit=self.unit_pcs, is_stackable=True)
+        new = mommy.make(ItemCategory, name="merge new", unit=self.unit_pcs, is_stackable=True)
+        both = mommy.make(Item, category=old, place=self.source, quantity=Decimal('2'))
+        mommy.make(ItemSerial, item=both, serial="merge01")
+        target = mommy.make(Item, category=new, place=self.source, quantity=Decimal('1'))
+        moved = mommy.make(Item, category=old, place=self.destination, quantity=Decimal('3'))
+        mommy.make(Item, category=old, place=self.shop, quantity=Decimal('0'))
+        t = Transaction.objects.create(source=self.source, destination=self.destination)
+        mommy.make(TransactionItem, transaction=t, category=old, quantity=1)
+        ReplayBalance.objects.create(place=self.source, category=old, quantity=2, serial_count=1)
+        ReplayBalance.objects.create(place=self.source, category=new, quantity=1)
+        ReplayBalance.objects.create(place=self.destination, category=old, quantity=3)
+        merge = FixCategoryMerge(old_category=old, new_category=new, old_category_sav_id=old.pk,
+                                 old_category_sav_name=old.name)
+        log = merge.do_merge(dry_run=True)
+        self.assertEqual(log['merged_items'], [(both.pk, target.pk)])
+        self.assertEqual(log['counts']['Item.zero_quantity_deleted'], 1)
+        self.assertEqual(log['counts']['Item.quantity'], 1)
+        self.assertEqual(log['counts']['ItemSerial.item'], 1)
+        self.assertEqual(log['counts']['Item.category'], 1)
+        self.assertEqual(log['counts']['TransactionItem.category'], 1)
+        self.assertEqual(Item.objects.filter(category=old).count(), 3)
+        User.objects.create_superuser("merge admin", "merge@example.com", "admin")
+        self.client.login(username="merge admin", password="admin")
+        response = self.client.post(reverse('admin:base_fixcategorymerge_add'),
+                                    {'old_category': old.pk, 'new_category': new.pk, 'dry_run': 'on'})
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(FixCategoryMerge.objects.exists())
+        self.assertContains(self.client.get(response['Location']), "dry run: Item.zero_quantity_deleted: 1")
+        merge.save()
+        data = json.loads(FixCategoryMerge.objects.get(pk=merge.pk).data)
+        self.assertFalse(data['dry_run'])
+        self.assertEqual(data['counts'], dict(log['counts']))
+        self.assertFalse(ItemCategory.objects.filter(pk=old.pk).exists())
+        self.assertEqual(Item.objects.get(pk=target.pk).quantity, Decimal('3'))
+        self.assertEqual(ItemSerial.objects.get(serial="merge01").item_id, target.pk)
+        self.assertEqual(Item.objects.get(pk=moved.pk).category_id, new.pk)
+        self.assertEqual(TransactionItem.objects.get(transaction=t).category_id, new.pk)
+        self.assertEqual(StockBalance.mismatches(), [])
+        self.assertEqual(
+            sorted(ReplayBalance.objects.values_list('place_id', 'category_id', 'quantity', 'serial_count')),
+            [(self.source.pk, new.pk, Decimal('3'), 1), (self.destination.pk, new.pk, Decimal('3'), 0)]
+        )
+        # every foreign key to Item and ItemCategory is either repointed by merges or skipped on purpose
+        keys = set((model.__name__, field.name) for referenced in (Item, ItemCategory)
+                   for model, field in reverse_foreign_keys(referenced))
+        listed = ITEM_MERGE_KEYS + ITEM_MERGE_SKIPPED + CATEGORY_MERGE_KEYS + CATEGORY_MERGE_SKIPPED
+        self.assertEqual(keys - set(listed), set())
+
+    @override_settings(APP_JOBS_ASYNC=True)
+    def test_16_place_merge(self):
+        old = mommy.make(Place, name="merge old", is_shop=False)
+        merged = mommy.make(Item, category=self.cat_router, place=old, quantity=3)
+        mommy.make(ItemSerial, item=merged, serial="pm01")
+        mommy.make(ItemSerial, item=merged, serial="pm02")
+        moved = mommy.make(Item, category=self.cat_fuel, place=old, quantity=Decimal('2.5'))
+        mommy.make(Item, category=self.cat_cable, place=old, quantity=Decimal('0'))
+        target = mommy.make(Item, category=self.cat_router, place=self.destination, quantity=1)
+        t = Transaction.objects.create(source=self.source, destination=old)
+        fix = mommy.prepare(FixPlaceMerge, old_place=old, new_place=self.destination)
+        fix.save()
+        job = Job.claim()
+        self.assertEqual(job.name, 'place_merge')
+        run_job(job)
+        self.assertEqual(Job.objects.get(pk=job.pk).status, Job.DONE)
+        log = json.loads(FixPlaceMerge.objects.get(pk=fix.pk).data)
+        self.assertEqual(log['counts']['Item.merged'], 1)
+        self.assertEqual(log['counts']['Item.moved'], 1)
+        self.assertEqual(log['counts']['Item.zero_quantity_deleted'], 1)
+        self.assertEqual(set(log['timings']), set(["audit", "stock", "complete", "history"]))
+        self.assertEqual(Item.objects.get(pk=target.pk).quantity, 4)
+        self.assertEqual(Item.objects.get(pk=target.pk).serials.count(), 2)
+        self.assertEqual(Item.objects.get(pk=moved.pk).place_id, self.destination.pk)
+        self.assertFalse(Item.objects.filter(place=old).exists())
+        audit = Transaction.objects.get(pk=log['transaction'])
+        self.assertEqual((audit.source_id, audit.destination_id, audit.is_completed),
+                         (old.pk, self.destination.pk, True))
+        self.assertEqual(
+            sorted((ti.quantity, ti.serial.serial if ti.serial else None) for ti in audit.transaction_items.all()),
+            [(1, "pm01"), (1, "pm02"), (1, None), (Decimal('2.5'), None)]
+        )
+        self.assertEqual(MovementLedger.objects.filter(transaction=audit).count(), 8)
+        self.assertEqual(Transaction.objects.get(pk=t.pk).destination_id, self.destination.pk)
+        self.assertTrue(Place.objects.get(pk=old.pk).name.startswith("DEL "))
+        self.assertEqual(StockBalance.mismatches(), [])
+
+    def test_17_consistency_audit(self):
+        chunked = mommy.make(Item, category=self.cat_cable, place=self.source, quantity=Decimal('5'))
+        mommy.make(ItemChunk, item=chunked, chunk=Decimal('3'))
+        serials = mommy.make(Item, category=self.cat_router, place=self.source, quantity=1)
+        mommy.make(ItemSerial, item=serials, serial="au01")
+        mommy.make(ItemSerial, item=serials, serial="au02")
+        orphan = mommy.make(Item, category=self.cat_router, place=self.destination, quantity=1, is_reserved=True)
+        negative = mommy.make(Item, category=self.cat_fuel, place=self.destination, quantity=Decimal('-1'))
+        report = audit()
+        self.assertEqual(report['violations'], 4)
+        self.assertEqual([(name, [item['item_id'] for item in check['items']])
+                          for name, check in report['checks'].items()],
+                         [('chunk_sum', [chunked.pk]), ('serial_count', [serials.pk]),
+                          ('orphan_reserved', [orphan.pk]), ('negative_quantity', [negative.pk])])
+        self.assertEqual(report['checks']['chunk_sum']['items'][0]['actual'], "3.000")
+        self.assertEqual(json.loads(json.dumps(report))['violations'], 4)
+        self.assertEqual(audit(since=timezone.now())['violations'], 0)
+        mommy.make(Item, category=self.cat_fuel, place=self.source, quantity=Decimal('-2'))
+        report = audit(checks=['negative_quantity'], limit=1)
+        self.assertEqual(list(report['checks'].keys()), ['negative_quantity'])
+        self.assertEqual(report['checks']['negative_quantity']['violations'], 2)
+        self.assertEqual(len(report['checks']['negative_quantity']['items']), 1)
+
+    def test_18_replay(self):
+        self._bulk_scenario("rep", bulk=False)
+        source = Place.objects.get(name="rep source")
+        destination = Place.objects.get(name="rep destination")
+        replay = Replay(itersize=2).run()
+        self.assertEqual(replay.movements, 3)
+        balances = replay.balances()
+        self.assertEqual(balances[(source.pk, self.cat_router.pk)], (Decimal('1'), 1))
+        self.assertEqual(balances[(destination.pk, self.cat_router.pk)], (Decimal('3'), 3))
+        self.assertEqual(balances[(source.pk, self.cat_fuel.pk)], (Decimal('3.5'), 0))
+        report = replay.diff()
+        # fuel item created in destination w/o movement is the only difference
+        self.assertEqual(report['mismatched_balances'], 1)
+        self.assertEqual(report['balances'][0]['place_id'], destination.pk)
+        self.assertEqual(report['balances'][0]['live'], ["8.000", 0])
+        self.assertEqual(report['misplaced_serials'], 0)
+        self.assertEqual(replay.write(), len(balances))
+        self.assertEqual(ReplayBalance.objects.get(place=destination, category=self.cat_fuel).quantity, Decimal('6.5'))
+        self.assertEqual(Replay().run(until=timezone.now() - timedelta(days=1)).rows, 0)
+        FixPlaceMerge(old_place=destination, new_place=source).save()
+        self.assertEqual(ReplayBalance.objects.get(place=source, category=self.cat_router).serial_count, 4)
+        self.assertFalse(ReplayBalance.objects.filter(place=destination).exists())
+        # audit transaction of merge is not replayed: history of destination is pointed to source already
+        replay = Replay().run()
+        self.assertEqual(replay.balances()[(source.pk, self.cat_router.pk)], (Decimal('4'), 4))
+        self.assertEqual(replay.diff()['mismatched_balances'], 1)
+
+    def test_19_stock_locking(self):
+        lock_stats.stats = {}
+        lock_stats.flushed_at = time.time()
+        first = mommy.make(Item, category=self.cat_fuel, place=self.source, quantity=Decimal('2'))
+        mommy.make(Item, category=self.cat_fuel, place=self.source, quantity=Decimal('3'))
+        t = Transaction.objects.create(source=self.source, destination=self.destination)
+        TransactionItem.objects.create(transaction=t, category=self.cat_fuel, quantity=Decimal('1.5'))
+        t.force_complete(bulk=False)
+        self.assertEqual(Item.objects.get(pk=first.pk).quantity, Decimal('0.5'))
+        self.assertEqual(Item.objects.get(place=self.destination).quantity, Decimal('1.5'))
+        self.assertEqual(set(lock_stats.stats), set([(self.source.pk, self.cat_fuel.pk),
+                                                     (self.destination.pk, self.cat_fuel.pk)]))
+        self.assertEqual(lock_stats.stats[(self.source.pk, self.cat_fuel.pk)]['retries'], 0)
+        stale = Item.objects.get(pk=first.pk)
+        stale.quantity = Decimal('2')
+        self.assertRaises(QuantityNotEnough, stale.withdraw, Decimal('1'))
+        self.assertEqual(Item.objects.get(pk=first.pk).quantity, Decimal('0.5'))
+        rows = get_lock_stats()
+        # transaction locks its pairs once, prepare and Place.withdraw/deposit inside complete don't lock them again
+        self.assertEqual(sorted(row['locks'] for row in rows if row['category_id'] == self.cat_fuel.pk), [1, 1])
+        with transaction.atomic():
+            lock_items(self.source.pk, self.cat_fuel.pk)
+            with hold_stock([(self.source.pk, self.cat_fuel.pk)]):
+                lock_items(self.source.pk, self.cat_fuel.pk)
+        self.assertEqual(lock_stats.stats[(self.source.pk, self.cat_fuel.pk)]['locks'], 2)
+        shared = LockStats()
+
+        def record():
+            for i in range(1000):
+                shared.record([(self.source.pk, self.cat_fuel.pk)], wait=0.001)
+        threads = [threading.Thread(target=record) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(shared.stats[(self.source.pk, self.cat_fuel.pk)]['locks'], 8000)
+
+    def test_20_subtree_filter(self):
+        child = mommy.make(Place, name="subtree child", is_shop=False, parent=self.source)
+        grandchild = mommy.make(Place, name="subtree grandchild", is_shop=False, parent=child)
+        items = dict((place.pk, mommy.make(Item, category=self.cat_router, place=place, quantity=1).pk)
+                     for place in (self.source, child, grandchild, self.destination))
+        qs = Item.objects.filter(subtree_q('place', Place, self.source.pk))
+        self.assertNotIn(' IN (', str(qs.query))
+        self.assertEqual(set(qs.values_list('id', flat=True)),
+                         set([items[self.source.pk], items[child.pk], items[grandchild.pk]]))
+        qs = Item.objects.filter(subtree_q('place', Place, Place.objects.get(pk=child.pk), include_self=False))
+        self.assertEqual(list(qs.values_list('id', flat=True)), [items[grandchild.pk]])
+        other = mommy.make(Place, name="subtree other", is_shop=False, parent=self.source)
+        with self.assertNumQueries(1):
+            q = subtree_q('', Place, self.source.pk)
+        self.assertIn(other.pk, Place.objects.filter(q).values_list('id', flat=True))
+        # bounds changed without signals (e.g. by other process) are seen too
+        source = Place.objects.get(pk=self.source.pk)
+        Place.objects.filter(pk=source.pk).update(rght=source.lft + 1)
+        self.assertFalse(Item.objects.filter(subtree_q('place', Place, source.pk, include_self=False)).exists())
+        self.assertFalse(Item.objects.filter(subtree_q('place', Place, 0)).exists())
+
+
+class QueryBudgetTestCase(SimpleTestCase):
+    def test_01_query_shape(self):
+        self.assertEqual(
+            query_shape('SELECT "base_item"."id" FROM "base_item" WHERE "base_item"."place_id" = 12'),
+            query_shape('SELECT "base_item"."id" FROM "base_item" WHERE "base_item"."place_id" = 7')
+        )
+        self.assertEqual(
+            query_shape("SELECT * FROM base_itemserial WHERE serial IN ('a''1', 'b2') AND id = 1"),
+            "SELECT * FROM base_itemserial WHERE serial IN (...) AND id = ?"
+        )
+
+    @override_settings(APP_QUERY_BUDGET={'default': {'queries': 10, 'time': 1}, 'admin:index': {'queries': 50}})
+    def test_02_budget(self):
+        self.assertEqual(get_query_budget('admin:index'), {'queries': 50, 'time': 1})
+        self.assertEqual(get_query_budget('base:ajax_qty'), {'queries': 10, 'time': 1})
+
+    @override_settings(DEBUG=False, APP_QUERY_BUDGET_ENABLED=False)
+    def test_03_disabled_without_debug(self):
+        request = RequestFactory().get('/')
+        QueryBudgetMiddleware().process_request(request)
+        self.assertFalse(connection.force_debug_cursor)
+        self.assertFalse(hasattr(request, 'query_budget_start'))
+
+
+class SerialRangesTestCase(SimpleTestCase):
+    def test_01_parse(self):
+        self.assertEqual(parse_serials_data("A0003, A0001--A0002; B7 zz AB12-0009--AB12-0011"),
+                         ["A0001", "A0002", "A0003", "AB12-0009", "AB12-0010", "AB12-0011", "B7", "zz"])
+        self.assertEqual(parse_serials_data(""), [])
+        for invalid in ("A1 A1", "zz zz", "A0001--A0010 A0005", "A0001--A0010, A0010--A0020", "A1--B2", "A01--A100",
+                        "A5--A3", "A000000--A100000"):
+            self.assertRaises(InvalidParameters, parse_serials_data, invalid)
+        self.assertEqual(len(SerialList("A0001--A0500 A1 B")), 502)
+
+    def test_02_large_ranges(self):
+        text = ", ".join("P%d-000001--P%d-100000" % (i, i) for i in range(3))
+        serials = parse_serials_data(text)
+        self.assertEqual(serials, sorted("P%d-%06d" % (i, n) for i in range(3) for n in range(1, 100001)))
+        self.assertRaises(InvalidParameters, SerialList, text + ", P1-050000")
+
+
+class BenchmarkTestCase(TransactionTestCase):
+    def test_01_scenarios(self):
+        fixture = Fixture(**SCALES['tiny']).create()
+        self.assertEqual(ItemSerial.objects.filter(item__place=fixture.storage).count(), 100)
+        self.assertEqual(Place.objects.get(pk=fixture.storage.pk).get_descendant_count(), 4)
+        report = run_benchmarks(fixture, n=2)
+        self.assertEqual(list(report['results'].keys()), list(BENCHMARK_SCENARIOS.keys()))
+        for name, result in report['results'].items():
+            self.assertGreater(result['queries'], 0, name)
+        self.assertEqual(Transaction.objects.count(), 0)
+        diff = compare_benchmarks(report, report)
+        self.assertEqual(diff['item_withdraw']['queries'], 0)
+
+
+class AdminConcurrencyTestCase(TransactionTestCase):
+    def test_01_place_item_changelist_threads(self):
+        user = User.objects.create_superuser("admin", "admin@example.com", "admin")
+        unit = mommy.make(Unit, name='pcs', unit_type=Unit.INTEGER)
+        cat_router = mommy.make(ItemCategory, unit=unit, is_stackable=True)
+        cat_switch = mommy.make(ItemCategory, unit=unit, is_stackable=True)
+        places = [mommy.make(Place, name="place %s" % i, is_shop=False) for i in range(6)]
+        for place in places:
+            Item.objects.create(place=place, category=cat_router, quantity=1)
+            Item.objects.create(place=place, category=cat_switch, quantity=0)
+        model_admin = [m for m in admin.site._registry.values() if isinstance(m, PlaceItemAdmin)][0]
+        factory = RequestFactory()
+        errors = []
+
+        def worker(place, show_zero):
+            try:
+                for i in range(20):
+                    request = factory.get('/', {'show_zero': 1} if show_zero else {})
+                    request.user = user
+                    response = model_admin.changelist_view(request, str(place.pk))
+                    self.assertEqual(response.context_data['cl_header'], place.name)
+                    queryset = response.context_data['cl'].queryset
+                    self.assertEqual(set(queryset.values_list('place_id', flat=True)), {place.pk})
+                    self.assertEqual(queryset.count(), 2 if show_zero else 1)
+            except Exception as e:  # pylint:disable=broad-except
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker, args=(place, i % 2)) for i, place in enumerate(places)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def test_02_instance_state(self):
+        self.assertIsNot(Transaction().items_prepared, Transaction().items_prepared)
+        self.assertIsNot(Purchase().items_prepared, Purchase().items_prepared)
+        self.assertIsNot(TransactionItemForm().serials, TransactionItemForm().serials)
+
+
+class ChangelistQueryPlanTestCase(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_superuser("admin", "admin@example.com", "admin")
+        self.unit = mommy.make(Unit, name='pcs', unit_type=Unit.INTEGER)
+        self.place = mommy.make(Place, name="place", is_shop=False, has_cells=True)
+        self.cell = mommy.make(Cell, place=self.place, name="A1")
+
+    def _add_items(self, count):
+        for i in range(count):
+            category = mommy.make(ItemCategory, unit=self.unit, is_stackable=True)
+            item = Item.objects.create(place=self.place, category=category, quantity=2)
+            mommy.make(ItemSerial, _quantity=2, item=item, cell=self.cell)
+
+    def _page_queries(self, model_admin, *args):
+        request = RequestFactory().get('/')
+        request.user = self.user
+        with CaptureQueriesContext(connection) as queries:
+            response = model_admin.changelist_view(request, *args)
+            rows = list(results(response.context_data['cl']))
+        return len(rows), len(queries)
+
+    def test_01_plan(self):
+        model_admin = admin.site._registry[ItemSerial]
+        select, prefetch, annotate = model_admin.get_list_plan(['serial', 'category_name', 'owner', 'cell', 'price'])
+        self.assertEqual(select, ['item__category', 'item__place', 'cell', 'purchase'])
+        self.assertEqual(prefetch, [])
+        model_admin = [m for m in admin.site._registry.values() if isinstance(m, ItemCategoryAdmin)][0]
+        select, prefetch, annotate = model_admin.get_list_plan(model_admin.list_display)
+        self.assertEqual(list(annotate.keys()), ['num_items'])
+
+    def test_02_constant_queries(self):
+        model_admin = admin.site._registry[ItemSerial]
+        place_item_admin = [m for m in admin.site._registry.values() if isinstance(m, PlaceItemAdmin)][0]
+        self._add_items(2)
+        serial_rows, serial_queries = self._page_queries(model_admin)
+        item_rows, item_queries = self._page_queries(place_item_admin, str(self.place.pk))
+        self.assertEqual((serial_rows, item_rows), (4, 2))
+        self._add_items(5)
+        self.assertEqual(self._page_queries(model_admin), (14, serial_queries))
+        self.assertEqual(self._page_queries(place_item_admin, str(self.place.pk)), (7, item_queries))
+
+    def test_03_cell_column_flags(self):
+        self._add_items(1)
+        model_admin = [m for m in admin.site._registry.values() if isinstance(m, ItemSerialsFilteredAdmin)][0]
+        request = RequestFactory().get('/')
+        request.user = self.user
+        request.item = Item.objects.get(place=self.place)
+        self.assertIn('custom_cell', model_admin.get_list_display(request))
+        # has_cells of place is read from cache, not by loading place of item
+        request.item = Item.objects.get(pk=request.item.pk)
+        with self.assertNumQueries(0):
+            self.assertIn('custom_cell', model_admin.get_list_display(request))
+
+
+class KeysetPaginationTestCase(TransactionTestCase):
+    def setUp(self):
+        self.source = mommy.make(Place, name="source", is_shop=False)
+        self.destination = mommy.make(Place, name="destination", is_shop=False)
+        now = timezone.now()
+        self.transactions = [
+            Transaction.objects.create(source=self.source, destination=self.destination,
+                                       completed_at=now - timedelta(minutes=i // 2))
+            for i in range(7)
+        ] + [Transaction.objects.create(source=self.source, destination=self.destination) for i in range(2)]
+
+    def tearDown(self):
+        Transaction.objects.all().delete()
+        Place.objects.all().delete()
+
+    def _walk(self, url):
+        factory = APIRequestFactory()
+        paginator = KeysetPagination()
+        paginator.page_size = 2
+        pages = []
+        while url:
+            request = Request(factory.get(url))
+            page = paginator.paginate_queryset(Transaction.objects.all(), request)
+            pages.append(page)
+            url = paginator.get_paginated_response([]).data['next']
+        return pages, paginator
+
+    def test_01_walk_all(self):
+        pages, paginator = self._walk('/api/transaction/')
+        ids = [t.pk for page in pages for t in page]
+        expected = list(Transaction.objects.order_by('-completed_at', '-id').values_list('pk', flat=True))
+        self.assertEqual(ids, expected)
+        self.assertEqual(len(pages), 5)
+
+    def test_02_previous(self):
+        factory = APIRequestFactory()
+        paginator = KeysetPagination()
+        paginator.page_size = 2
+        first = paginator.paginate_queryset(Transaction.objects.all(), Request(factory.get('/api/transaction/')))
+        next_url = paginator.get_next_link()
+        paginator.paginate_queryset(Transaction.objects.all(), Request(factory.get(next_url)))
+        previous_url = paginator.get_previous_link()
+        page = paginator.paginate_queryset(Transaction.objects.all(), Request(factory.get(previous_url)))
+        self.assertEqual([t.pk for t in page], [t.pk for t in first])
+        self.assertEqual(paginator.get_previous_link(), None)
+
+
+class EstimatedCountPaginatorTestCase(TransactionTestCase):
+    def setUp(self):
+        self.source = mommy.make(Place, name="source", is_shop=False)
+        self.destination = mommy.make(Place, name="destination", is_shop=False)
+        for i in range(5):
+            Transaction.objects.create(source=self.source, destination=self.destination)
+
+    def tearDown(self):
+        Transaction.objects.all().delete()
+        Place.objects.all().delete()
 
+    def test_01_exact(self):
+        paginator = EstimatedCountPaginator(Transaction.objects.order_by('id'), 2)
+        self.assertEqual(paginator.count, 5)
+        self.assertFalse(paginator.estimated)
+        self.assertEqual(paginator.num_pages, 3)
+
+    @override_settings(APP_ADMIN_COUNT_ESTIMATE=0)
+    def test_02_estimated(self):
+        ids = list(Transaction.objects.order_by('id').values_list('id', flat=True))
+        paginator = EstimatedCountPaginator(Transaction.objects.order_by('id'), 2)
+        self.assertGreater(paginator.count, 0)
+        self.assertTrue(paginator.estimated)
+        pages = [paginator.page(number) for number in range(1, 5)]
+        self.assertEqual([[t.pk for t in page] for page in pages], [ids[0:2], ids[2:4], ids[4:], []])
+        self.assertEqual([page.has_next() for page in pages], [True, True, False, False])
+        self.assertEqual(pages[1].previous_page_number(), 1)
+        self.assertEqual(pages[1].next_page_number(), 3)
@@ -0,0 +1,84 @@
+# -*- encoding: utf-8 -*-
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+from django.conf import settings
+from django.db import connection
+from django.http import HttpResponse
+
+from base.caching import get_cache, get_timeout, get_versions
+from base.models import Place, ItemCategory, TransactionItem
+from base.rollup import invalidate_summaries
+
+
+def _node_keys(model, node_ids):
+    """
+    Cache keys of tree json, in namespace of model version: any node save, move or delete makes all of them unused.
+    """
+    version = get_versions(model)[0]
+    return ["tree:%s:%s:%s" % (model._meta.model_name, node_id or 'root', version) for node_id in node_ids]
+
+
+def ancestors_ids(model, node_ids):
+    """
+    Ids of provided nodes and all their ancestors, found by single query over tree_id/lft/rght ranges.
+    :param node_ids: ids of nodes
+    :type node_ids: list[int]
+    :rtype: list[int]
+    """
+    node_ids = [pk for pk in set(node_ids) if pk]
+    if not node_ids:
+        return []
+    sql = """
+        SELECT DISTINCT a.id FROM {table} n
+            JOIN {table} a ON a.tree_id = n.tree_id AND a.lft <= n.lft AND a.rght >= n.rght
+        WHERE n.id = ANY(%s)
+    """.format(table=model._meta.db_table)
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [node_ids])
+        return [row[0] for row in cursor.fetchall()]
+
+
+def invalidate_nodes(model, node_ids):
+    """
+    Drops cached tree json and stock summaries affected by stock change of provided nodes.
+    Node label is shown in json of its parent, and summaries roll up to the root, so json of every ancestor
+    and of top level is dropped.
+    """
+    ids = ancestors_ids(model, node_ids)
+    if not ids:
+        return
+    get_cache().delete_many(_node_keys(model, ids + [None]))
+    invalidate_summaries(model, ids)
+
+
+def invalidate_transaction(trans):
+    """
+    Called by Transaction.complete: drops cached tree json of moved categories and of places items moved between.
+    Cache is dropped before commit, so json built by concurrent request in between lives until
+    settings.APP_TREE_CACHE_TIMEOUT.
+    :type trans: base.models.Transaction
+    """
+    items = TransactionItem.objects.filter(transaction_id=trans.pk)
+    place_ids = [trans.source_id, trans.destination_id]
+    place_ids.extend(items.exclude(destination=None).values_list('destination_id', flat=True).distinct())
+    invalidate_nodes(Place, place_ids)
+    invalidate_nodes(ItemCategory, items.values_list('category_id', flat=True).distinct())
+
+
+class CachedTreeMixin(object):
+    """
+    DjangoMpttAdmin mixin: jqTree json of every load_on_demand request (top level or children of one node)
+    is cached per node until tree structure changes (see base.caching.bump_version) or stock of subtree changes
+    (see invalidate_nodes). Json of different admin sites is kept under the same node key.
+    """
+    def tree_json_view(self, request):
+        cache = get_cache()
+        key = _node_keys(self.model, [request.GET.get('node')])[0]
+        variant = "%s:%s" % (self.admin_site.name, self.tree_load_on_demand)
+        variants = cache.get(key) or {}
+        if variant in variants:
+            return HttpResponse(variants[variant], content_type='application/json')
+        response = super(CachedTreeMixin, self).tree_json_view(request)
+        variants[variant] = response.content
+        cache.set(key, variants, get_timeout(settings.APP_TREE_CACHE_TIMEOUT))
+        return response
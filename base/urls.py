@@ -27,6 +27,10 @@ urlpatterns = patterns('base.views',
                            name="ajax_serial_warranty"),
                        url(r'^ajax/serial_warranty_delete/(?P<serial_id>\d+)/', 'ajax_serial_warranty',
                            name="ajax_serial_warranty_delete"),
+                       url(r'^ajax/job/(?P<job_id>\d+)/', 'ajax_job',
+                           name="ajax_job"),
+                       url(r'^job/(?P<job_id>\d+)/download', 'job_download',
+                           name="job_download"),
                        url(r'^place_item/(?P<place_id>\d+)/export', 'export_items',
                            name="export_items"),
                        url(r'^get_object_ancestors/(?P<model_name>.+)/(?P<object_id>\d+)/', 'get_object_ancestors',
@@ -2,18 +2,25 @@
 from __future__ import print_function, division, unicode_literals, absolute_import
 
 import json
-import xlsxwriter
-from io import BytesIO
-from unidecode import unidecode
+import mimetypes
+import os
+import tempfile
+from wsgiref.util import FileWrapper
 
 from django.apps import apps
-from django.http import HttpResponse, Http404
-from django.shortcuts import render_to_response
-from django.template.defaultfilters import slugify
-from datetime import datetime
+from django.contrib.admin.views.decorators import staff_member_required
+from django.core.exceptions import PermissionDenied
+from django.http import HttpResponse, Http404, StreamingHttpResponse, FileResponse
+from django.core.urlresolvers import reverse
+from django.shortcuts import render_to_response, redirect, get_object_or_404
 
 from base.admin.forms import WarrantyForm
-from base.models import Item, PurchaseItem, ItemSerial, Cell, ItemChunk, Warranty, Place
+from base.export import iter_items_csv, write_items_xlsx, export_names
+from base.models import Item, PurchaseItem, ItemSerial, Cell, ItemChunk, Warranty, Place, StockBalance, Job, \
+    ItemCategory
+from base.serials import resolve_ids
+
+EXPORT_CHUNK_SIZE = 64 * 1024
 
 
 def get_client_ip(request):
@@ -35,15 +42,14 @@ def ajax_qty(request, place_id, category_id):
     data = {
         'selector': selector
     }
-    try:
-        item = Item.objects.get(place_id=place_id, category_id=category_id)
-    except Item.DoesNotExist:
+    quantity = StockBalance.get_available(place_id, category_id)
+    if quantity is None:
         data.update({
             'qty': 'n/a'
         })
     else:
         data.update({
-            'qty': "%0.3f" % item.quantity
+            'qty': "%0.3f" % quantity
         })
     return HttpResponse(json.dumps(data), content_type="application/json")
 
@@ -77,14 +83,11 @@ def ajax_serial_category(request, serial_id):
     data = {
         'selector': selector
     }
-    try:
-        serial = ItemSerial.objects.get(pk=serial_id)
-    except ItemSerial.DoesNotExist:
-        pass
-    else:
+    ref = resolve_ids([serial_id]).get(int(serial_id))
+    if ref:
         data.update({
-            'category_name': serial.item.category.name,
-            'category_id': serial.item.category_id,
+            'category_name': ItemCategory.objects.filter(pk=ref.category_id).values_list('name', flat=True)[0],
+            'category_id': ref.category_id,
         })
     return HttpResponse(json.dumps(data), content_type="application/json")
 
@@ -255,62 +258,68 @@ def export_items(request, place_id=None):
     except Place.DoesNotExist:
         raise Http404("No place with id: %s" % place_id)
 
-    output = BytesIO()
-
-    base_level = pl.level
-    safe_name = unidecode(pl.name)[:30]
-    time_str = datetime.now().strftime("%Y-%m-%d %H:%M")
-    filename = slugify("%s-%s" % (safe_name, time_str))
-
-    book = xlsxwriter.Workbook(output)
-    blue_fmt = book.add_format({'bold': True, 'font_color': 'blue', 'align': 'center'})
-    bold_fmt = book.add_format({'bold': True, 'font_color': 'black', 'align': 'left'})
-    norm_fmt = book.add_format({'bold': False, 'font_color': 'black', 'align': 'left'})
-    norm_fmt.set_text_wrap()
-
-    sheet = book.add_worksheet(safe_name)
-    sheet.merge_range('A1:E1', "%s -- %s" % (pl.name, time_str), blue_fmt)
-    sheet.set_column(0, 0, 25)
-    sheet.set_column(1, 1, 50)
-    sheet.set_column(2, 2, 8)
-    sheet.set_column(3, 3, 8)
-    sheet.set_column(4, 4, 60)
-    sheet.write(1, 0, 'Місце', bold_fmt)
-    sheet.write(1, 1, 'Категорія предмету', bold_fmt)
-    sheet.write(1, 2, 'Кількість', bold_fmt)
-    sheet.write(1, 3, 'Одиниця', bold_fmt)
-    sheet.write(1, 4, 'Серійні номери', bold_fmt)
-
-    row = 1
-
-    places = pl.get_descendants(include_self=True)
-    for p in places:
-        items = p.items.filter(quantity__gt=0).select_related(
-            'place', 'category', 'category__unit').order_by('category__name')
-        row += 1
-        sheet.merge_range(row, 0, row, 4, p.name, bold_fmt)
-        sheet.set_row(row, None, None, {'level': p.level - base_level})
-        for i in items:
-            row += 1
-            sheet.write(row, 0, i.place.name, norm_fmt)
-            sheet.write(row, 1, i.category.name, norm_fmt)
-            sheet.write(row, 2, i.quantity, norm_fmt)
-            sheet.write(row, 3, i.category.unit.name, norm_fmt)
-            sheet.write(row, 4,
-                        ', '.join(map(lambda x: x.serial, i.serials.all()))
-                        , norm_fmt)
-            sheet.set_row(row, None, None, {'level': p.level - base_level + 1})
-
-    book.close()
+    if request.GET.get('async'):
+        job = Job.enqueue('export_items', {'place_id': pl.pk, 'format': request.GET.get('format')}, request.user)
+        return redirect(reverse("admin:base_job_change", args=[job.pk]))
 
+    safe_name, title, filename = export_names(pl)
+
+    if request.GET.get('format') == 'csv':
+        response = StreamingHttpResponse(iter_items_csv(pl), content_type="text/csv; charset=utf-8")
+        response['Content-Disposition'] = "attachment; filename=%s.csv" % filename
+        return response
+
+    output = tempfile.TemporaryFile()
+    write_items_xlsx(pl, output, safe_name, title)
+    size = output.tell()
     output.seek(0)
-    response = HttpResponse(output.read(),
-                            content_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+    response = StreamingHttpResponse(FileWrapper(output, EXPORT_CHUNK_SIZE),
+                                     content_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+    response['Content-Length'] = size
     response['Content-Disposition'] = "attachment; filename=%s.xlsx" % filename
 
     return response
 
 
+def get_user_job(request, job_id):
+    """
+    Job by id, only for its owner or superuser.
+    :raise PermissionDenied: if job is created by other user
+    :rtype: Job
+    """
+    job = get_object_or_404(Job, pk=job_id)
+    if job.created_by_id != request.user.pk and not request.user.is_superuser:
+        raise PermissionDenied
+    return job
+
+
+@staff_member_required
+def ajax_job(request, job_id):
+    job = get_user_job(request, job_id)
+    progress, message = job.get_progress()
+    data = {
+        'status': job.get_status_display(),
+        'progress': progress,
+        'message': message,
+        'result': job.get_result() if job.status == Job.DONE else None,
+        'url': job.get_download_url(),
+    }
+    return HttpResponse(json.dumps(data), content_type="application/json")
+
+
+@staff_member_required
+def job_download(request, job_id):
+    job = get_user_job(request, job_id)
+    path = job.get_export_path()
+    if path is None or not os.path.isfile(path):
+        raise Http404("No file of job: %s" % job_id)
+    name = job.get_result().get('name', os.path.basename(path))
+    response = FileResponse(open(path, 'rb'), content_type=mimetypes.guess_type(name)[0] or 'application/octet-stream')
+    response['Content-Length'] = os.path.getsize(path)
+    response['Content-Disposition'] = "attachment; filename=%s" % name
+    return response
+
+
 def get_object_ancestors(request, model_name, object_id):
     try:
         model_class = apps.get_model('base', model_name)
@@ -8,7 +8,6 @@ from django.contrib import messages
 from django.contrib.admin.utils import quote
 from django.core.exceptions import ValidationError, PermissionDenied
 from django.core.urlresolvers import reverse
-from django.db.models import Q
 from django.http import HttpResponseForbidden
 from django.utils.html import mark_safe
 from django.utils.translation import ugettext_lazy as _, ugettext
@@ -18,7 +17,8 @@ from filebrowser.settings import ADMIN_THUMBNAIL
 from grappelli_filters import RelatedAutocompleteFilter, FiltersMixin
 
 from base.admin import MPTTRelatedAutocompleteFilter
-from base.models import Place, StorageToWorkerTransaction, WorkersItem, WorkersReturn, WorkersUsed, WorkersInstalled
+from base.models import Place, StorageToWorkerTransaction, WorkersItem, WorkersReturn, WorkersUsed, WorkersInstalled, \
+    subtree_q
 from .forms import WorkersAdminAuthenticationForm, ItemCategoryForm, PlaceForm, TransactionItemForm, \
     TransactionForm, ItemChunkForm, ItemSerialForm, ReturnForm, TransactionDestinationForm
 
@@ -67,12 +67,12 @@ class GetPlaceMixin(object):
             raise PermissionDenied(_("user does not have configured place in profile"))
         return place
 
-    def get_places_ids(self, request):
-        return self.get_place(request).get_descendants(include_self=True).values_list('id', flat=True)
+    def get_places_filter(self, request, path):
+        return subtree_q(path, Place, self.get_place(request))
 
     @staticmethod
-    def get_addresses_ids():
-        return Place.objects.get(pk=PLACE_ADDRESS_ID).get_descendants(include_self=True).values_list('id', flat=True)
+    def get_addresses_filter(path):
+        return subtree_q(path, Place, PLACE_ADDRESS_ID)
 
 
 class PlaceAdmin(admin.ModelAdmin):
@@ -103,10 +103,9 @@ class StorageToWorkerTransactionAdmin(FiltersMixin, GetPlaceMixin, admin.ModelAd
     ]
 
     def get_queryset(self, request):
-        places = self.get_places_ids(request)
         qs = super(StorageToWorkerTransactionAdmin, self).get_queryset(request).prefetch_related(
             'destination', 'source')
-        return qs.filter(destination_id__in=places).order_by('-completed_at')
+        return qs.filter(self.get_places_filter(request, 'destination')).order_by('-completed_at')
 
     def has_delete_permission(self, request, obj=None):
         if obj and obj.is_completed:
@@ -150,9 +149,8 @@ class WorkersItemAdmin(FiltersMixin, GetPlaceMixin, AdminReadOnly):
     change_form_template = 'admin/proxy_change_form.html'
 
     def get_queryset(self, request):
-        places = self.get_places_ids(request)
         qs = super(WorkersItemAdmin, self).get_queryset(request).prefetch_related('serials', 'category', 'place')
-        return qs.filter(place_id__in=places).order_by('-category__name')
+        return qs.filter(self.get_places_filter(request, 'place')).order_by('-category__name')
 
     def changelist_view(self, request, extra_context=None):  # pylint:disable=arguments-differ
         extra_context = extra_context or {}
@@ -211,7 +209,6 @@ class WorkersReturnAdmin(FiltersMixin, GetPlaceMixin, admin.ModelAdmin):
             _inlines = [ReturnItemInlineReadonly, ]
         else:
             _inlines = self.inlines
-        self._obj = obj
 
         for inline_class in _inlines:
             inline = inline_class(self.model, self.admin_site)
@@ -230,8 +227,8 @@ class WorkersReturnAdmin(FiltersMixin, GetPlaceMixin, admin.ModelAdmin):
         for instance in instances:
             instance.save()
         formset.save_m2m()
-        if self._obj:
-            t = self._obj
+        if form.instance.pk:
+            t = form.instance
             if hasattr(t, "is_pending") and t.is_pending:
                 # print "complete pending transaction"
                 t.is_pending = False
@@ -258,10 +255,10 @@ class WorkersUsedAdmin(FiltersMixin, GetPlaceMixin, admin.ModelAdmin):
     ]
 
     def get_queryset(self, request):
-        places = self.get_places_ids(request)
         qs = super(WorkersUsedAdmin, self).get_queryset(request).prefetch_related(
             'destination', 'source')
-        return qs.filter(source_id__in=places, destination_id=PLACE_USED_ID).order_by('-completed_at')
+        return qs.filter(self.get_places_filter(request, 'source'),
+                         destination_id=PLACE_USED_ID).order_by('-completed_at')
 
     def has_delete_permission(self, request, obj=None):
         if obj and obj.is_completed:
@@ -311,10 +308,10 @@ class WorkersInstalledAdmin(FiltersMixin, GetPlaceMixin, admin.ModelAdmin):
     ]
 
     def get_queryset(self, request):
-        places = self.get_places_ids(request)
         qs = super(WorkersInstalledAdmin, self).get_queryset(request).prefetch_related(
             'destination', 'source')
-        return qs.filter(Q(source_id__in=places, destination_id__in=self.get_addresses_ids())).order_by('-completed_at')
+        return qs.filter(self.get_places_filter(request, 'source'),
+                         self.get_addresses_filter('destination')).order_by('-completed_at')
 
     def has_delete_permission(self, request, obj=None):
         if obj and obj.is_completed:
@@ -1,7 +1,6 @@
 # -*- encoding: utf-8 -*-
 from __future__ import print_function, division, unicode_literals, absolute_import
 
-from copy import deepcopy
 from datetime import datetime
 
 import autocomplete_light
@@ -11,6 +10,8 @@ from django.core.exceptions import ObjectDoesNotExist
 from django.utils.translation import ugettext_lazy as _, ugettext
 
 from base.admin.validators import validate_place_name
+from base.caching import get_unit_type, get_category_flags
+from base.serials import find_serials
 from base.models import InvalidParameters, ItemCategory, ItemCategoryComment, Place, PurchaseItem, TransactionItem, \
     Purchase, Transaction, Unit, ItemSerial, FixCategoryMerge, FixPlaceMerge, Cell, Item, ItemChunk, Transmutation, \
     TransmutationItem, Warranty, Return, ReturnItem
@@ -90,7 +91,7 @@ class ItemSerialForm(autocomplete_light.ModelForm):
 
     def clean_item(self):
         item = self.cleaned_data.get("item", None)
-        if not item or not item.category.unit.unit_type == Unit.INTEGER:
+        if not item or not get_category_flags([item.category_id])[item.category_id]['unit_type'] == Unit.INTEGER:
             raise forms.ValidationError("this item category can not have serial")
         if item.quantity < 1:
             raise forms.ValidationError("item quantity not enough: %s" % item.quantity)
@@ -169,13 +170,16 @@ class PlaceForm(forms.ModelForm):
 
 class TransactionItemForm(autocomplete_light.ModelForm):
     _serials = forms.CharField(required=False, label=_("serials"), widget=forms.Textarea(attrs={'cols': 80, 'rows': 1}))
-    serials = []
 
     class Meta:
         model = TransactionItem
         fields = ['quantity']
         autocomplete_fields = ('category', 'serial', 'chunk', 'destination')
 
+    def __init__(self, *args, **kwargs):
+        super(TransactionItemForm, self).__init__(*args, **kwargs)
+        self.serials = []
+
     def clean(self):
         self.serials = []
         cleaned_data = dict(self.cleaned_data)
@@ -197,7 +201,7 @@ class TransactionItemForm(autocomplete_light.ModelForm):
         except InvalidParameters as e:
             raise forms.ValidationError({'_serials': e})
 
-        if len(serials_data) and category and category.unit.unit_type == Unit.DECIMAL:
+        if len(serials_data) and category and get_unit_type(category.unit_id) == Unit.DECIMAL:
             raise forms.ValidationError({'_serials': ugettext(
                 'unit type `%s` can not have serials' % self.category.unit.name
             )})
@@ -209,19 +213,10 @@ class TransactionItemForm(autocomplete_light.ModelForm):
                 u'serials count error: {count}≠{quantity}'.format(count=len(serials_data), quantity=quantity)
             )})
 
-        for serial in serials_data:
-            try:
-                sr = ItemSerial.objects.get(serial=serial, item__category=category, item__place=transaction.source)
-            except ItemSerial.DoesNotExist:
-                raise forms.ValidationError({'_serials': ugettext(
-                    u'serial <{serial}> <{category}> not found in <{place}>'.format(
-                        serial=serial,
-                        category=category,
-                        place=transaction.source if transaction else "<unknown place>"
-                    )
-                )})
-            else:
-                self.serials.append(sr)
+        if serials_data:
+            self.serials, errors = find_serials(serials_data, category, transaction.source if transaction else None)
+            if errors:
+                raise forms.ValidationError({'_serials': errors})
 
         self.cleaned_data['_serials'] = self.serials
 
@@ -238,12 +233,7 @@ class TransactionItemForm(autocomplete_light.ModelForm):
         if ti.transaction.is_completed:
             ti.transaction.reset()
         if self.serials:
-            for serial in self.serials:
-                nti = deepcopy(ti)
-                nti.pk = None
-                nti.quantity = 1
-                nti.serial = serial
-                nti.save()
+            ti.split_by_serials(self.serials)
             setattr(ti, "trash", True)
         return ti
 
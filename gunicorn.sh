@@ -3,6 +3,7 @@ set -e
 LOGFILE=/var/log/gunicorn/moneypot-api.log
 LOGDIR=$(dirname $LOGFILE)
 NUM_WORKERS=3
+NUM_THREADS=8
 # user/group to run as
 USER=maxim
 GROUP=maxim
@@ -10,6 +11,7 @@ ADDRESS=127.0.0.1:8003
 cd /home/maxim/production/moneypot-api
 source env/bin/activate
 test -d $LOGDIR || mkdir -p $LOGDIR
-exec gunicorn moneypot.wsgi:application -w $NUM_WORKERS --bind=$ADDRESS \
+exec gunicorn moneypot.wsgi:application -w $NUM_WORKERS \
+  --worker-class=gthread --threads=$NUM_THREADS --bind=$ADDRESS \
   --user=$USER --group=$GROUP --log-level=debug \
   --log-file=$LOGFILE 2>>$LOGFILE
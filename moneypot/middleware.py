@@ -1,10 +1,15 @@
 # -*- encoding: utf-8 -*-
 from __future__ import print_function, division, unicode_literals, absolute_import
 
+import json
+import logging
+import random
 import re
 import sys
+from collections import Counter
 
 from django.conf import settings
+from django.db import connection, DatabaseError
 from django.http import HttpResponse
 from django.views.debug import ExceptionReporter
 
@@ -29,3 +34,101 @@ class StaticRevision(object):
                 html = re.sub(b"\.(js|css)(\")", b".\\1?rev=%s\\2" % revision.encode('utf-8'), html, re.UNICODE)
                 response.content = html
         return response
+
+
+logger = logging.getLogger('moneypot.queries')
+
+QUERY_SHAPE_RULES = (
+    (re.compile(r"'(?:[^']|'')*'"), "?"),
+    (re.compile(r"\b\d+(?:\.\d+)?\b"), "?"),
+    (re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)"), "(...)"),
+    (re.compile(r"\s+"), " "),
+)
+
+
+def query_shape(sql):
+    """
+    Replaces literals in sql with placeholders, so queries which differ only by parameters have the same shape.
+    :param sql: executed sql
+    :type sql: str
+    :rtype: str
+    """
+    for rxp, repl in QUERY_SHAPE_RULES:
+        sql = rxp.sub(repl, sql)
+    return sql.strip()
+
+
+def get_query_budget(url_name):
+    """
+    Budget for url name from settings.APP_QUERY_BUDGET, missing keys are taken from 'default' budget.
+    :param url_name: namespaced url name, ex: admin:base_item_changelist
+    :type url_name: str
+    :return: dict with keys queries, time, repeats
+    :rtype: dict
+    """
+    budgets = getattr(settings, 'APP_QUERY_BUDGET', {})
+    budget = dict(budgets.get('default', {}))
+    budget.update(budgets.get(url_name, {}))
+    return budget
+
+
+class QueryBudgetMiddleware(object):
+    """
+    Counts queries and db time per request, finds repeated query shapes (N+1) and compares them with
+    settings.APP_QUERY_BUDGET. Violations are logged into 'moneypot.queries' logger as json records.
+    Samples are stored in base.models.RequestStat with probability settings.APP_QUERY_STATS_SAMPLE,
+    requests over budget are always stored.
+    Queries are captured by debug cursor, which keeps sql of every query of request in memory, so middleware works
+    only with DEBUG or settings.APP_QUERY_BUDGET_ENABLED.
+    """
+
+    def process_request(self, request):
+        if not (settings.DEBUG or getattr(settings, 'APP_QUERY_BUDGET_ENABLED', False)):
+            return
+        request.query_budget_debug_cursor = connection.force_debug_cursor
+        request.query_budget_start = len(connection.queries_log)
+        connection.force_debug_cursor = True
+
+    def process_response(self, request, response):
+        if not hasattr(request, 'query_budget_start'):
+            return response
+        queries = list(connection.queries_log)[request.query_budget_start:]
+        connection.force_debug_cursor = request.query_budget_debug_cursor
+
+        match = getattr(request, 'resolver_match', None)
+        if not match:
+            return response
+        url_name = match.view_name
+
+        shapes = Counter(query_shape(q['sql']) for q in queries)
+        repeated_shape, repeated = shapes.most_common(1)[0] if shapes else ("", 0)
+        record = {
+            'url_name': url_name,
+            'path': request.path,
+            'method': request.method,
+            'status': response.status_code,
+            'query_count': len(queries),
+            'query_time': round(sum(float(q['time']) for q in queries), 3),
+            'repeated': repeated,
+        }
+
+        budget = get_query_budget(url_name)
+        violations = []
+        if record['query_count'] > budget.get('queries', record['query_count']):
+            violations.append('queries')
+        if record['query_time'] > budget.get('time', record['query_time']):
+            violations.append('time')
+        if repeated > budget.get('repeats', repeated):
+            violations.append('repeats')
+
+        if violations:
+            logger.warning(json.dumps(dict(record, violations=violations, budget=budget,
+                                           repeated_shape=repeated_shape[:500])))
+
+        if violations or random.random() < getattr(settings, 'APP_QUERY_STATS_SAMPLE', 0):
+            from base.models import RequestStat
+            try:
+                RequestStat.objects.create(is_over_budget=bool(violations), **dict(record, path=record['path'][:255]))
+            except DatabaseError:
+                logger.exception("can not save request stat for %s", url_name)
+        return response
@@ -64,6 +64,7 @@ INSTALLED_APPS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'moneypot.middleware.QueryBudgetMiddleware',
     'downtime.middleware.DowntimeMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -185,6 +186,66 @@ APP_FILTERS = {
     'GROUP_WORKERS_ID': 4
 }
 
+# Transaction.complete moves items with grouped queries (see base.bulk.BulkComplete) when True
+APP_BULK_COMPLETE = False
+
+# Check query budgets with DEBUG off too, costs memory for sql of every query of request
+APP_QUERY_BUDGET_ENABLED = False
+# Per url name limits for moneypot.middleware.QueryBudgetMiddleware, missing keys are taken from 'default'
+APP_QUERY_BUDGET = {
+    'default': {'queries': 200, 'time': 2.0, 'repeats': 30},
+}
+# Share of requests stored in base.models.RequestStat, requests over budget are stored always
+APP_QUERY_STATS_SAMPLE = 0.05
+
+# Cache alias used by base app (see base.caching). Should be backend shared by all gunicorn workers
+# (memcached, redis, database) in production, so invalidation done by one worker is seen by others.
+APP_CACHE = 'default'
+# Seconds to keep cached lookups: unit types, category and place flags
+APP_CACHE_TIMEOUT = 3600
+# Max seconds to keep any entry when APP_CACHE is per-process backend (LocMemCache): changes made by other
+# processes are not seen by it until entry expires
+APP_LOCAL_CACHE_TIMEOUT = 30
+
+# Seconds to keep cached subtree stock summaries (see base.rollup)
+APP_ROLLUP_CACHE_TIMEOUT = 300
+# Seconds to keep cached autocomplete results of one search string (see base.search)
+APP_SEARCH_CACHE_TIMEOUT = 60
+# Max count of serials in one A0001--A9999 range of serials form field (see base.serialranges)
+APP_SERIALS_RANGE_LIMIT = 100000
+# Keep sorted array of all serials in memory of every process for unscoped prefix search (see base.serials)
+APP_SERIAL_INDEX_WARM = False
+# Min seconds between rebuilds of stale in-memory serial index
+APP_SERIAL_INDEX_REFRESH = 60
+# Seconds to keep cached jqTree json of Place and ItemCategory admins (see base.treecache)
+APP_TREE_CACHE_TIMEOUT = 3600
+# Max count of reported items per check of `manage.py audit_stock` (see base.audit)
+APP_AUDIT_LIMIT = 100
+# Seconds subtracted from audit start time in watermark for next incremental audit
+APP_AUDIT_WATERMARK_OVERLAP = 300
+# Rows fetched per round trip by server side cursors of history replay (see base.replay)
+APP_REPLAY_ITERSIZE = 10000
+# Seconds to wait for lock of category in place before retry, see base.locking.lock_stock
+APP_LOCK_TIMEOUT = 2
+# Retries of timed out or deadlocked lock, delay grows by APP_LOCK_RETRY_DELAY seconds with every attempt
+APP_LOCK_RETRIES = 3
+APP_LOCK_RETRY_DELAY = 0.1
+# Lock waits longer than this seconds are logged into 'base.locking' logger
+APP_LOCK_SLOW = 0.5
+# Seconds between merges of lock statistics of process into LockStat table, at start of request or after job
+APP_LOCK_STATS_FLUSH = 60
+# Admin changelists with EstimatedCountMixin show planner estimate instead of exact count above this rows count
+APP_ADMIN_COUNT_ESTIMATE = 10000
+
+# Merges, returns and transmutations are queued to `manage.py worker` instead of running in request (see base.jobs)
+APP_JOBS_ASYNC = False
+# Seconds after which running job is considered abandoned by died worker and can be claimed again
+APP_JOBS_STALE_TIMEOUT = 3600
+# Seconds to wait before retry, multiplied by attempt number
+APP_JOBS_RETRY_DELAY = 60
+# Files of async exports, out of MEDIA_ROOT: they are served only to job owner by base.views.job_download
+APP_EXPORT_ROOT = os.path.join(PROJECT_ROOT, 'exports')
+
 
 def db_connection_init(sender, **kwargs):
     cursor = connection.cursor()
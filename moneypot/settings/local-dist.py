@@ -57,7 +57,13 @@ EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
 CACHES = {
     'default': {
         'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
-    }
+    },
+    # Cache shared by all workers, enable with APP_CACHE = 'shared'
+    # 'shared': {
+    #     'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+    #     'LOCATION': '127.0.0.1:11211',
+    #     'KEY_PREFIX': 'moneypot',
+    # },
 }
 
 # SECURITY WARNING: don't run with debug turned on in production!